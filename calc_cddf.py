@@ -28,15 +28,17 @@ import math
 #Complex number
 import cmath
 import operator
+import concurrent.futures
 import h5py
 import numpy as np
-import scipy.integrate as integrate
+import scipy.interpolate
 from scipy.stats import poisson
 import matplotlib.pyplot as plt
+import filecache
 
 class DLACatalogue(object):
     """Class to contain the DLA catalogue and hold the files containing the data"""
-    def __init__(self, processed_file = "processed_qsos_dr7q.mat", sample_file = "dla_samples.mat", raw_file = "preloaded_qsos_dr7.mat", snrs_file = "snrs_qsos_dr7.mat", snr = -2, lowzcut=False):
+    def __init__(self, processed_file = "processed_qsos_dr7q.mat", sample_file = "dla_samples.mat", raw_file = "preloaded_qsos_dr7.mat", snrs_file = "snrs_qsos_dr7.mat", snr = -2, lowzcut=False, low_memory=False, lazy=False, chunk_size=256, cache_bytes=512*1024**2):
         #Should we include the second DLA?
         self.second_dla = False
         #Spectra with a DLA probability below this value are assumed to have p = 0, as an optimization.
@@ -54,6 +56,17 @@ class DLACatalogue(object):
         self.raw_file = raw_file
         self.processed_file = processed_file
         self.tophat_prior = False
+        #Store the sample likelihoods in single precision, dropping samples with probability below p_thresh_sample.
+        #This uses several times less memory, at the cost of small changes to the results: see low_memory_report.
+        self.low_memory = low_memory
+        #Load the sample likelihoods only when first needed, in chunks of chunk_size spectra,
+        #keeping at most cache_bytes of them in memory. Use prefetch to load them in advance.
+        self.lazy = lazy
+        if lazy and low_memory:
+            raise ValueError("lazy and low_memory cannot be used together")
+        self.chunk_size = chunk_size
+        self._chunk_cache = filecache.FileCache(max_bytes=cache_bytes, check_mtime=False)
+        self._prefetcher = None
 
         #Load data from the file
         self.filehandle = h5py.File(processed_file,'r')
@@ -76,28 +89,35 @@ class DLACatalogue(object):
         self.snrs = np.array(ff["snrs"])
         if self.filter_noisy_pixels:
             self.pixel_noise = np.array(ff["pixel_noise"])
+            self._good_runs = good_pixel_runs(self.pixel_noise, self.noise_thresh)
         ff.close()
+        #Index of spectra sorted by SNR, built when first needed: see snr_index.
+        self._snr_index = None
         self.set_snr(snr)
         self.do_resample = False
         #This allows us to filter by quasar redshift later
-        self.condition = np.ones_like(self.z_min, dtype=np.bool)
+        self.condition = np.ones_like(self._z_min, dtype=bool)
         #Now load big arrays.
         #First do the DLA1 likelihoods
         #Load normalization constant for the DLA likelihoods
         self.log_norm_like_cache = {}
-        dla_ind = self.filter_dla_spectra(second=False)
-        if len(np.shape(self.filehandle["sample_log_likelihoods_dla"])) > 2:
-            log_norm_like = self.filehandle["sample_log_likelihoods_dla"][0]
-        else:
-            log_norm_like = self.filehandle["sample_log_likelihoods_dla"]
-        #Normalize by the total likelihood of a DLA in each spectrum, so that sum_spectrum ( like) == 1
-        #Each DLA in a spectrum is a different column
-        log_dla_like = self.filehandle["log_likelihoods_dla"][0]
-        #log_norm_like -= (log_dla_like + np.log(np.shape(self.log_norm_like)[0]))
-        for spec in dla_ind[0]:
-            self.log_norm_like_cache[spec] = np.array(log_norm_like[:,spec] - (log_dla_like[spec] + np.log(np.shape(log_norm_like)[0])))
-        del log_norm_like
-        del log_dla_like
+        if not self.lazy:
+            dla_ind = self.filter_dla_spectra(second=False)
+            if len(np.shape(self.filehandle["sample_log_likelihoods_dla"])) > 2:
+                log_norm_like = self.filehandle["sample_log_likelihoods_dla"][0]
+            else:
+                log_norm_like = self.filehandle["sample_log_likelihoods_dla"]
+            #Normalize by the total likelihood of a DLA in each spectrum, so that sum_spectrum ( like) == 1
+            #Each DLA in a spectrum is a different column
+            log_dla_like = self.filehandle["log_likelihoods_dla"][0]
+            #log_norm_like -= (log_dla_like + np.log(np.shape(self.log_norm_like)[0]))
+            if self.low_memory:
+                self._prune_log_norm_like(log_norm_like, log_dla_like, dla_ind[0])
+            else:
+                for spec in dla_ind[0]:
+                    self.log_norm_like_cache[spec] = np.array(log_norm_like[:,spec] - (log_dla_like[spec] + np.log(np.shape(log_norm_like)[0])))
+            del log_norm_like
+            del log_dla_like
 
         #Now build caches for the DLA2 likelihoods and base_sample values
         if self.second_dla:
@@ -123,12 +143,92 @@ class DLACatalogue(object):
         self.lnhi_vals = samplefilehandle["log_nhi_samples"][:,0]
         samplefilehandle.close()
 
+    def _prune_log_norm_like(self, log_norm_like, log_dla_like, specs):
+        """Store the normalised log likelihoods of the samples in the spectra specs, for low_memory mode.
+        Samples with a probability p_DLA * exp(log_norm_like) below p_thresh_sample are dropped:
+        they are excluded from the confidence intervals anyway, and contribute little to the means.
+        The rest are kept in single precision in a compressed sparse row layout:
+        the samples of the spectrum _sparse_specs[i] are _sparse_samples[_sparse_indptr[i]:_sparse_indptr[i+1]],
+        with log likelihoods in _sparse_log_like."""
+        nsamples = np.shape(log_norm_like)[0]
+        self._sparse_specs = np.array(specs)
+        self._sparse_indptr = np.zeros(np.size(specs)+1, dtype=np.int64)
+        samples = [np.array([], dtype=np.int32)]
+        log_likes = [np.array([], dtype=np.float32)]
+        for (i, spec) in enumerate(specs):
+            log_like = np.array(log_norm_like[:,spec]) - (log_dla_like[spec] + np.log(nsamples))
+            keep = np.where(np.exp(log_like) * self.p_dla[spec] > self.p_thresh_sample)[0]
+            samples.append(keep.astype(np.int32))
+            log_likes.append(log_like[keep].astype(np.float32))
+            self._sparse_indptr[i+1] = self._sparse_indptr[i] + np.size(keep)
+        self._sparse_samples = np.concatenate(samples)
+        self._sparse_log_like = np.concatenate(log_likes)
+
+    def _sparse_row(self, spec):
+        """Get the (sample indices, log likelihoods) stored for a spectrum in low_memory mode,
+        or None if the spectrum was not stored."""
+        row = np.searchsorted(self._sparse_specs, spec)
+        if row == np.size(self._sparse_specs) or self._sparse_specs[row] != spec:
+            return None
+        (start, end) = self._sparse_indptr[row:row+2]
+        return (self._sparse_samples[start:end], self._sparse_log_like[start:end])
+
+    def _load_chunk(self, chunk):
+        """Load the normalised log likelihoods for the spectra in a chunk, for lazy mode.
+        Returns an array of shape (nsamples, chunk_size)."""
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, np.size(self._z_min))
+        if len(self.filehandle["sample_log_likelihoods_dla"].shape) > 2:
+            log_norm_like = self.filehandle["sample_log_likelihoods_dla"][0,:,start:end]
+        else:
+            log_norm_like = self.filehandle["sample_log_likelihoods_dla"][:,start:end]
+        log_dla_like = self.filehandle["log_likelihoods_dla"][0,start:end]
+        log_norm_like -= (log_dla_like + np.log(np.shape(log_norm_like)[0]))
+        return log_norm_like
+
+    def _load_chunks(self, chunks):
+        """Load a list of chunks into the cache"""
+        for chunk in chunks:
+            self._chunk_cache.load(chunk, self._load_chunk)
+        return chunks
+
+    def prefetch(self, z_min=None, z_max=None, wait=True):
+        """Hint that queries will soon cover DLAs in a redshift range, for lazy mode.
+        Loads the chunks containing spectra above p_thresh_spec whose redshift path overlaps [z_min, z_max].
+        If wait is False the chunks are loaded in a background thread and a future is returned.
+        Otherwise returns the list of chunks loaded."""
+        if not self.lazy:
+            return []
+        specs = self.filter_dla_spectra()[0]
+        if self.do_resample:
+            specs = self._resample[specs]
+        wanted = np.ones(np.size(specs), dtype=bool)
+        if z_min is not None:
+            wanted *= self._z_max[specs] > z_min
+        if z_max is not None:
+            wanted *= self._z_min[specs] < z_max
+        chunks = [int(cc) for cc in np.unique(specs[wanted] // self.chunk_size)]
+        if wait:
+            return self._load_chunks(chunks)
+        if self._prefetcher is None:
+            self._prefetcher = concurrent.futures.ThreadPoolExecutor(1)
+        return self._prefetcher.submit(self._load_chunks, chunks)
+
+    def likelihood_memory(self):
+        """Memory used to store the sample likelihoods of the first DLA, in bytes."""
+        if self.lazy:
+            return self._chunk_cache.nbytes
+        if self.low_memory:
+            return self._sparse_specs.nbytes + self._sparse_indptr.nbytes + self._sparse_samples.nbytes + self._sparse_log_like.nbytes
+        return np.sum([ll.nbytes for ll in self.log_norm_like_cache.values()], dtype=np.int64)
+
     def resample(self, do_it=True, nspec=0):
         """Generate a new sample (with replacement) of the same size as the original."""
         assert not self.second_dla  #not implemented
         assert not self.filter_noisy_pixels #not implemented
         #z_max, z_min, p_dla, snrs and log_norm_like will now be sampled from the new set.
         self.do_resample = do_it
+        self._snr_index = None
         #Stop if we aren't resampling
         if not do_it:
             return
@@ -231,6 +331,16 @@ class DLACatalogue(object):
         if self.do_resample:
             spec = self._resample[spec]
         if not second:
+            if self.lazy:
+                (chunk, column) = divmod(spec, self.chunk_size)
+                return self._chunk_cache.load(chunk, self._load_chunk)[:,column]
+            if self.low_memory:
+                sparse = self._sparse_row(spec)
+                if sparse is not None:
+                    #Dropped samples have zero probability
+                    log_norm_like = np.full(np.size(self.z_offsets), -np.inf)
+                    log_norm_like[sparse[0]] = sparse[1]
+                    return log_norm_like
             try:
                 return self.log_norm_like_cache[spec]
             except KeyError:
@@ -242,7 +352,8 @@ class DLACatalogue(object):
                 #Each DLA in a spectrum is a different column
                 log_dla_like = self.filehandle["log_likelihoods_dla"][0,spec]
                 log_norm_like -= (log_dla_like + np.log(np.shape(log_norm_like)[0]))
-                self.log_norm_like_cache[spec] = log_norm_like
+                if not self.low_memory:
+                    self.log_norm_like_cache[spec] = log_norm_like
                 assert 0.95 < np.sum(np.exp(log_norm_like)) < 1.05
                 return log_norm_like
         # Or get for the second DLA:
@@ -281,18 +392,32 @@ class DLACatalogue(object):
         Find the spectra we are not interested in, because the probability of a DLA is below the desired threshold.
         Or because the SNR is insufficient
         """
-        return np.where((self._p_dla(second=second) > self.p_thresh_spec)*self._filter_snr_spectra())
-
-    def _filter_snr_spectra(self):
-        """Helper function to get SNR mask."""
-        snrs = self.snrs
-        if self.do_resample:
-            snrs = self.snrs[self._resample]
-        return (snrs > self.snr_thresh)*self.condition
+        ind = self.filter_snr_spectra()[0]
+        return (ind[np.where(self._p_dla(second=second)[ind] > self.p_thresh_spec)],)
 
     def filter_snr_spectra(self):
         """Remove spectra whose SNR is below snr_thresh"""
-        return np.where(self._filter_snr_spectra())
+        ind = self.snr_index().above(self.snr_thresh)
+        return (ind[np.where(self.condition[ind])],)
+
+    def snr_index(self):
+        """Get the SNRIndex of the (possibly resampled) spectra, so that selecting by SNR and redshift
+        does not need to look at the whole catalogue. It is shared between SNR thresholds,
+        and rebuilt on resampling or if lowzcut or proximity_zone change."""
+        key = (self.lowzcut, self.proximity_zone)
+        if self._snr_index is None or self._snr_index.key != key:
+            snrs = self.snrs
+            if self.do_resample:
+                snrs = self.snrs[self._resample]
+            self._snr_index = SNRIndex(snrs, self.z_min(), self._path_z_max(self.z_max(), self.z_min()), key=key)
+        return self._snr_index
+
+    def _path_z_max(self, max_z_dlas, min_z_dlas):
+        """The maximum redshift of the path searched for DLAs:
+        if lowzcut, spectra close to the quasar are removed."""
+        if self.lowzcut:
+            max_z_dlas = np.max([np.min([max_z_dlas, self.proximity(max_z_dlas)],axis=0), min_z_dlas],axis=0)
+        return max_z_dlas
 
     def set_snr(self, snr_thresh):
         """Set the value of SNR to be used, loading the SNR array if needed"""
@@ -343,98 +468,89 @@ class DLACatalogue(object):
         """
         assert z_min < z_max
         #Make a clean copy
-        #Filter spectra that don't make the SNR cut
-        ind = self.filter_snr_spectra()
+        #Filter spectra that don't make the SNR cut, or aren't in our redshift range
+        ind = self.snr_index().overlapping(self.snr_thresh, z_min, z_max)
+        ind = ind[np.where(self.condition[ind])]
         max_z_dlas = np.array(self.z_max())[ind]
         min_z_dlas = np.array(self.z_min())[ind]
         #Increase the minimum redshift to remove spectra contaminated by the lyman beta forest.
-        if self.lowzcut:
-            max_z_dlas = np.max([np.min([max_z_dlas, self.proximity(max_z_dlas)],axis=0), min_z_dlas],axis=0)
+        max_z_dlas = self._path_z_max(max_z_dlas, min_z_dlas)
         assert np.all(max_z_dlas - min_z_dlas >= 0)
-        #Filter spectra that aren't in our redshift range
-        i2 = np.where(np.logical_and(min_z_dlas < z_max, max_z_dlas > z_min))
-        max_z_dlas = max_z_dlas[i2]
-        min_z_dlas = min_z_dlas[i2]
         total = 0
         #Shortcut for spectra which cross the whole bin
         whole_bin = np.logical_and(max_z_dlas > z_max, min_z_dlas < z_min)
         #Find spectra where all pixels pass noise cuts
         if self.filter_noisy_pixels:
-            pixel_noise = self.pixel_noise[ind][i2]
-            no_filters = np.array([np.all(ftrns < self.noise_thresh) for ftrns in pixel_noise])
+            no_filters = self._pixel_runs()[5][ind]
             whole_bin = np.logical_and(whole_bin, no_filters)
         i3 = np.where(whole_bin)
-        (tbin,err) = integrate.quad(path_length_int, z_min, z_max)
+        #Path lengths are differences of the cumulative X(z)
+        xofz = path_length_table()
+        tbin = xofz(z_max) - xofz(z_min)
         total += np.size(i3) * tbin
         #Integrate only remaining spectra
         i3 = np.where(np.logical_not(whole_bin))
         max_z_dlas = max_z_dlas[i3]
         min_z_dlas = min_z_dlas[i3]
         if not self.filter_noisy_pixels:
-            for (zmin, zmax) in zip(min_z_dlas, max_z_dlas):
-                assert zmin <= zmax
-                #Do the spectra
-                pathzmax = np.min([z_max, zmax])
-                pathzmin = np.max([z_min, zmin])
-                (ans, err) = integrate.quad(path_length_int, pathzmin, pathzmax)
-                total += ans
-                assert err < 1e-6
+            assert np.all(min_z_dlas <= max_z_dlas)
+            #Do the spectra
+            pathzmax = np.minimum(z_max, max_z_dlas)
+            pathzmin = np.maximum(z_min, min_z_dlas)
+            total += np.sum(xofz(pathzmax) - xofz(pathzmin))
         else:
-            total += self._do_filtered_path(z_max, z_min, min_z_dlas, max_z_dlas, pixel_noise, no_filters, i3)
+            specs = ind[i3]
+            total += self._do_filtered_path(z_max, z_min, min_z_dlas, max_z_dlas, specs, no_filters[i3])
         #The total dX for the path length we looked in
         return total
 
-    def _do_filtered_path(self, z_max, z_min, min_z_dlas, max_z_dlas, pixel_noise, no_filters, i3):
-        """Compute the path length for spectra where certain pixels have been filtered due to their SNR."""
-        total = 0.
-        pixel_noise = pixel_noise[i3]
-        no_filters = no_filters[i3]
-        #Clamp remaining max and min to limits
-        #max_z_dlas[np.where(max_z_dlas > z_max)] = z_max
-        #min_z_dlas[np.where(min_z_dlas < z_min)] = z_min
-        for (zmin, zmax, pn, nf) in zip(min_z_dlas, max_z_dlas, pixel_noise, no_filters):
-            assert zmin < zmax
-            #Do the spectra that have good noise properties
-            pathzmax = np.min([z_max, zmax])
-            pathzmin = np.max([z_min, zmin])
-            if nf:
-                (ans, err) = integrate.quad(path_length_int, pathzmin, pathzmax)
-            #Do the others
-            else:
-                zzs = zmin+(zmax-zmin)*np.arange(np.size(pn))/(np.size(pn)-1)
-                #This will contain a list of contiguous regions with good noise properties
-                regions = []
-                #Find the first pixel within the redshift range which has good noise.
-                ii = np.where(np.logical_and(zzs >= pathzmin, pn < self.noise_thresh))
-                if np.size(ii) == 0:
-                    continue
-                ii = ii[0][0]
-                #As long as there is more spectrum to look at within our redshift range
-                while np.logical_and(ii < np.size(pn)-1, zzs[ii] <= pathzmax):
-                    #Find the next pixel which exceeds the noise bound
-                    ie = np.where(np.logical_and(pn[ii:] > self.noise_thresh, zzs[ii:] < pathzmax))
-                    #If no more pixels exceed the noise bound, exit the loop
-                    if np.size(ie) == 0:
-                        regions+=[(zzs[ii], pathzmax)]
-                        break
-                    #If this pixel exists, mark it as the end of the region
-                    ie = ie[0][0]+ii
-                    regions+=[(zzs[ii], zzs[ie-1])]
-                    #Find the start of the next regions with low noise
-                    ind = np.where(pn[ie:] < self.noise_thresh)
-                    #If it doesn't exist, exit the loop
-                    if np.size(ind) == 0:
-                        break
-                    ii = ind[0][0]+ie
-                ans=0
-                err=0
-                #Do it piecewise: first argument is the start of each bin, second is the end.
-                for zrr in regions:
-                    (a1, e1) = integrate.quad(path_length_int, zrr[0], zrr[1])
-                    ans+=a1
-                    err+=e1
-            total += ans
-            assert err < 1e-6
+    def _pixel_runs(self):
+        """Get the runs of good pixels from good_pixel_runs, recomputing them if noise_thresh has changed."""
+        if self._good_runs[0] != self.noise_thresh:
+            self._good_runs = good_pixel_runs(self.pixel_noise, self.noise_thresh)
+        return self._good_runs
+
+    def _do_filtered_path(self, z_max, z_min, min_z_dlas, max_z_dlas, specs, no_filters):
+        """Compute the path length for spectra where certain pixels have been filtered due to their SNR.
+        specs are the indices of the spectra, whose redshift ranges are (min_z_dlas, max_z_dlas),
+        and no_filters is true for spectra with no noisy pixels.
+        Uses the runs of good pixels from good_pixel_runs, vectorized over all runs.
+        The path in each run is from the first good pixel above z_min to the last good pixel,
+        or to z_max if the next noisy pixel is above z_max.
+        A pixel is good if its noise is strictly below noise_thresh, as for no_filters:
+        a pixel with noise equal to the threshold is noisy and ends a run."""
+        assert np.all(min_z_dlas < max_z_dlas)
+        (_, run_ptr, run_start, run_end, npix, _) = self._pixel_runs()
+        xofz = path_length_table()
+        pathzmax = np.minimum(z_max, max_z_dlas)
+        pathzmin = np.maximum(z_min, min_z_dlas)
+        #Do the spectra that have good noise properties
+        total = np.sum(xofz(pathzmax[no_filters]) - xofz(pathzmin[no_filters]))
+        #Do the others: find the runs of each spectrum
+        noisy = np.where(np.logical_not(no_filters))[0]
+        nruns = run_ptr[specs[noisy]+1] - run_ptr[specs[noisy]]
+        owner = np.repeat(noisy, nruns)
+        runs = np.repeat(run_ptr[specs[noisy]] - np.cumsum(nruns) + nruns, nruns) + np.arange(np.sum(nruns))
+        start = run_start[runs]
+        end = run_end[runs]
+        npix = npix[specs[owner]]
+        zmin = min_z_dlas[owner]
+        zmax = max_z_dlas[owner]
+        pathzmin = pathzmin[owner]
+        pathzmax = pathzmax[owner]
+        def zofpix(pix):
+            """Redshift of a pixel in each run"""
+            return zmin+(zmax-zmin)*pix/(npix-1)
+        #First pixel of each run which is within the redshift range
+        first = np.maximum(start, np.ceil((pathzmin - zmin)/(zmax-zmin)*(npix-1)).astype(int))
+        first[np.where(zofpix(first) < pathzmin)] += 1
+        ii = np.where(zofpix(first-1) >= pathzmin)
+        first[ii] = np.maximum(first[ii]-1, start[ii])
+        zfirst = zofpix(first)
+        valid = (first < end)*(first < npix-1)*(zfirst <= pathzmax)
+        #Runs end at their last pixel, unless the next noisy pixel is past the end of the range.
+        zlast = np.where((end < npix)*(zofpix(end) < pathzmax), zofpix(end-1), pathzmax)
+        total += np.sum(xofz(zlast[valid]) - xofz(zfirst[valid]))
         return total
 
     def column_density_function(self, z_min=1., z_max=6., lnhi_nbins=30, lnhi_min=20.,lnhi_max=23.):
@@ -697,8 +813,28 @@ class DLACatalogue(object):
 
     def _get_prob_dla_this_bin(self, spec, index, *, second=False):
         """Get the probability of a DLA with the samples specified in index."""
+        if self.low_memory and not second:
+            prob = self._sparse_prob(spec, index)
+            if prob is not None:
+                return prob * self._p_dla()[spec]
         return np.exp(self._log_norm_like(spec,second=second)[index]) * self._p_dla(second=second)[spec]
 
+    def _sparse_prob(self, spec, index):
+        """Get the normalised likelihood of the samples in (sorted) index, from the stored samples in low_memory mode.
+        Only the stored samples are exponentiated, in double precision. Returns None if the spectrum was not stored."""
+        if self.do_resample:
+            spec = self._resample[spec]
+        sparse = self._sparse_row(spec)
+        if sparse is None:
+            return None
+        (samples, log_like) = sparse
+        prob = np.zeros(np.size(index))
+        pos = np.searchsorted(index, samples)
+        found = np.where(pos < np.size(index))[0]
+        found = found[index[pos[found]] == samples[found]]
+        prob[pos[found]] = np.exp(log_like[found].astype(np.float64))
+        return prob
+
     def _split_distributions(self, q_bins, lred=2., ured=4., lnhi_min=20.3, lnhi_max=23., *, nhi=False):
         """Split the distributions for both the first and second DLA, in turn"""
         (probs, poissons) = self._split_distributions_single(q_bins, lred=lred, ured=ured, lnhi_min=lnhi_min, lnhi_max=lnhi_max, nhi=nhi, second=False)
@@ -743,7 +879,7 @@ class DLACatalogue(object):
                 #Exclude pixels which have too large noise within them
                 #These are the indexes of the samples in the pixel noise vector
                 pn = self.pixel_noise[spec]
-                pind = np.array((redshifts-self.z_min(spec))/(self.z_max(spec)-self.z_min(spec))*np.size(pn),dtype=np.int)
+                pind = np.array((redshifts-self.z_min(spec))/(self.z_max(spec)-self.z_min(spec))*np.size(pn),dtype=int)
                 desired_samples *=(pn[pind] < self.noise_thresh)
             ind = np.where(desired_samples)
             if np.size(ind) == 0:
@@ -903,6 +1039,87 @@ class DLACatalogue(object):
         hh.close()
         return zzs, flux
 
+def low_memory_report(z_min=2, z_max=4, **kwargs):
+    """Compare the results of DLACatalogue with and without low_memory.
+    Keyword arguments are passed to DLACatalogue.
+    Returns a dictionary with the ratio of the memory used for the likelihoods,
+    and the maximum relative change in the CDDF, dN/dX and Omega_DLA (summed and from the CDDF)."""
+    full = DLACatalogue(**kwargs)
+    low = DLACatalogue(low_memory=True, **kwargs)
+    def maxrel(new, old):
+        """Maximum relative difference, ignoring empty bins"""
+        new = np.ravel(new)
+        old = np.ravel(old)
+        ii = np.where(old != 0)
+        if np.size(ii) == 0:
+            return 0.
+        return np.max(np.abs(new[ii]/old[ii]-1))
+    report = {"memory_ratio" : full.likelihood_memory() / max(low.likelihood_memory(), 1)}
+    report["cddf"] = maxrel(low.column_density_function(z_min=z_min, z_max=z_max)[1], full.column_density_function(z_min=z_min, z_max=z_max)[1])
+    report["dndx"] = maxrel(low.line_density(z_min=z_min, z_max=z_max)[1], full.line_density(z_min=z_min, z_max=z_max)[1])
+    report["omega_dla"] = maxrel(low.omega_dla(z_min=z_min, z_max=z_max)[1], full.omega_dla(z_min=z_min, z_max=z_max)[1])
+    report["omega_dla_cddf"] = maxrel(low.omega_dla_cddf(z_min=z_min, z_max=z_max)[1], full.omega_dla_cddf(z_min=z_min, z_max=z_max)[1])
+    for (key, value) in report.items():
+        print(key, "=", value)
+    return report
+
+class SNRIndex(object):
+    """Index of spectra sorted by SNR, with their redshift ranges, to select
+    the spectra with SNR above a threshold whose redshift range overlaps a window.
+    Finding the spectra above a threshold costs O(log n + k) for k spectra selected,
+    so that a sweep over many thresholds can share one index.
+    For the redshift window, the spectra above the most recent threshold are sorted by z_min,
+    with a running maximum of z_max. Spectra starting inside the window are then one contiguous slice,
+    and those starting below it are searched only from the first spectrum whose running z_max reaches the window.
+    So a window query costs O(log n + k), plus the spectra starting below the window which end before it
+    but after a longer spectrum: few, as the redshift ranges of the spectra are similar in length.
+    z_max must not be less than z_min.
+    Spectra with NaN SNR are never selected. Selections are returned sorted, in the order of the catalogue.
+    key is stored to check whether the index is still valid."""
+    def __init__(self, snrs, z_min, z_max, key=None):
+        snrs = np.asarray(snrs, dtype=np.float64)
+        snrs = np.where(np.isnan(snrs), -np.inf, snrs)
+        #Sort by decreasing SNR, so that the spectra above a threshold come first
+        self.order = np.argsort(-snrs, kind='stable')
+        self._neg_snrs = -snrs[self.order]
+        self._z_min = np.asarray(z_min)[self.order]
+        self._z_max = np.asarray(z_max)[self.order]
+        self.key = key
+        #Redshift index of the spectra above the last threshold used: see _window_index
+        self._window = None
+
+    def count_above(self, snr_thresh):
+        """Number of spectra with SNR > snr_thresh"""
+        return np.searchsorted(self._neg_snrs, -snr_thresh, side='left')
+
+    def above(self, snr_thresh):
+        """Indices of the spectra with SNR > snr_thresh"""
+        return self._window_index(self.count_above(snr_thresh))[0]
+
+    def _window_index(self, nabove):
+        """For the nabove spectra with highest SNR, get (their indices, in catalogue order,
+        their indices sorted by z_min, the sorted z_min, their z_max, the running maximum of z_max).
+        Only the last one is kept, as a sweep over redshift bins uses the same threshold."""
+        if self._window is None or self._window[0] != nabove:
+            selected = np.sort(self.order[:nabove])
+            selected.flags.writeable = False
+            byz = np.argsort(self._z_min[:nabove], kind='stable')
+            z_max = self._z_max[:nabove][byz]
+            self._window = (nabove, selected, self.order[:nabove][byz], self._z_min[:nabove][byz], z_max, np.maximum.accumulate(z_max))
+        return self._window[1:]
+
+    def overlapping(self, snr_thresh, z_min, z_max):
+        """Indices of the spectra with SNR > snr_thresh whose redshift range overlaps (z_min, z_max)."""
+        (_, byz, zmins, zmaxs, runmax) = self._window_index(self.count_above(snr_thresh))
+        #Spectra starting inside the window all overlap it
+        start = np.searchsorted(zmins, z_min, side='right')
+        end = np.searchsorted(zmins, z_max, side='left')
+        #Spectra starting below the window overlap it if they end inside it.
+        #Before first, every spectrum ends below the window.
+        first = min(np.searchsorted(runmax, z_min, side='right'), start)
+        below = first + np.where(zmaxs[first:start] > z_min)[0]
+        return np.sort(np.concatenate([byz[below], byz[start:max(start, end)]]))
+
 def find_snr(nspec, real_index, raw_file, zmin, zmax):
     """Find the signal to noise ratio, according to the definition where it is the flux/s.d. noise."""
     #Get noise variance
@@ -981,7 +1198,7 @@ def HubbleByH0(z, Omega_m=0.279):
         We neglect curvature and radiation, and assume Omega_lambda = 1- Omega_m.
         Omega_m is WMAP 9 by default
     """
-    return math.sqrt(Omega_m* (1+z)**3 + (1 - Omega_m))
+    return np.sqrt(Omega_m* (1+z)**3 + (1 - Omega_m))
 
 def interval(cdf, level, offset=0):
     """Return a tuple with the confidence interval at level for the given cdf.
@@ -1062,6 +1279,45 @@ def path_length_int(z, Omega_m=0.279):
     """
     return (1+z)**2 / HubbleByH0(z, Omega_m)
 
+_path_length_tables = {}
+
+def path_length_table(Omega_m=0.279, zmax=20., npoints=4000):
+    """Get (a cached) cumulative absorption distance, X(z) = int_0^z path_length_int dz,
+    as a spline. The path length between z1 and z2 is then X(z2) - X(z1).
+    The spline is the antiderivative of a cubic spline of the integrand, accurate to about 1e-12."""
+    key = (Omega_m, zmax, npoints)
+    if key not in _path_length_tables:
+        zz = np.linspace(0, zmax, npoints)
+        _path_length_tables[key] = scipy.interpolate.CubicSpline(zz, path_length_int(zz, Omega_m)).antiderivative()
+    return _path_length_tables[key]
+
+def good_pixel_runs(pixel_noise, noise_thresh):
+    """Find the runs of contiguous pixels with noise below noise_thresh in each spectrum.
+    pixel_noise is a list of arrays, one per spectrum. The masks of all spectra are joined,
+    separated by a bad pixel, so that the runs are found by one np.diff.
+    Returns (noise_thresh, run_ptr, run_start, run_end, npix, clean): the runs of spectrum i are run_ptr[i]:run_ptr[i+1],
+    and each covers pixels run_start to run_end (exclusive) of its spectrum.
+    npix is the number of pixels in each spectrum, and clean is true for spectra with no noisy pixels."""
+    npix = np.array([np.size(pn) for pn in pixel_noise], dtype=np.int64)
+    #Offset of each spectrum in the joined mask, which has a bad pixel after each spectrum
+    offsets = np.concatenate([[0], np.cumsum(npix+1)])
+    good = np.zeros(offsets[-1]+1, dtype=bool)
+    if np.size(npix) > 0:
+        good[1:-1] = np.concatenate([np.append(np.asarray(pn) < noise_thresh, False) for pn in pixel_noise])[:-1]
+    edges = np.diff(good.astype(np.int8))
+    #Positions in the joined mask, shifted by the leading bad pixel
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0]
+    owner = np.searchsorted(offsets, starts, side='right') - 1
+    run_ptr = np.searchsorted(owner, np.arange(np.size(npix)+1))
+    run_start = starts - offsets[owner]
+    run_end = ends - offsets[owner]
+    #Clean spectra have no pixels, or one run covering all of them
+    clean = (npix == 0)
+    single = np.where(np.diff(run_ptr) == 1)[0]
+    clean[single] = (run_start[run_ptr[single]] == 0)*(run_end[run_ptr[single]] == npix[single])
+    return (noise_thresh, run_ptr, run_start, run_end, npix, clean)
+
 def rho_crit(hubble=0.7):
     """Get the critical density at z=0 in units of g cm^-3"""
     #H in units of 1/s
@@ -0,0 +1,219 @@
+"""Tests for the DLA catalogue, using a small synthetic catalogue"""
+import h5py
+import numpy as np
+import scipy.integrate
+import calc_cddf
+
+def _fake_catalogue(tmp_path, nspec=30, nsamples=2000, seed=12):
+    """Write processed, sample and snr files for a catalogue with nspec spectra and nsamples samples,
+    laid out as in the matlab files. Returns the keyword arguments for DLACatalogue."""
+    rng = np.random.RandomState(seed)
+    z_min = rng.uniform(1.8, 2.5, nspec)
+    z_max = z_min + rng.uniform(1., 2., nspec)
+    offsets = rng.uniform(0, 1, nsamples)
+    lnhi = rng.uniform(20., 23., nsamples)
+    #Likelihoods peaked around a different sample in each spectrum
+    centres = rng.randint(0, nsamples, nspec)
+    log_like = -0.5*((offsets[:,None] - offsets[centres])**2/0.05**2 + (lnhi[:,None] - lnhi[centres])**2/0.3**2)
+    log_like += rng.normal(0, 0.1, np.shape(log_like))
+    log_dla_like = np.log(np.mean(np.exp(log_like), axis=0))
+    files = {"processed_file" : str(tmp_path / "processed.mat"), "sample_file" : str(tmp_path / "samples.mat"),
+             "snrs_file" : str(tmp_path / "snrs.mat"), "raw_file" : str(tmp_path / "raw.mat")}
+    with h5py.File(files["processed_file"], 'w') as ff:
+        ff["min_z_dlas"] = z_min.reshape(1, -1)
+        ff["max_z_dlas"] = z_max.reshape(1, -1)
+        ff["p_dlas"] = rng.uniform(0, 1, (1, nspec))
+        ff["test_ind"] = np.ones((1, nspec))
+        ff["sample_log_likelihoods_dla"] = log_like
+        ff["log_likelihoods_dla"] = log_dla_like.reshape(1, -1)
+    with h5py.File(files["sample_file"], 'w') as ff:
+        ff["offset_samples"] = offsets.reshape(-1, 1)
+        ff["log_nhi_samples"] = lnhi.reshape(-1, 1)
+    with h5py.File(files["snrs_file"], 'w') as ff:
+        ff["snrs"] = rng.uniform(1, 10, nspec)
+    return files
+
+def test_low_memory(tmp_path):
+    """Low memory mode uses much less memory and changes the results only slightly."""
+    files = _fake_catalogue(tmp_path)
+    full = calc_cddf.DLACatalogue(**files)
+    low = calc_cddf.DLACatalogue(low_memory=True, **files)
+    assert low.likelihood_memory() * 4 < full.likelihood_memory()
+    assert low._sparse_log_like.dtype == np.float32
+    #Probabilities above the threshold are kept
+    spec = full.filter_dla_spectra()[0][0]
+    index = np.arange(np.size(full.z_offsets))
+    pfull = full._get_prob_dla_this_bin(spec, index)
+    plow = low._get_prob_dla_this_bin(spec, index)
+    kept = np.where(pfull > full.p_thresh_sample)
+    assert np.allclose(plow[kept], pfull[kept], rtol=1e-5)
+    assert np.all(plow[np.where(pfull <= full.p_thresh_sample)] == 0)
+    assert np.argmax(low._log_norm_like(spec)) == np.argmax(full._log_norm_like(spec))
+    report = calc_cddf.low_memory_report(z_min=2, z_max=3, **files)
+    assert report["memory_ratio"] > 4
+    assert report["cddf"] < 0.01
+    assert report["dndx"] < 0.01
+    #The summed Omega_DLA includes the pruned samples in the full catalogue
+    assert report["omega_dla"] < 0.05
+
+def test_lazy(tmp_path):
+    """Lazy loading gives the same likelihoods as eager loading, within the memory budget."""
+    files = _fake_catalogue(tmp_path)
+    full = calc_cddf.DLACatalogue(**files)
+    lazy = calc_cddf.DLACatalogue(lazy=True, chunk_size=4, cache_bytes=3*4*2000*8, **files)
+    assert lazy.likelihood_memory() == 0
+    try:
+        calc_cddf.DLACatalogue(lazy=True, low_memory=True, **files)
+        assert False
+    except ValueError:
+        pass
+    for spec in full.filter_dla_spectra()[0]:
+        assert np.array_equal(lazy._log_norm_like(spec), full._log_norm_like(spec))
+        assert lazy.find_max_like(spec) == full.find_max_like(spec)
+    stats = lazy._chunk_cache.stats()
+    assert stats["entries"] <= 3
+    assert stats["evictions"] > 0
+    assert lazy.likelihood_memory() <= 3*4*2000*8
+    (_, dndx, _, _, _) = lazy.line_density(z_min=2, z_max=3)
+    assert np.allclose(dndx, full.line_density(z_min=2, z_max=3)[1])
+    #Prefetching a redshift range loads only chunks with spectra overlapping it
+    lazy._chunk_cache.clear()
+    specs = lazy.filter_dla_spectra()[0]
+    chunks = lazy.prefetch(z_min=3.9, z_max=5.)
+    assert chunks == sorted(set(int(ss) // 4 for ss in specs[np.where(lazy.z_max()[specs] > 3.9)]))
+    assert len(lazy._chunk_cache) == min(len(chunks), 3)
+    assert lazy.prefetch(z_min=7.) == []
+    future = lazy.prefetch(z_min=2., z_max=2.5, wait=False)
+    assert future.result() == lazy.prefetch(z_min=2., z_max=2.5)
+
+def test_path_length_table():
+    """The cumulative table agrees with direct integration."""
+    xofz = calc_cddf.path_length_table()
+    for (zlo, zhi) in ((0., 1.), (2., 2.3), (3.1, 6.5)):
+        (direct, _) = scipy.integrate.quad(calc_cddf.path_length_int, zlo, zhi)
+        assert np.isclose(xofz(zhi) - xofz(zlo), direct, rtol=1e-10)
+
+def test_good_pixel_runs():
+    """Runs of good pixels are found across spectra, including at the ends and in empty spectra."""
+    noise = [np.array([0.1, 1, 1, 0.1, 0.1]), np.array([]), np.array([1., 1.]), np.array([0.1, 0.1, 1, 0.1])]
+    (_, run_ptr, start, end, npix, clean) = calc_cddf.good_pixel_runs(noise, 0.5)
+    assert np.array_equal(run_ptr, [0, 2, 2, 2, 4])
+    assert np.array_equal(start, [0, 3, 0, 3])
+    assert np.array_equal(end, [1, 5, 2, 4])
+    assert np.array_equal(npix, [5, 0, 2, 4])
+    assert np.array_equal(clean, [np.all(pn < 0.5) for pn in noise])
+    (_, _, _, _, _, clean) = calc_cddf.good_pixel_runs(noise, 2.)
+    assert np.all(clean)
+
+def _filtered_path_loop(noise_thresh, z_max, z_min, min_z_dlas, max_z_dlas, pixel_noise, no_filters):
+    """Reference for DLACatalogue._do_filtered_path: walk each spectrum, integrating each region with good noise.
+    As in _do_filtered_path, a pixel is good only if its noise is below noise_thresh."""
+    total = 0.
+    for (zmin, zmax, pn, nf) in zip(min_z_dlas, max_z_dlas, pixel_noise, no_filters):
+        pathzmax = np.min([z_max, zmax])
+        pathzmin = np.max([z_min, zmin])
+        if nf:
+            total += scipy.integrate.quad(calc_cddf.path_length_int, pathzmin, pathzmax)[0]
+            continue
+        zzs = zmin+(zmax-zmin)*np.arange(np.size(pn))/(np.size(pn)-1)
+        #Contiguous regions with good noise properties
+        regions = []
+        #Find the first pixel within the redshift range which has good noise.
+        ii = np.where(np.logical_and(zzs >= pathzmin, pn < noise_thresh))
+        if np.size(ii) == 0:
+            continue
+        ii = ii[0][0]
+        while ii < np.size(pn)-1 and zzs[ii] <= pathzmax:
+            #Find the next noisy pixel
+            ie = np.where(np.logical_and(pn[ii:] >= noise_thresh, zzs[ii:] < pathzmax))
+            if np.size(ie) == 0:
+                regions += [(zzs[ii], pathzmax)]
+                break
+            ie = ie[0][0]+ii
+            regions += [(zzs[ii], zzs[ie-1])]
+            #Find the start of the next region with low noise
+            ind = np.where(pn[ie:] < noise_thresh)
+            if np.size(ind) == 0:
+                break
+            ii = ind[0][0]+ie
+        for zrr in regions:
+            total += scipy.integrate.quad(calc_cddf.path_length_int, zrr[0], zrr[1])[0]
+    return total
+
+def test_filtered_path(tmp_path):
+    """The vectorized path length for spectra with noisy pixels matches walking each spectrum."""
+    files = _fake_catalogue(tmp_path)
+    cat = calc_cddf.DLACatalogue(**files)
+    rng = np.random.RandomState(3)
+    nspec = np.size(cat.p_dla)
+    #Noisy pixels come in clumps; some spectra have none.
+    pixel_noise = np.empty(nspec, dtype=object)
+    for ii in range(nspec):
+        pn = np.repeat(rng.uniform(0, 0.6, rng.randint(5, 60)), rng.randint(1, 20))
+        if ii % 5 == 0:
+            pn = np.minimum(pn, 0.1)
+        pixel_noise[ii] = pn
+    #Pixels with noise exactly at the threshold are noisy
+    pixel_noise[1] = np.concatenate([0.1*np.ones(100), cat.noise_thresh*np.ones(3), 0.1*np.ones(100)])
+    cat.pixel_noise = pixel_noise
+    cat.filter_noisy_pixels = True
+    cat._good_runs = calc_cddf.good_pixel_runs(pixel_noise, cat.noise_thresh)
+    specs = np.arange(nspec)
+    no_filters = np.array([np.all(pn < cat.noise_thresh) for pn in pixel_noise])
+    for (z_min, z_max) in ((2., 3.), (2.3, 2.6), (1., 6.)):
+        fast = cat._do_filtered_path(z_max, z_min, cat.z_min(), cat.z_max(), specs, no_filters)
+        slow = _filtered_path_loop(cat.noise_thresh, z_max, z_min, cat.z_min(), cat.z_max(), pixel_noise, no_filters)
+        assert slow > 0
+        assert np.isclose(fast, slow, rtol=1e-8)
+    #The threshold pixels split the second spectrum into two runs, with a gap between them
+    (zmin, zmax) = (cat.z_min()[1:2], cat.z_max()[1:2])
+    zofpix = lambda pix: zmin[0]+(zmax[0]-zmin[0])*pix/202.
+    xofz = calc_cddf.path_length_table()
+    split = cat._do_filtered_path(zmax[0], zmin[0], zmin, zmax, specs[1:2], no_filters[1:2])
+    assert np.isclose(split, xofz(zofpix(99)) - xofz(zofpix(0)) + xofz(zmax[0]) - xofz(zofpix(103)), rtol=1e-8)
+    assert cat.path_length(2., 3.) > 0
+    #Changing the threshold recomputes the runs
+    cat.noise_thresh = 0.1
+    assert cat.path_length(2., 3.) < calc_cddf.DLACatalogue(**files).path_length(2., 3.)
+
+def test_snr_index():
+    """The SNR index selects the same spectra as masking the whole catalogue."""
+    rng = np.random.RandomState(5)
+    snrs = rng.uniform(0, 10, 500)
+    snrs[::37] = np.nan
+    z_min = rng.uniform(2, 3, 500)
+    z_max = z_min + rng.uniform(0, 2, 500)
+    index = calc_cddf.SNRIndex(snrs, z_min, z_max)
+    for snr in np.linspace(-1, 11, 50):
+        assert np.array_equal(index.above(snr), np.where(snrs > snr)[0])
+        for (zlo, zhi) in ((2., 2.5), (3.5, 4.), (5., 6.)):
+            assert np.array_equal(index.overlapping(snr, zlo, zhi), np.where((snrs > snr)*(z_min < zhi)*(z_max > zlo))[0])
+    #Windows with edges exactly at the ends of spectra, and one long spectrum hiding shorter ones
+    z_max[3] = 10.
+    index = calc_cddf.SNRIndex(snrs, z_min, z_max)
+    for (zlo, zhi) in ((z_min[10], z_max[10]), (z_max[20], z_max[20]+0.1), (z_min[30]-0.1, z_min[30]), (3.9, 4.1), (6., 7.)):
+        for snr in (8., 0., 8.):
+            assert np.array_equal(index.overlapping(snr, zlo, zhi), np.where((snrs > snr)*(z_min < zhi)*(z_max > zlo))[0])
+
+def test_catalogue_snr_filter(tmp_path):
+    """Changing the SNR threshold or lowzcut gives the same selections and path lengths as before."""
+    files = _fake_catalogue(tmp_path)
+    cat = calc_cddf.DLACatalogue(**files)
+    for snr in (0, 3, 6):
+        cat.set_snr(snr)
+        assert np.array_equal(cat.filter_snr_spectra()[0], np.where(cat.snrs > snr)[0])
+        assert np.array_equal(cat.filter_dla_spectra()[0], np.where((cat.snrs > snr)*(cat.p_dla > cat.p_thresh_spec))[0])
+        for lowzcut in (False, True):
+            cat.lowzcut = lowzcut
+            ind = np.where(cat.snrs > snr)
+            zmax = cat.z_max()[ind]
+            if lowzcut:
+                zmax = np.maximum(np.minimum(zmax, zmax - cat.proximity_zone), cat.z_min()[ind])
+            overlap = np.where((cat.z_min()[ind] < 3.)*(zmax > 2.5))
+            direct = np.sum([scipy.integrate.quad(calc_cddf.path_length_int, max(zlo, 2.5), min(zhi, 3.))[0] for (zlo, zhi) in zip(cat.z_min()[ind][overlap], zmax[overlap])])
+            assert np.isclose(cat.path_length(2.5, 3.), direct, rtol=1e-8)
+    #The index is shared between thresholds
+    index = cat.snr_index()
+    cat.set_snr(1)
+    cat.filter_snr_spectra()
+    assert cat.snr_index() is index
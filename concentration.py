@@ -6,13 +6,41 @@ For this reason implement also the Ludlow 2016, 1601.02624 concentration mass re
 
 import math
 import numpy as np
+import scipy.interpolate
 
 #Utility functions
+def cached_by_redshift(cache, zz, coefficients, max_size=4096):
+    """Evaluate the redshift dependent coefficients of a model for an array of redshifts.
+    coefficients(z) returns a tuple of floats for a single redshift, and is called once
+    for each distinct redshift, the result being stored in the dictionary cache.
+    The cache is emptied before it would grow beyond max_size redshifts,
+    so that scanning over many redshifts does not use unbounded memory.
+    Returns an array of shape (ncoefficients,)+shape(zz)."""
+    zz = np.asarray(zz, dtype=np.float64)
+    (uniq, inverse) = np.unique(zz, return_inverse=True)
+    missing = [z for z in uniq if z not in cache]
+    values = [cache[z] if z in cache else coefficients(z) for z in uniq]
+    if len(cache) + len(missing) > max_size:
+        cache.clear()
+    if np.size(uniq) <= max_size:
+        cache.update(zip(uniq, values))
+    table = np.array(values).T
+    return table[:, inverse].reshape((-1,)+np.shape(zz))
+
+def capped_exp(logconc, max_conc):
+    """exp(logconc), but no more than max_conc, which is returned exactly where it is reached."""
+    logmax = np.log(max_conc)
+    return np.where(logconc >= logmax, max_conc, np.exp(np.minimum(logconc, logmax)))[()]
+
 class PradaConcentration(object):
     """Class to collect the functions for the Prada 2012, 1104.5130, concentration."""
     def __init__(self, omega_matter):
         self.omega_matter = omega_matter
         self.omega_lambda = 1-omega_matter
+        #Maximum concentration
+        self.max_conc = 1000
+        #redshift -> (Bzero, Bone)
+        self._zcache = {}
 
     def cmin(self, x):
         """Minimum of halo concentration, eq. 19 & 21."""
@@ -42,38 +70,48 @@ class PradaConcentration(object):
 
     def curlyC(self, sigmap):
         """Eq. 16: the unscaled redshift zero concentration."""
+        return np.exp(self.log_curlyC(sigmap))
+
+    def log_curlyC(self, sigmap):
+        """Log of Eq. 16, which does not overflow for small sigmap."""
         A = 2.881
         b = 1.257
         c = 1.022
         d = 0.06
-        return A * ((sigmap / b)**c + 1) * np.exp(d/sigmap**2)
+        return np.log(A * ((sigmap / b)**c + 1)) + d/sigmap**2
 
     def xxtime(self,zz):
         """Rescaled time variable as a function of redshift"""
         aa = 1./(1+zz)
         return (self.omega_lambda/ self.omega_matter)**(1./3) * aa
 
-    def concentration(self, nu, zz):
-        """Concentration parameter for NFW halo. Eq. 14. Mass in M_sun/h"""
-        #Get time.
+    def _coefficients(self, zz):
+        """The redshift dependent scalings B_0 and B_1 at a single redshift."""
         x = self.xxtime(zz)
+        return (self.Bzero(x), self.Bone(x))
+
+    def log_concentration(self, nu, zz):
+        """Log of the concentration, before the maximum is imposed.
+        This is smooth, and does not overflow for large halos."""
+        (bzero, bone) = cached_by_redshift(self._zcache, zz, self._coefficients)
         #Fluctuation amplitude at this redshift
-        sp = self.Bone(x) * 1.686/nu
-        #Concentration
-        conc = self.Bzero(x) * self.curlyC(sp)
+        sp = bone * 1.686/nu
+        return np.log(bzero) + self.log_curlyC(sp)
+
+    def concentration(self, nu, zz):
+        """Concentration parameter for NFW halo. Eq. 14. Mass in M_sun/h
+        nu and zz may be arrays, which are broadcast against each other."""
         #For large halos at high redshift, the Prada concentration becomes very large.
         #This is clearly unphysical, and only happens because there are no halos
         #to fit to in that box. Impose a maximum so that the lack of halos always wins.
-        if np.size(conc) > 1:
-            conc[np.where(conc > 1000)] = 1000
-        elif conc > 1000:
-            conc = 1000
-        return conc
+        return capped_exp(self.log_concentration(nu, zz), self.max_conc)
 
 class LudlowConcentration(object):
     """Class to compute the concentration from Ludlow 2016, 1601.02624"""
     def __init__(self, Dofz):
         self.Dofz = Dofz
+        #redshift -> (conc0, beta, gamma1, gamma2, nu0, D(z))
+        self._zcache = {}
 
     def conc0(self, zz):
         """Utility function from Ludlow 2015. Eq. C2."""
@@ -96,21 +134,31 @@ class LudlowConcentration(object):
         a = 1./(1+zz)
         nu0 = (4.135 - 0.564/a - 0.21/a/a + 0.0557/a**3 - 0.00348/a**4)
         #Prevent from going negative at high redshift
-        return np.max([nu0, 0.5])
+        return np.maximum(nu0, 0.5)
+
+    def _coefficients(self, zz):
+        """All the redshift dependent parameters at a single redshift."""
+        return (self.conc0(zz), self.beta(zz), self.gamma1(zz), self.gamma2(zz), self.nu0(zz), self.Dofz(zz))
+
+    def _conc(self, nuu, coeffs):
+        """The fitting formula, for nuu = nu/nu0 and the output of _coefficients."""
+        (conc0, beta, gamma1, gamma2) = coeffs[0:4]
+        return conc0 * (nuu)**(-gamma1)*(1+(nuu)**(1./beta))**(-beta*(gamma2 - gamma1))
 
     def concentration(self,nu,zz):
-        """Concentration fitting formula for Ludlow 2016, 1601.02624, as a function of peak height. Appendix C"""
-        nuu = nu/(self.nu0(zz)/self.Dofz(zz))
-        conc = self.conc0(zz) * (nuu)**(-self.gamma1(zz))*(1+(nuu)**(1./self.beta(zz)))**(-self.beta(zz)*(self.gamma2(zz) - self.gamma1(zz)))
+        """Concentration fitting formula for Ludlow 2016, 1601.02624, as a function of peak height. Appendix C
+        nu and zz may be arrays, which are broadcast against each other."""
+        coeffs = cached_by_redshift(self._zcache, zz, self._coefficients)
+        (nu0, dofz) = coeffs[4:]
+        conc = self._conc(nu/(nu0/dofz), coeffs)
         assert np.all(np.isfinite(conc))
         return conc
 
     def comoving_concentration(self,nu,zz):
         """Concentration fitting formula for Ludlow 2016, 1601.02624, as a function of peak height. Appendix C.
         This assumes that nu is nu * D(z)"""
-        nuu = nu/self.nu0(zz)
-        conc = self.conc0(zz) * (nuu)**(-self.gamma1(zz))*(1+(nuu)**(1./self.beta(zz)))**(-self.beta(zz)*(self.gamma2(zz) - self.gamma1(zz)))
-        return conc
+        coeffs = cached_by_redshift(self._zcache, zz, self._coefficients)
+        return self._conc(nu/coeffs[4], coeffs)
 
 
 class ConstantConcentration(object):
@@ -122,3 +170,71 @@ class ConstantConcentration(object):
         """Constant concentration."""
         _ = zz
         return self.conc*np.ones_like(nu)
+
+
+class ConcentrationTable(object):
+    """A spline of log c(log10 M, z) for a concentration model, so concentrations need not be
+    recomputed for every mass on every call.
+    nu_func(log10 M, z) gives the peak height for mass in M_sun/h and should broadcast.
+    The accuracy is measured when the table is built, by comparing to the model at the midpoints
+    of the grid, and stored in max_rel_error. With the default grid, 200 masses over 19 decades and
+    128 redshifts from 0 to 20 evenly spaced in log(1+z), it is better than 10^-4 (6.4x10^-5) for the Prada model,
+    whose maximum concentration is imposed after interpolation. For the Ludlow model it is better than 10^-4,
+    except for 6.3 < z < 7.4, where the floor on nu0 puts a kink in c(z) and the error is up to 0.4%.
+    It is exact for a constant concentration.
+    key is an arbitrary string identifying the cosmology and model, checked when loading from disk."""
+    def __init__(self, conc_model, nu_func, log_mass_lim=(1, 20), redshifts=None, nmass=200, key=""):
+        if redshifts is None:
+            redshifts = np.expm1(np.linspace(0, np.log(21.), 128))
+        self.key = key
+        self.max_conc = getattr(conc_model, "max_conc", np.inf)
+        self.logmass = np.linspace(log_mass_lim[0], log_mass_lim[1], nmass)
+        self.redshifts = np.array(redshifts, dtype=np.float64)
+        self.logconc = self._exact(conc_model, nu_func, self.logmass, self.redshifts)
+        self._setup()
+        #Check the accuracy halfway between the grid points
+        midmass = (self.logmass[1:]+self.logmass[:-1])/2.
+        midz = (self.redshifts[1:]+self.redshifts[:-1])/2.
+        exact = capped_exp(self._exact(conc_model, nu_func, midmass, midz), self.max_conc)
+        self.max_rel_error = np.max(np.abs(self.concentration(midmass[:,np.newaxis], midz[np.newaxis,:])/exact - 1))
+
+    def _exact(self, conc_model, nu_func, logmass, redshifts):
+        """The log of the concentration from the model on a mass x redshift grid.
+        If the model has a maximum concentration, this is the smooth log concentration before the maximum is imposed."""
+        nu = nu_func(logmass[:,np.newaxis], redshifts[np.newaxis,:])
+        if hasattr(conc_model, "log_concentration"):
+            logconc = conc_model.log_concentration(nu, redshifts[np.newaxis,:])
+        else:
+            logconc = np.log(conc_model.concentration(nu, redshifts[np.newaxis,:]))
+        return np.ones_like(nu)*logconc
+
+    def _setup(self):
+        """Build the spline"""
+        kz = min(3, np.size(self.redshifts)-1)
+        self.spline = scipy.interpolate.RectBivariateSpline(self.logmass, self.redshifts, self.logconc, kx=3, ky=kz)
+
+    def concentration(self, logmass, zz):
+        """Interpolated concentration. logmass is log10(M / (M_sun/h)). Arrays are broadcast."""
+        (logmass, zz) = np.broadcast_arrays(logmass, zz)
+        logconc = self.spline.ev(logmass.ravel(), zz.ravel()).reshape(np.shape(logmass))
+        return capped_exp(logconc, self.max_conc)
+
+    def save(self, fname):
+        """Save the table to a file, which can be loaded with load_table"""
+        np.savez(fname, logmass=self.logmass, redshifts=self.redshifts, logconc=self.logconc,
+                 key=self.key, max_rel_error=self.max_rel_error, max_conc=self.max_conc)
+
+def load_table(fname, key=None):
+    """Load a ConcentrationTable saved to fname.
+    If key is not None, raise ValueError if the table was made for a different cosmology or model."""
+    with np.load(fname) as data:
+        if key is not None and str(data["key"]) != key:
+            raise ValueError(fname+" is for "+str(data["key"])+" not "+key)
+        table = ConcentrationTable.__new__(ConcentrationTable)
+        table.key = str(data["key"])
+        table.max_rel_error = float(data["max_rel_error"])
+        table.max_conc = float(data["max_conc"])
+        for name in ("logmass", "redshifts", "logconc"):
+            setattr(table, name, data[name])
+    table._setup()
+    return table
@@ -0,0 +1,75 @@
+"""Tests for the concentration-mass relations."""
+
+import numpy as np
+import concentration
+import halo_mass_function
+
+def test_broadcast():
+    """Check that evaluating on a (nu, z) grid matches evaluating one point at a time."""
+    overden = halo_mass_function.Overdensities(0)
+    nu = np.logspace(-1, 0.7, 7)
+    zz = np.array([0., 0.5, 2., 6., 20.])
+    for model in (concentration.LudlowConcentration(overden.Dofz), concentration.PradaConcentration(overden.omega_matter0)):
+        grid = model.concentration(nu[np.newaxis,:], zz[:,np.newaxis])
+        assert np.shape(grid) == (np.size(zz), np.size(nu))
+        for (i, z) in enumerate(zz):
+            for (j, n) in enumerate(nu):
+                assert np.allclose(grid[i,j], model.concentration(n, z), rtol=1e-12)
+        assert np.all(grid <= 1000)
+        if hasattr(model, "max_conc"):
+            #The maximum is exact
+            assert np.max(model.concentration(np.array([1e-3, 1e-2]), 0.)) == 1000
+        assert np.all(np.isfinite(grid))
+    #nu0 is clamped element-wise
+    ludlow = concentration.LudlowConcentration(overden.Dofz)
+    assert np.all(ludlow.nu0(zz) >= 0.5)
+    assert ludlow.nu0(zz)[0] > 0.5
+
+def test_redshift_cache():
+    """The cache of redshift dependent coefficients is bounded, and does not change the results."""
+    calls = []
+    def coefficients(z):
+        """Coefficients which count their evaluations"""
+        calls.append(z)
+        return (z, 2*z)
+    cache = {}
+    coeffs = concentration.cached_by_redshift(cache, [[1., 2.], [2., 1.]], coefficients, max_size=4)
+    assert np.array_equal(coeffs, [[[1., 2.], [2., 1.]], [[2., 4.], [4., 2.]]])
+    assert len(calls) == 2
+    concentration.cached_by_redshift(cache, [1., 2.], coefficients, max_size=4)
+    assert len(calls) == 2
+    #Adding more redshifts than fit empties the cache first
+    concentration.cached_by_redshift(cache, [3., 4., 5.], coefficients, max_size=4)
+    assert sorted(cache) == [3., 4., 5.]
+    #More distinct redshifts than max_size in one call are not stored
+    coeffs = concentration.cached_by_redshift(cache, np.arange(6.), coefficients, max_size=4)
+    assert np.array_equal(coeffs[1], 2*np.arange(6.))
+    assert len(cache) == 0
+    overden = halo_mass_function.Overdensities(0)
+    ludlow = concentration.LudlowConcentration(overden.Dofz)
+    ludlow.concentration(1., np.linspace(0, 20, 5000))
+    assert len(ludlow._zcache) <= 4096
+
+def test_table(tmp_path):
+    """Check the interpolation table against the models, and that it can be saved and loaded."""
+    overden = halo_mass_function.Overdensities(0)
+    def nu_func(logmass, zz):
+        """Peak height at arbitrary redshift"""
+        return 1.686/(overden.Dofz(zz)*overden.sigma_int(logmass))
+    logmass = np.linspace(2.5, 16, 37)
+    zz = np.array([0., 0.33, 1.7, 12.])
+    #The bounds on max_rel_error documented in ConcentrationTable
+    for (model, bound) in ((concentration.LudlowConcentration(overden.Dofz), 4e-3), (concentration.PradaConcentration(overden.omega_matter0), 1e-4)):
+        table = concentration.ConcentrationTable(model, nu_func, key="test")
+        assert table.max_rel_error < bound
+        exact = model.concentration(nu_func(logmass[:,np.newaxis], zz), zz)
+        assert np.allclose(table.concentration(logmass[:,np.newaxis], zz), exact, rtol=2e-4)
+    fname = str(tmp_path / "conc.npz")
+    table.save(fname)
+    loaded = concentration.load_table(fname, "test")
+    assert np.all(loaded.concentration(logmass, 0.5) == table.concentration(logmass, 0.5))
+    try:
+        concentration.load_table(fname, "other")
+        assert False
+    except ValueError:
+        pass
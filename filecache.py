@@ -0,0 +1,125 @@
+"""
+A small cache for arrays parsed from text files which do not change between reads.
+Entries are validated against the modification time of the file,
+and the least recently used entries are evicted once a memory budget is exceeded.
+"""
+
+import os.path
+import collections
+import threading
+import numpy as np
+
+def data_nbytes(data):
+    """Estimate the memory used by a parsed file: an array or a (nested) tuple of arrays."""
+    if isinstance(data, (tuple, list)):
+        return sum(data_nbytes(dd) for dd in data)
+    return np.asarray(data).nbytes
+
+def _freeze(data):
+    """Make cached arrays read-only, so a caller cannot silently modify the cached copy."""
+    if isinstance(data, (tuple, list)):
+        for dd in data:
+            _freeze(dd)
+    elif isinstance(data, np.ndarray):
+        data.flags.writeable = False
+    return data
+
+class FileCache(object):
+    """LRU cache of arrays loaded from files. Usage:
+        cache = FileCache(max_bytes=2**28)
+        table = cache.load(fname, np.loadtxt)
+    The loader is called as loader(fname) on a miss and its output is kept until the file
+    is modified (its mtime changes, forwards or backwards) or the entry is evicted. Returned arrays are shared and read-only.
+    With check_size=True, a change in the file size also invalidates the entry,
+    which catches files rewritten within the resolution of the modification time.
+    With check_mtime=False the file is never checked: use this for files which are never rewritten.
+    It is safe to use from several threads; files are parsed outside the lock.
+    If fname does not exist (because the loader reads it from somewhere else, eg, a binary store)
+    the data is not cached, as there is nothing to check it against."""
+    def __init__(self, max_bytes=256*1024**2, check_mtime=True, check_size=False):
+        #Memory budget in bytes. Zero means nothing is stored.
+        self.max_bytes = max_bytes
+        self.check_mtime = check_mtime
+        self.check_size = check_size
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        #Maps (fname, loader) -> ((mtime, size), data, nbytes), ordered from least to most recently used.
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def load(self, fname, loader=np.loadtxt):
+        """Get the data from fname, parsing the file with loader only if it is not cached or has changed."""
+        key = (fname, loader)
+        stamp = self._stamp(fname)
+        if stamp is None:
+            with self._lock:
+                self.misses += 1
+                if key in self._data:
+                    self._remove(key)
+            return _freeze(loader(fname))
+        with self._lock:
+            try:
+                (cstamp, data, _) = self._data[key]
+                #Any change of mtime, including to an older one (eg, a file replaced by a copy), is a change
+                if stamp == cstamp:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return data
+                self._remove(key)
+            except KeyError:
+                pass
+            self.misses += 1
+        data = _freeze(loader(fname))
+        nbytes = data_nbytes(data)
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                #Another thread may have loaded it meanwhile
+                if key in self._data:
+                    self._remove(key)
+                self._data[key] = (stamp, data, nbytes)
+                self.nbytes += nbytes
+                self._evict()
+        return data
+
+    def _stamp(self, fname):
+        """The (mtime, size) used to check whether a file has changed, or None if the file does not exist.
+        Either may be zero if it is not checked."""
+        if not self.check_mtime:
+            return (0., 0)
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        if self.check_size:
+            return (stat.st_mtime, stat.st_size)
+        return (stat.st_mtime, 0)
+
+    def _remove(self, key):
+        """Remove a single entry"""
+        (_, _, nbytes) = self._data.pop(key)
+        self.nbytes -= nbytes
+
+    def _evict(self):
+        """Drop least recently used entries until we are within the memory budget"""
+        while self.nbytes > self.max_bytes:
+            (_, (_, _, nbytes)) = self._data.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Return a dictionary of cache statistics"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._data), "nbytes": self.nbytes, "max_bytes": self.max_bytes}
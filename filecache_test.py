@@ -0,0 +1,102 @@
+"""Tests for the parsed file cache."""
+
+import os
+import concurrent.futures
+import numpy as np
+import filecache
+
+def test_lru_eviction(tmp_path):
+    """Check that the least recently used entries are dropped to stay within budget."""
+    fnames = []
+    for i in range(3):
+        fname = str(tmp_path / ("file%d.txt" % i))
+        np.savetxt(fname, i*np.ones(100))
+        fnames.append(fname)
+    #Room for two 800 byte arrays
+    cache = filecache.FileCache(max_bytes=2000)
+    assert np.all(cache.load(fnames[0]) == 0)
+    cache.load(fnames[1])
+    #Touch the first file so that the second is least recently used
+    cache.load(fnames[0])
+    cache.load(fnames[2])
+    assert len(cache) == 2
+    assert cache.nbytes <= 2000
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.load(fnames[0])
+    assert cache.hits == 2
+    cache.load(fnames[1])
+    assert cache.misses == 4
+    #Cached arrays are shared, so should not be writable
+    assert not cache.load(fnames[1]).flags.writeable
+
+def test_older_mtime(tmp_path):
+    """Check that a file replaced by one with an older mtime is reloaded."""
+    fname = str(tmp_path / "file.txt")
+    np.savetxt(fname, np.ones(10))
+    cache = filecache.FileCache(max_bytes=1000)
+    cache.load(fname)
+    mtime = os.path.getmtime(fname)
+    np.savetxt(fname, np.zeros(10))
+    os.utime(fname, (mtime-100, mtime-100))
+    assert np.all(cache.load(fname) == 0)
+    assert cache.misses == 2
+    cache.load(fname)
+    assert cache.hits == 1
+
+def test_size_validation(tmp_path):
+    """Check that a file rewritten with the same mtime but a different size is reloaded."""
+    fname = str(tmp_path / "file.txt")
+    np.savetxt(fname, np.ones(10))
+    cache = filecache.FileCache(max_bytes=100, check_size=True)
+    cache.load(fname)
+    mtime = os.path.getmtime(fname)
+    np.savetxt(fname, np.ones(12))
+    os.utime(fname, (mtime, mtime))
+    assert np.size(cache.load(fname)) == 12
+    assert cache.misses == 2
+    #No room for this as well as the 96 byte entry: it evicts the old entry
+    np.savetxt(str(tmp_path / "big.txt"), np.ones(10))
+    cache.load(str(tmp_path / "big.txt"))
+    assert cache.stats()["evictions"] == 1
+    cache.clear()
+    assert len(cache) == 0 and cache.evictions == 0
+
+def test_missing_file(tmp_path):
+    """Check that data for a file which does not exist is not cached, so it is seen once the file is made."""
+    fname = str(tmp_path / "file.txt")
+    def loader(fname):
+        """Read the file if it exists, otherwise an empty array"""
+        if os.path.exists(fname):
+            return np.loadtxt(fname)
+        return np.array([])
+    cache = filecache.FileCache(max_bytes=1000)
+    assert np.size(cache.load(fname, loader)) == 0
+    assert len(cache) == 0
+    np.savetxt(fname, np.ones(10))
+    assert np.size(cache.load(fname, loader)) == 10
+    assert cache.misses == 2
+    cache.load(fname, loader)
+    assert cache.hits == 1
+
+def test_threads(tmp_path):
+    """Check the counters and memory use stay consistent when many threads load and evict at once."""
+    fnames = []
+    for i in range(20):
+        fname = str(tmp_path / ("file%d.txt" % i))
+        np.savetxt(fname, i*np.ones(10+i))
+        fnames.append(fname)
+    #Room for a few entries, so there are many evictions
+    cache = filecache.FileCache(max_bytes=1000)
+    rng = np.random.RandomState(7)
+    order = [fnames[i] for i in rng.randint(0, 20, 2000)]
+    def load(fname):
+        """Load a file and check the contents"""
+        data = cache.load(fname)
+        return np.size(data) == 10+fnames.index(fname) and np.all(data == fnames.index(fname))
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(load, order))
+    assert cache.hits + cache.misses == len(order)
+    assert cache.evictions > 0
+    assert cache.nbytes == sum(nbytes for (_, _, nbytes) in cache._data.values())
+    assert cache.nbytes <= cache.max_bytes
+    assert len(cache) == len(cache._data) <= 20
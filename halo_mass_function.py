@@ -24,6 +24,9 @@ class HaloMassFunction(object):
     mass_function: returns dn / dln sigma which is what is commonly referred to as the mass function.
     Other functions are various choices of mass function
     """
+    #Names of all the available mass functions
+    mass_functions = ("press_schechter", "jenkins", "sheth_tormen", "warren", "tinker_200", "tinker_300", "tinker_alt", "watson_FOF")
+
     def __init__(self, redshift, omega_m=0.32, omega_b=0.045, omega_l=0.68, hubble=0.67, ns=0.96, sigma8=0.83, mass_function=None, log_mass_lim=(1, 20) ,use_pbh=False):
         #Sigma tables
         self.overden = Overdensities(redshift,omega_m, omega_b,omega_l,hubble, ns,sigma8,log_mass_lim=log_mass_lim,use_pbh=use_pbh)
@@ -32,6 +35,8 @@ class HaloMassFunction(object):
         else:
             self.mass_function = mass_function.__get__(self)
         self.delta_c0 = 1.69  # critical density for turnaround (Press-Schechter)
+        #(mass function, CumulativeAbundance table)
+        self._abundance = None
 
     def dndm(self, mass):
         """Returns the halo mass function dn/dM in units of h^4 M_sun^-1 Mpc^-3
@@ -47,6 +52,26 @@ class HaloMassFunction(object):
         dndM = - dlogsigma*mass_func/mass*rhom
         return dndM
 
+    def dndm_models(self, mass, models=None):
+        """Returns dn/dM in units of h^4 M_sun^-1 Mpc^-3 for several mass functions at once,
+        as an array of shape (len(models), len(mass)). Requires mass in units of M_sun /h.
+        models is a list of mass functions, either names from mass_functions or functions of (self, sigma).
+        Defaults to all of mass_functions. sigma and d log sigma/dM are computed only once."""
+        if models is None:
+            models = self.mass_functions
+        rhom = self.overden.rhocrit(0) * self.overden.omega_matter0
+        sigma = self.overden.sigmaof_M_z(mass)
+        dlogsigma = self.overden.log_sigmaof_M(mass)/mass
+        mass_funcs = np.array([self._get_mass_function(model)(sigma) for model in models])
+        #We have dn / dM = - d ln sigma /dM rho_0/M f(sigma)
+        return - dlogsigma*mass_funcs/mass*rhom
+
+    def _get_mass_function(self, model):
+        """Get a mass function, bound to this object, from its name or the function."""
+        if isinstance(model, str):
+            return getattr(self, model)
+        return model.__get__(self)
+
     def dndm_z(self, mass, zz):
         """Returns the halo mass function dn/dM in units of h^4 M_sun^-1 Mpc^-3
         Requires mass in units of M_sun /h """
@@ -62,6 +87,46 @@ class HaloMassFunction(object):
         dndM = - dlogsigma*mass_func/mass*rhom
         return dndM
 
+    def dndm_grid(self, mass, zz, cumulative=False):
+        """Returns the halo mass function dn/dM on a grid of mass and redshift,
+        as an array of shape (len(zz), len(mass)), in units of h^4 M_sun^-1 Mpc^-3.
+        Requires mass in units of M_sun /h.
+        The z=0 sigma tables are reused, rescaled by the growth function.
+        If cumulative is True, also returns n(>M, z), the number density of halos with mass between M
+        and the largest mass in the grid, in h^3 Mpc^-3. This is integrated with the trapezium rule in log M,
+        so the mass grid should be dense and sorted."""
+        mass = np.asarray(mass, dtype=np.float64)
+        zz = np.asarray(zz, dtype=np.float64)
+        rhom = self.overden.rhocrit(0) * self.overden.omega_matter0
+        growth = self.overden.Dofz(np.ravel(zz))
+        sigma = growth[:,np.newaxis]*self.overden.sigmaof_M(mass)[np.newaxis,:]
+        dlogsigma = self.overden.log_sigmaof_M(mass)/mass
+        #We have dn / dM = - d ln sigma /dM rho_0/M f(sigma)
+        dndM = - dlogsigma*self.mass_function(sigma)/mass*rhom
+        if not cumulative:
+            return dndM
+        #n(>M) = int dn/dM M dlnM, summed down from the largest mass
+        dndlnm = dndM*mass
+        trapz = 0.5*(dndlnm[:,1:]+dndlnm[:,:-1])*np.diff(np.log(mass))
+        ngtm = np.zeros_like(dndM)
+        ngtm[:,:-1] = np.cumsum(trapz[:,::-1], axis=1)[:,::-1]
+        return (dndM, ngtm)
+
+    def abundance(self):
+        """The CumulativeAbundance table for the current mass function at the redshift of the sigma tables.
+        Built when first needed and again if mass_function is changed."""
+        if self._abundance is None or self._abundance[0] != self.mass_function:
+            self._abundance = (self.mass_function, CumulativeAbundance(self))
+        return self._abundance[1]
+
+    def n_above(self, mass):
+        """Number density of halos with mass above mass, in h^3 Mpc^-3. Mass in M_sun/h. Accepts arrays."""
+        return self.abundance().n_above(mass)
+
+    def mass_above(self, nhalo):
+        """Inverse of n_above, for abundance matching: the mass in M_sun/h above which the number density of halos is nhalo."""
+        return self.abundance().mass_above(nhalo)
+
     def press_schechter(self, sigma):
         """Press-Schechter (This form from Jenkins et al. 2001, MNRAS 321, 372-384, eqtn. 5)"""
         nu = self.delta_c0 / sigma
@@ -121,6 +186,53 @@ class HaloMassFunction(object):
         c = 1.210
         return A*( np.power(b / sigma, 1.0*a) + 1)*np.exp(-1.0*c / sigma / sigma )
 
+class CumulativeAbundance(object):
+    """Table of the cumulative halo abundance n(>M), for a HaloMassFunction at the redshift of its sigma tables.
+    dn/dM is integrated once, on a grid of npoints masses evenly spaced in log M over the mass range of the sigma tables,
+    taking dn/dlnM to be exponential in ln M between grid points.
+    Lookups and the inverse use cubic splines of log n against log M.
+    With the default 4000 points over 19 decades of mass at z=0, n(>M) is accurate to 10^-4 where n > 10^-9 h^3 Mpc^-3
+    and to 10^-3 where n > 10^-25 h^3 Mpc^-3. The inverse, M(n), is accurate to 10^-4 over the whole table.
+    n(>M) is taken to be zero above the largest tabulated mass."""
+    def __init__(self, hmf, npoints=4000):
+        overden = hmf.overden
+        self.logmass = np.linspace(overden.log_mass_min, overden.log_mass_max, npoints)
+        mass = 10**self.logmass
+        dndlnm = hmf.dndm(mass)*mass
+        #Integrate each interval assuming dn/dlnM is exponential in ln M,
+        #which is exact in the exponential tail of the mass function, then sum down from the largest mass.
+        (lower, upper) = (dndlnm[:-1], dndlnm[1:])
+        dlnm = np.diff(np.log(mass))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            interval = dlnm*(upper-lower)/np.log(upper/lower)
+        #Where the function is flat or zero, use the trapezium rule
+        trapz = 0.5*(upper+lower)*dlnm
+        interval = np.where(np.isfinite(interval)*(np.abs(upper-lower) > 1e-8*lower), interval, trapz)
+        self.nhalo = np.zeros(npoints)
+        self.nhalo[:-1] = np.cumsum(interval[::-1])[::-1]
+        #Interpolate in log space, where the mass function is smooth.
+        #At the highest masses dn/dM underflows to zero, so these are excluded.
+        valid = np.where(self.nhalo > 0)
+        self._logm = self.logmass[valid]
+        self._logn = np.log10(self.nhalo[valid])
+        self._n_int = scipy.interpolate.InterpolatedUnivariateSpline(self._logm, self._logn)
+        self._m_int = scipy.interpolate.InterpolatedUnivariateSpline(self._logn[::-1], self._logm[::-1])
+
+    def n_above(self, mass):
+        """Number density of halos above mass, in h^3 Mpc^-3. Mass in M_sun/h. Accepts arrays.
+        Returns NaN for masses below the table."""
+        logm = np.log10(mass)
+        nhalo = 10**self._n_int(logm)
+        nhalo = np.where(logm > self._logm[-1], 0., nhalo)
+        return np.where(logm < self._logm[0], np.nan, nhalo)
+
+    def mass_above(self, nhalo):
+        """Mass in M_sun/h above which the number density of halos is nhalo. Accepts arrays.
+        Returns NaN if nhalo is outside the range of the table."""
+        logn = np.log10(nhalo)
+        mass = 10**self._m_int(logn)
+        return np.where((logn < self._logn[-1])+(logn > self._logn[0]), np.nan, mass)
+
 class Overdensities(object):
     """Module for calculating the linear theory overdensities.
     Main result obtained from sigmaof_M_z"""
@@ -301,22 +413,31 @@ class Overdensities(object):
     def Dofz(self, redshift):
         """
         /* Growth function */
+        Interpolated from a table, so it is cheap to call in loops. Accepts arrays.
         """
+        return self.growth(redshift)
 
+    def Dofz_exact(self, redshift):
+        """
+        /* Growth function, from the fitting formula */
+        """
         thisDofz = self.gofz(redshift) / self.gofz(0.0) / (1.0+redshift)
         return thisDofz
 
+    @property
+    def growth(self):
+        """The growth factor table for this cosmology, shared between all instances with the same cosmology."""
+        return growth_factor(self.omega_matter0, self.omega_lambda0)
 
     def gofz(self, redshift):
         """
         /* g(z) - I don't think this has any other name*/
         """
-
-        thisgofz = 2.5 * self.omega_matter_of_z(redshift) / \
-        ( math.pow( self.omega_matter_of_z(redshift), 4.0/7.0 ) - \
-          self.omega_lambda_of_z(redshift) + \
-          ( (1.0 + self.omega_matter_of_z(redshift) / 2.0) * \
-          (1.0 + self.omega_lambda_of_z(redshift) / 70.0) ))
+        omz = self.omega_matter_of_z(redshift)
+        olz = self.omega_lambda_of_z(redshift)
+        thisgofz = 2.5 * omz / \
+        ( np.power( omz, 4.0/7.0 ) - olz + \
+          ( (1.0 + omz / 2.0) * (1.0 + olz / 70.0) ))
 
         return thisgofz
 
@@ -326,8 +447,8 @@ class Overdensities(object):
         /* Omega matter as a function of redshift */
         """
 
-        thisomofz = self.omega_matter0 * math.pow( 1.0+redshift, 3.0) / \
-            math.pow( self.Eofz(redshift), 2.0 )
+        thisomofz = self.omega_matter0 * np.power( 1.0+redshift, 3.0) / \
+            np.power( self.Eofz(redshift), 2.0 )
 
         return thisomofz
 
@@ -336,7 +457,7 @@ class Overdensities(object):
         /* Omega lambda as a function of redshift */
         """
 
-        thisolofz = self.omega_lambda0 / math.pow( self.Eofz(redshift), 2.0 )
+        thisolofz = self.omega_lambda0 / np.power( self.Eofz(redshift), 2.0 )
 
         return thisolofz
 
@@ -344,12 +465,66 @@ class Overdensities(object):
         """
         /* E(z) - I don't think this has any other name */
         """
-        thiseofz = math.sqrt( self.omega_lambda0 \
-            + (1.0 - self.omega_lambda0 - self.omega_matter0)*math.pow( 1.0+redshift, 2.0) \
-            + self.omega_matter0 * math.pow( 1.0+redshift, 3.0)  )
+        thiseofz = np.sqrt( self.omega_lambda0 \
+            + (1.0 - self.omega_lambda0 - self.omega_matter0)*np.power( 1.0+redshift, 2.0) \
+            + self.omega_matter0 * np.power( 1.0+redshift, 3.0)  )
 
         return thiseofz
 
+class GrowthFactor(object):
+    """A table of the growth function D(z) for one cosmology, as a spline of log D in log(1+z).
+    Computing D(z) from the fitting formula is slow because of all the function calls.
+    The table reproduces the fitting formula to better than 10^-9 for 0 <= z <= zmax.
+    Outside that range the fitting formula is used.
+    Single redshifts, as in integrands, use a cubic Hermite interpolation in pure python,
+    avoiding the overhead of a call into numpy or scipy."""
+    def __init__(self, omega_matter0, omega_lambda0, zmax=3000, npoints=2000):
+        self.zmax = zmax
+        #Only needs the background cosmology
+        self.cosmo = Overdensities.__new__(Overdensities)
+        self.cosmo.omega_matter0 = omega_matter0
+        self.cosmo.omega_lambda0 = omega_lambda0
+        logzp1 = np.linspace(0, np.log1p(zmax), npoints)
+        self.logD = scipy.interpolate.InterpolatedUnivariateSpline(logzp1, np.log(self.cosmo.Dofz_exact(np.expm1(logzp1))))
+        #Tables for the scalar path: values and derivatives at the nodes, as python floats.
+        self._dx = logzp1[1]
+        self._nodes = self.logD(logzp1).tolist()
+        self._derivs = (self.logD.derivative()(logzp1)*self._dx).tolist()
+
+    def _scalar(self, redshift):
+        """D(z) for a single redshift 0 <= z <= zmax"""
+        xx = math.log1p(redshift)/self._dx
+        i = min(int(xx), len(self._nodes)-2)
+        t = xx - i
+        #Cubic Hermite basis
+        t2 = t*t
+        t3 = t2*t
+        logd = (2*t3-3*t2+1)*self._nodes[i] + (t3-2*t2+t)*self._derivs[i] + (-2*t3+3*t2)*self._nodes[i+1] + (t3-t2)*self._derivs[i+1]
+        return math.exp(logd)
+
+    def __call__(self, redshift):
+        """D(z). Accepts arrays."""
+        if isinstance(redshift, (float, int)) and 0 <= redshift <= self.zmax:
+            return self._scalar(redshift)
+        zz = np.asarray(redshift, dtype=np.float64)
+        growth = np.exp(self.logD(np.log1p(zz)))
+        outside = (zz > self.zmax) + (zz < 0)
+        if np.any(outside):
+            growth = np.where(outside, self.cosmo.Dofz_exact(zz), growth)
+        if np.ndim(growth) == 0:
+            return float(growth)
+        return growth
+
+#Growth factor tables: (omega_matter0, omega_lambda0) -> GrowthFactor
+_growth_tables = {}
+
+def growth_factor(omega_matter0, omega_lambda0):
+    """Get the (cached) GrowthFactor table for a cosmology"""
+    key = (omega_matter0, omega_lambda0)
+    if key not in _growth_tables:
+        _growth_tables[key] = GrowthFactor(omega_matter0, omega_lambda0)
+    return _growth_tables[key]
+
 
 class TransferFunction(object):
     """
@@ -0,0 +1,46 @@
+"""Tests for the halo mass function module."""
+
+import numpy as np
+import scipy.integrate as integ
+import halo_mass_function
+
+def test_growth_table():
+    """Check the tabulated growth function against the fitting formula, for scalars and arrays."""
+    overden = halo_mass_function.Overdensities(0)
+    zz = np.concatenate([[0.], np.logspace(-3, np.log10(3000), 300), [4000.]])
+    exact = np.array([overden.Dofz_exact(z) for z in zz])
+    assert np.allclose(overden.Dofz(zz), exact, rtol=1e-9, atol=0)
+    assert np.allclose([overden.Dofz(z) for z in zz], exact, rtol=1e-9, atol=0)
+    assert overden.Dofz(0) == 1.
+    #Array and scalar versions of the background functions agree
+    assert np.allclose(overden.Eofz(zz), [overden.Eofz(z) for z in zz])
+    #The table is shared between instances with the same cosmology
+    assert halo_mass_function.Overdensities(1).growth is overden.growth
+
+def test_dndm_grid():
+    """Check the mass function grid against dndm_z at each redshift, and the cumulative abundance."""
+    hmf = halo_mass_function.HaloMassFunction(0)
+    mass = np.logspace(8, 15, 400)
+    zz = np.linspace(0, 6, 13)
+    (dndm, ngtm) = hmf.dndm_grid(mass, zz, cumulative=True)
+    assert np.shape(dndm) == (np.size(zz), np.size(mass))
+    for (i, z) in enumerate(zz):
+        assert np.allclose(dndm[i], hmf.dndm_z(mass, z), rtol=1e-12)
+    assert np.allclose(dndm[0], hmf.dndm(mass), rtol=1e-9)
+    #Cumulative abundance is decreasing in mass and zero at the top.
+    assert np.all(np.diff(ngtm, axis=1) <= 0)
+    assert np.all(ngtm[:,-1] == 0)
+    assert np.isclose(ngtm[0,0], np.trapz(dndm[0]*mass, np.log(mass)), rtol=1e-12)
+
+def test_abundance_table():
+    """Check the cumulative abundance table against direct integration, and its inverse."""
+    hmf = halo_mass_function.HaloMassFunction(0)
+    mass = np.logspace(3, 15, 7)
+    direct = [integ.quad(lambda lnm: hmf.dndm(np.exp(lnm))*np.exp(lnm), np.log(mm), np.log(1e20), epsrel=1e-10, limit=500)[0] for mm in mass]
+    assert np.allclose(hmf.n_above(mass), direct, rtol=1e-4)
+    assert np.allclose(hmf.mass_above(direct), mass, rtol=1e-4)
+    assert np.isnan(hmf.mass_above(1e20))
+    #Changing the mass function rebuilds the table
+    hmf.mass_function = hmf.press_schechter
+    nps = integ.quad(lambda lnm: hmf.dndm(np.exp(lnm))*np.exp(lnm), np.log(1e12), np.log(1e20), epsrel=1e-10, limit=500)[0]
+    assert np.isclose(hmf.n_above(1e12), nps, rtol=1e-4)
@@ -17,36 +17,165 @@
 
 
 import math
+import os.path
 import numpy as np
 import scipy.special
 import matplotlib
 import matplotlib.pyplot as plt
-import pint
 import concentration
 import halo_mass_function as hm
+import unitregistry
 matplotlib.use('PDF')
 
-#This is a global so that the decorator checking works.
-ureg_chk=pint.UnitRegistry()
-
 def ggconc(conc):
     """Utility function that drops out of the NFW profile. Eq. 10 of the attached pdf."""
     return np.log(1+conc)-conc/(1+conc)
 
+#The functions below are the unitless parts of the merger rate, shared by the halo classes,
+#which use pint quantities, and MergerRateSurface, which uses plain arrays.
+def merger_prefactor(gravity, light):
+    """Prefactor of the merger cross-section, (4 pi)^2 (85 pi/3)^(2/7) G^2/c^3.
+    G and c may be pint quantities or numbers."""
+    return (4*math.pi)**2*(85*math.pi/3)**(2./7)*gravity**2/light**3
+
+def vdisp_factor(conc, dmax):
+    """Ratio of the 1D velocity dispersion, v_max/sqrt(2), to the virial velocity of an NFW halo."""
+    return np.sqrt(conc/dmax*ggconc(dmax)/ggconc(conc))/math.sqrt(2)
+
+def velocity_average(sigma, vvir):
+    """The average of v^(-11/7) over the relative velocities, times v, in units where c = 1.
+    The merger cross-section is merger_prefactor times this. Eq. 11 of the PDF.
+    Assumes that the relative velocities are distributed like a Maxwell-Boltzmann with a temperature
+    of the velocity dispersion sigma and a maximum value of the virial velocity vvir.
+    sigma and vvir are velocities divided by the speed of light, as arrays."""
+    #Now we have a mathematica integral in terms of gamma functions.
+    #P[v_, sigma_, vvir_] := Exp[-v^2/sigma^2] - Exp[-vvir^2/sigma^2]
+    #FunctionExpand[Integrate[v^(3/7)*P[v, sigma, Vvir], {v, 0, Vvir}]]
+    #Piece from the constant exponential cutoff
+    cutoff = -(7/10)*np.exp(-(vvir**2/sigma**2)) * vvir**(10/7)
+    #Piece from the gamma integral: note that mathematica's incomplete gamma function
+    #is not quite the same as scipy's: scipy is (Gamma[a] - Gamma[a,z])/Gamma[a]
+    gammaint = sigma**(10/7)*scipy.special.gammainc(5/7,vvir**2/sigma**2)* scipy.special.gamma(5/7)/2
+    #We also need to normalise the probability function for v:
+    #Integrate[4*Pi*v^2*P[v, sigma, Vvir], {v, 0, Vvir}]
+    probnorm = math.pi**(3/2)*sigma**3*scipy.special.erf(vvir/sigma)
+    assert np.all(probnorm > 0)
+    return (gammaint + cutoff)/probnorm
+
+def nfw_rho0_factor(conc):
+    """Central density of an NFW halo, in units of M / R_s^3."""
+    return 1/(4 * math.pi * ggconc(conc))
+
+def nfw_rate_factor(conc):
+    """Merger rate of an NFW halo, in units of cross-section * M^2 / R_s^3."""
+    return 2 * math.pi * nfw_rho0_factor(conc)**2 /3 * (1 - 1/(1+conc)**3)
+
+def einasto_rho0_factor(conc, alpha):
+    """Central density of an Einasto halo, in units of M / R_s^3."""
+    gamma = scipy.special.gammainc(3/alpha, 2/alpha * conc**alpha) * scipy.special.gamma(3/alpha)
+    prefac = 4 * math.pi * np.exp(2/alpha)/ alpha *(alpha/2)**(3/alpha)
+    return 1 / gamma / prefac
+
+def einasto_rate_factor(conc, alpha):
+    """Merger rate of an Einasto halo, in units of cross-section * M^2 / R_s^3."""
+    d2 = np.exp(4/alpha) /alpha * (alpha/4)**(3/alpha) * scipy.special.gammainc(3/alpha, 4/alpha * conc**alpha) * scipy.special.gamma(3/alpha)
+    return 2 * math.pi * d2 * einasto_rho0_factor(conc, alpha)**2
+
+#Nodes and weights of the 15 point Gauss-Kronrod rule on [-1, 1] and of the 7 point Gauss rule it extends.
+#Non-negative nodes only: the rules are symmetric. The Gauss nodes are the odd entries. From QUADPACK.
+_KRONROD_NODES = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                           0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                           0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                           0.207784955007898467600689403773245, 0.])
+_KRONROD_WEIGHTS = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                             0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                             0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                             0.204432940075298892414161999234649, 0.209482141084727828012999174891714])
+_GAUSS_WEIGHTS = np.array([0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+                           0.381830050505118944950369775488975, 0.417959183673469387755102040816327])
+
+def _kronrod_rule():
+    """The 15 point Kronrod nodes and weights, and the weights of the 7 point Gauss rule on the same nodes."""
+    nodes = np.concatenate([-_KRONROD_NODES[:-1], _KRONROD_NODES[::-1]])
+    kweights = np.concatenate([_KRONROD_WEIGHTS[:-1], _KRONROD_WEIGHTS[::-1]])
+    gweights = np.zeros(8)
+    gweights[1::2] = _GAUSS_WEIGHTS
+    gweights = np.concatenate([gweights[:-1], gweights[::-1]])
+    return (nodes, kweights, gweights)
+
+def log_mass_integral(func, logmin, logmax, tol=1e-4, panel=3., min_width=1e-3, atol=0.):
+    """Integrate func(log10 M) d ln M from logmin to logmax with adaptive Gauss-Kronrod quadrature.
+    func takes an array of log10 M and returns an array whose last axis is the mass, so that several
+    integrands (eg, mass functions) can be done at once.
+    The range is split into panels of width panel decades, aligned to multiples of panel, so that integrals
+    with different limits evaluate func at the same masses and a cache of func is effective.
+    End panels narrower than half a panel are merged into their neighbours.
+    Each panel is integrated with the 15 point Kronrod rule, and its error estimated by the difference
+    to the 7 point Gauss rule on the same nodes. Panels with a large share of the error are bisected
+    until the summed error is less than max(tol times the total integral, atol) for every integrand.
+    An integrand which is zero everywhere is thus accepted at once. Panels narrower than min_width decades
+    are not bisected. The error estimate is conservative: the actual error is usually much smaller than tol.
+    Returns an array of the integrals, with the shape of func without its last axis."""
+    if logmax < logmin:
+        return -log_mass_integral(func, logmax, logmin, tol=tol, panel=panel, min_width=min_width, atol=atol)
+    if logmax == logmin:
+        #Empty range: evaluate once to find the shape of the integral
+        return np.zeros(np.shape(func(np.array([logmin])))[:-1])
+    edges = np.arange(np.ceil(logmin/panel)*panel, logmax, panel)
+    edges = np.unique(np.concatenate([[logmin], edges, [logmax]]))
+    #Merge end panels narrower than half a panel into their neighbours
+    if np.size(edges) > 3 and edges[1] - edges[0] < panel/2.:
+        edges = np.delete(edges, 1)
+    if np.size(edges) > 3 and edges[-1] - edges[-2] < panel/2.:
+        edges = np.delete(edges, -2)
+    pending = list(zip(edges[:-1], edges[1:]))
+    (nodes, kweights, gweights) = _kronrod_rule()
+    npts = np.size(nodes)
+    #Panels done so far, with their integrals and error estimates
+    panels = []
+    integrals = []
+    errors = []
+    while pending:
+        #Evaluate all the new panels at once
+        (aa, bb) = np.array(pending).T
+        half = (bb-aa)/2.
+        mid = (bb+aa)/2.
+        values = func((mid[:,np.newaxis] + half[:,np.newaxis]*nodes).ravel())
+        values = values.reshape(np.shape(values)[:-1]+(-1, npts))
+        #d ln M = ln(10) d log10 M
+        high = np.sum(values*kweights, axis=-1)*half*math.log(10)
+        low = np.sum(values*gweights, axis=-1)*half*math.log(10)
+        panels += pending
+        integrals += list(np.moveaxis(high, -1, 0))
+        errors += list(np.moveaxis(np.abs(high-low), -1, 0))
+        budget = np.maximum(tol*np.abs(np.sum(integrals, axis=0)), atol)
+        if np.all(np.sum(errors, axis=0) <= budget):
+            break
+        #Share of the error budget used by each panel, in the worst integrand
+        share = np.array(errors)/np.where(budget > 0, budget, 1.)
+        share[np.where((np.array(errors) > 0)*(budget == 0))] = np.inf
+        share = np.max(share.reshape(len(panels), -1), axis=-1)
+        #Bisect the panels using more than their share
+        bisect = [i for i in range(len(panels)) if share[i] > 1./len(panels) and panels[i][1] - panels[i][0] >= min_width]
+        pending = []
+        for i in bisect:
+            (a, b) = panels[i]
+            pending += [(a, (a+b)/2.), ((a+b)/2., b)]
+        panels = [panels[i] for i in range(len(panels)) if i not in bisect]
+        integrals = [integrals[i] for i in range(len(integrals)) if i not in bisect]
+        errors = [errors[i] for i in range(len(errors)) if i not in bisect]
+    return np.sum(integrals, axis=0)
+
 class NFWHalo(hm.HaloMassFunction):
-    """Class to add the ability to compute concentrations to the halo mass function"""
-    def __init__(self,*args,conc_model="ludlow", conc_value=1.,hubble=0.67, **kwargs):
-        self.ureg=pint.UnitRegistry()
-        self.ureg.define("Msolar = 1.98855*10**30 * kilogram")
-        #Mpc newton's constant and light speed are already defined.
-        #Hubble constant and related objects!
-        #The try except is because the method names change between pint 0.6 and pint 0.8
-        try:
-            self.ureg.define(pint.unit.UnitDefinition('hub', '', (),pint.unit.ScaleConverter(hubble)))
-        except AttributeError:
-            self.ureg.define(pint.definitions.UnitDefinition('hub', '', (),pint.converters.ScaleConverter(hubble)))
-        self.ureg.define("Msolarh = Msolar / hub")
-        self.ureg.define("Mpch = Mpc / hub")
+    """Class to add the ability to compute concentrations to the halo mass function.
+    If conc_table is True, concentrations are interpolated from a concentration.ConcentrationTable,
+    built when first needed and again if conc_model is changed. If conc_table is a file name,
+    the table is loaded from it if it matches the cosmology and model, and otherwise built and saved to it."""
+    def __init__(self,*args,conc_model="ludlow", conc_value=1.,hubble=0.67, conc_table=None, **kwargs):
+        #Shared between all halos: building a registry is slow.
+        self.ureg = unitregistry.get_registry()
+        #Conversions to Msun/h and Mpc/h for this hubble constant.
+        self.hubble_units = unitregistry.HubbleUnits(hubble)
         #Factor of R_s at which the maximum circular velocity of the halo is reached.
         self.dmax = 2.1626
         super().__init__(*args, **kwargs)
@@ -56,20 +185,59 @@ class NFWHalo(hm.HaloMassFunction):
             self.conc_model = concentration.PradaConcentration(self.overden.omega_matter0)
         else:
             self.conc_model = concentration.ConstantConcentration(conc_value)
+        self.conc_table = conc_table
+        self._conc_table = None
+        #Cached merger rate integrands: key -> {log10 M : value}
+        self._integrand_cache = {}
+
+    def mass_h(self, mass):
+        """Convert a mass in Msun (a plain number or a pint quantity) to a number in Msun/h"""
+        return self.hubble_units.msolarh(mass)
 
     def get_nu(self,mass):
         """Get nu, delta_c/sigma"""
-        if self.ureg.get_dimensionality('') == self.ureg.get_dimensionality(mass):
-            mass = mass * self.ureg.Msolar
-        return 1.686/self.overden.sigmaof_M_z(mass.to(self.ureg.Msolarh).magnitude)
+        return 1.686/self.overden.sigmaof_M_z(self.mass_h(mass))
+
+    def nu_of_z(self, logmass, zz):
+        """nu, delta_c/sigma, for log10(mass) in Msun/h at arbitrary redshifts. Arrays are broadcast."""
+        dofz = self.overden.Dofz(zz)
+        return 1.686/(dofz*self.overden.sigma_int(logmass))
 
     def concentration(self,mass):
         """Compute the concentration for a halo mass in Msun"""
 #         assert self.ureg.get_dimensionality('[mass]') == self.ureg.get_dimensionality(mass)
-        nu = self.get_nu(mass)
         zz = self.overden.redshift
+        if self.conc_table:
+            return self.get_conc_table().concentration(np.log10(self.mass_h(mass)), zz)
+        nu = self.get_nu(mass)
         return self.conc_model.concentration(nu, zz)
 
+    def _conc_table_key(self):
+        """String identifying the cosmology and concentration model, for checking saved tables."""
+        over = self.overden
+        params = (over.omega_matter0, over.omega_baryon0, over.omega_lambda0, over.hubble0, over.ns, over.Norm,
+                  over.log_mass_min, over.log_mass_max, getattr(self.conc_model, "conc", None))
+        return type(self.conc_model).__name__+" "+repr(params)
+
+    def get_conc_table(self):
+        """Get the concentration table for the current conc_model, building or loading it if needed."""
+        if self._conc_table is not None and self._conc_table[0] is self.conc_model:
+            return self._conc_table[1]
+        key = self._conc_table_key()
+        table = None
+        if isinstance(self.conc_table, str) and os.path.exists(self.conc_table):
+            try:
+                table = concentration.load_table(self.conc_table, key)
+            except ValueError:
+                table = None
+        if table is None or self.overden.redshift > table.redshifts[-1]:
+            redshifts = np.expm1(np.linspace(0, np.log(1+max(20., self.overden.redshift)), 128))
+            table = concentration.ConcentrationTable(self.conc_model, self.nu_of_z, (self.overden.log_mass_min, self.overden.log_mass_max), redshifts, key=key)
+            if isinstance(self.conc_table, str):
+                table.save(self.conc_table)
+        self._conc_table = (self.conc_model, table)
+        return table
+
     def rhocrit(self):
         """Critical density at redshift of the snapshot. Units are kg m^-3."""
         #Newtons constant in units of m^3 kg^-1 s^-2
@@ -108,7 +276,7 @@ class NFWHalo(hm.HaloMassFunction):
     def vel_disp(self, mass):
         """The 1D velocity dispersion of a halo in m/s, as a function of the virial radius. Equal to v_max/sqrt(2)"""
         conc = self.concentration(mass)
-        v1d = self.virialvel(mass)/math.sqrt(2)*np.sqrt(conc/self.dmax*ggconc(self.dmax)/ggconc(conc))
+        v1d = self.virialvel(mass)*vdisp_factor(conc, self.dmax)
         return v1d
 
     def cross_section(self, mass):
@@ -118,24 +286,10 @@ class NFWHalo(hm.HaloMassFunction):
         Since MPBH drops out, set it to one here.
         Returns cross-section in m^3/s kg^-2"""
 #         assert self.ureg.get_dimensionality('[mass]') == self.ureg.get_dimensionality(mass)
-        prefac = ((4*math.pi)**2*(85*math.pi/3)**(2./7)*self.ureg.newtonian_constant_of_gravitation**2/self.ureg.speed_of_light**3).to_base_units()
-        sigma = (self.vel_disp(mass)/self.ureg.speed_of_light).to_base_units()
-        vvir = (self.virialvel(mass)/self.ureg.speed_of_light).to_base_units()
-#         assert self.ureg.get_dimensionality('') == self.ureg.get_dimensionality(sigma)
-        #Now we have a mathematica integral in terms of gamma functions.
-        #P[v_, sigma_, vvir_] := Exp[-v^2/sigma^2] - Exp[-vvir^2/sigma^2]
-        #FunctionExpand[Integrate[v^(3/7)*P[v, sigma, Vvir], {v, 0, Vvir}]]
-        #Piece from the constant exponential cutoff
-        cutoff = -(7/10)*np.exp(-(vvir**2/sigma**2)) * vvir**(10/7)
-        #Piece from the gamma integral: note that mathematica's incomplete gamma function
-        #is not quite the same as scipy's: scipy is (Gamma[a] - Gamma[a,z])/Gamma[a]
-        gammaint = sigma**(10/7)*scipy.special.gammainc(5/7,vvir**2/sigma**2)* scipy.special.gamma(5/7)/2
-        #We also need to normalise the probability function for v:
-        #Integrate[4*Pi*v^2*P[v, sigma, Vvir], {v, 0, Vvir}]
-        probnorm = math.pi**(3/2)*sigma**3*scipy.special.erf(vvir/sigma) - 2*math.pi/3*np.exp(-(vvir**2/sigma**2))*(3*sigma**2*vvir + 2*vvir**3) *0
-        assert np.all(probnorm.magnitude > 0)
-        cross_section = prefac*(gammaint + cutoff)/probnorm
-#         assert self.ureg.get_dimensionality('[length]**3 [time]**(-1) [mass]**(-2)') == self.ureg.get_dimensionality(cross_section)
+        prefac = merger_prefactor(self.ureg.newtonian_constant_of_gravitation, self.ureg.speed_of_light).to_base_units()
+        sigma = (self.vel_disp(mass)/self.ureg.speed_of_light).to('').magnitude
+        vvir = (self.virialvel(mass)/self.ureg.speed_of_light).to('').magnitude
+        cross_section = prefac*velocity_average(sigma, vvir)
         return cross_section
 
     def profile(self, radius, mass):
@@ -155,18 +309,25 @@ class NFWHalo(hm.HaloMassFunction):
         crosssec = self.cross_section(mass)
         #In m
         Rs = self.Rs(mass)
-        rho0 = self.rho0(mass)
-        rate = crosssec * 2 * math.pi * rho0**2 * Rs**3 /3 * (1 - 1/(1+conc)**3)
+        rate = crosssec * mass**2 / Rs**3 * self.rate_factor(conc)
         return rate.to('year**(-1)')
 
     def rho0(self, mass):
         """Central density for the NFW halo in units of M_sun Mpc^-3"""
 #         assert self.ureg.get_dimensionality('[mass]') == self.ureg.get_dimensionality(mass)
         conc = self.concentration(mass)
-        return mass / ( 4 * math.pi * self.Rs(mass)**3 * ggconc(conc))
+        return mass / self.Rs(mass)**3 * self.rho0_factor(conc)
+
+    def rho0_factor(self, conc):
+        """Central density in units of M / R_s^3"""
+        return nfw_rho0_factor(conc)
+
+    def rate_factor(self, conc):
+        """Merger rate in units of cross-section * M^2 / R_s^3"""
+        return nfw_rate_factor(conc)
 
-    def mergerpervolume(self, lowermass=None, uppermass=None):
-        """The merger rate for primordial black holes in events per Gpc per yr."""
+    def _merger_mass_limits(self, lowermass=None, uppermass=None):
+        """log10 of the range of halo masses, in M_sun, over which to integrate the merger rate."""
         #See notes for these limits
         if lowermass is None:
             lowermass = 400*self.ureg.Msolar
@@ -176,14 +337,36 @@ class NFWHalo(hm.HaloMassFunction):
             uppermass = uppermass * self.ureg.Msolar
         if self.ureg.get_dimensionality('') == self.ureg.get_dimensionality(lowermass):
             lowermass = lowermass * self.ureg.Msolar
-        #mass has units M_sun
-        mass = np.logspace(np.log10(lowermass/self.ureg.Msolar),np.log10(uppermass/self.ureg.Msolar),1000)*self.ureg.Msolar
-        integrand = self.halomergerratepervolume(mass)
-        #trapz needs a wrapper: because we are integrating d log M the units do not change.
-        int_units = self.ureg.Gpc**(-3)/self.ureg.year
-        trapz = self.ureg.wraps(int_units, int_units)(np.trapz)
-        mergerrate = trapz(integrand,np.log(mass/self.ureg.Msolar))
-        return mergerrate.to('Gpc**(-3) year**(-1)')
+        return (math.log10(lowermass.to(self.ureg.Msolar).magnitude), math.log10(uppermass.to(self.ureg.Msolar).magnitude))
+
+    def mergerpervolume(self, lowermass=None, uppermass=None, tol=1e-4):
+        """The merger rate for primordial black holes in events per Gpc per yr.
+        Integrated in log M to relative accuracy tol by log_mass_integral.
+        Evaluations of the integrand are cached, so that calls with different limits reuse them."""
+        (logmin, logmax) = self._merger_mass_limits(lowermass, uppermass)
+        integrand = self._cached_integrand(("halomergerratepervolume",), lambda logm: self.halomergerratepervolume(10**logm).magnitude)
+        mergerrate = log_mass_integral(integrand, logmin, logmax, tol)
+        return mergerrate * self.ureg('Gpc**(-3) year**(-1)')
+
+    def _cached_integrand(self, key, evaluate):
+        """Wrap evaluate(log10 M), a function returning an array whose last axis is mass,
+        so that each mass is only evaluated once for the current mass function and concentration model.
+        key identifies the function."""
+        key = key + (self.mass_function, self.conc_model, bool(self.conc_table))
+        #Discard cached values for other models
+        if key not in self._integrand_cache:
+            self._integrand_cache.clear()
+            self._integrand_cache[key] = {}
+        cache = self._integrand_cache[key]
+        def cached(logm):
+            """Evaluate only the masses not already in the cache"""
+            missing = [lm for lm in logm if lm not in cache]
+            if missing:
+                values = np.asarray(evaluate(np.array(missing)))
+                for (i, lm) in enumerate(missing):
+                    cache[lm] = values[...,i]
+            return np.moveaxis(np.array([cache[lm] for lm in logm]), 0, -1)
+        return cached
 
     def mergerfraction(self, vvir, time=None, bhmass = None):
         """Compute the fraction of black hole binaries which merge within time,
@@ -208,13 +391,33 @@ class NFWHalo(hm.HaloMassFunction):
             mass = mass * self.ureg.Msolar
         #pbhrate is 1/s
         pbhrate = self.pbhpbhrate(mass)
-        dndm_func = self.ureg.wraps('Mpch**(-3) Msolarh**(-1)', self.ureg.Msolarh)(self.dndm)
         #dndm has units: h^4 M_sun^-1 Mpc^-3
-        dndm = dndm_func(mass).to('Mpc**(-3) Msolar**(-1)')
+        dndm = self.hubble_units.mass_function(self.dndm(self.mass_h(mass)))
         assert np.all(dndm.magnitude >= 0)
         #So result is (Mpc)^-3 s^-1
         return (dndm * pbhrate * mass).to('Gpc**(-3) year**(-1)')
 
+    def halomergerratepervolume_models(self, mass, models=None):
+        """The merger rate per year per unit volume for halos in a mass bin, for several mass functions at once.
+        Returns an array of shape (len(models), len(mass)). See HaloMassFunction.dndm_models.
+        The merger rate per halo is computed only once."""
+        if self.ureg.get_dimensionality('') == self.ureg.get_dimensionality(mass):
+            mass = mass * self.ureg.Msolar
+        pbhrate = self.pbhpbhrate(mass)
+        dndm = self.hubble_units.mass_function(self.dndm_models(self.mass_h(mass), models))
+        assert np.all(dndm.magnitude >= 0)
+        return (dndm * pbhrate * mass).to('Gpc**(-3) year**(-1)')
+
+    def mergerpervolume_models(self, models=None, lowermass=None, uppermass=None, tol=1e-4):
+        """The merger rate for primordial black holes in events per Gpc per yr, for several mass functions at once.
+        See mergerpervolume."""
+        if models is None:
+            models = self.mass_functions
+        (logmin, logmax) = self._merger_mass_limits(lowermass, uppermass)
+        integrand = self._cached_integrand(tuple(models), lambda logm: self.halomergerratepervolume_models(10**logm, models).magnitude)
+        mergerrate = log_mass_integral(integrand, logmin, logmax, tol)
+        return mergerrate * self.ureg('Gpc**(-3) year**(-1)')
+
     def evaptime(self,mass, bhmass=None):
         """The evaporation timescale following Binney and Tremaine."""
         if bhmass is None:
@@ -250,37 +453,115 @@ class NFWHalo(hm.HaloMassFunction):
 
 class EinastoHalo(NFWHalo):
     """Einasto profile with alpha = 0.18"""
-    def pbhpbhrate(self, mass):
-        """The merger rate for primordial black holes (per year) in a halo of mass in Msun/h, computed in the attached pdf."""
-        #Virial radius R200 in Mpc/h from the virial mass
-        if self.ureg.get_dimensionality('') == self.ureg.get_dimensionality(mass):
-            mass = mass * self.ureg.Msolar
-        conc = self.concentration(mass)
-        alpha = 0.18
-        crosssec = self.cross_section(mass)
-        rho0 = self.rho0(mass)
-        d2 = np.exp(4/alpha) * self.Rs(mass)**3 /alpha * (alpha/4)**(3/alpha) * scipy.special.gammainc(3/alpha, 4/alpha * conc**alpha) * scipy.special.gamma(3/alpha)
-        rate = 2 * math.pi* crosssec * d2 * rho0**2
-        return rate.to('year**(-1)')
+    alpha = 0.18
 
-    def rho0(self, mass):
-        """Central density for the Einasto profile in M_sun/Mpc^3 h^2"""
-        alpha = 0.18
-        R200 = self.R200(mass)
-        conc = self.concentration(mass)
-        gamma = scipy.special.gammainc(3/alpha, 2/alpha * conc**alpha) * scipy.special.gamma(3/alpha)
-        prefac = 4 * math.pi * np.exp(2/alpha)/ alpha *(alpha/2)**(3/alpha)
-        return mass / gamma / prefac / (R200 / conc)**3
+    def rho0_factor(self, conc):
+        """Central density in units of M / R_s^3"""
+        return einasto_rho0_factor(conc, self.alpha)
+
+    def rate_factor(self, conc):
+        """Merger rate in units of cross-section * M^2 / R_s^3"""
+        return einasto_rate_factor(conc, self.alpha)
 
     def profile(self, rr, mass):
         R200 = self.R200(mass)
         conc = self.concentration(mass)
         Rs = R200/conc
-        alpha = 0.18
+        alpha = self.alpha
         rho0 = self.rho0(mass)
         rho = rho0 * np.exp(-2 / alpha * ((rr/Rs)**alpha -1))
         return rho
 
+class MergerRateSurface(object):
+    """The PBH merger rate density on a grid of halo mass and redshift, computed in one pass without units.
+    Reproduces NFWHalo.halomergerratepervolume and EinastoHalo.halomergerratepervolume for a halo at each redshift,
+    sharing the z=0 sigma tables, the growth function and the quantities which do not depend on the concentration
+    (critical density, virial radius and velocity, mass function) between models.
+    halo is an NFWHalo, providing the cosmology, mass function and constants.
+    Masses are Gauss-Legendre nodes in log M between lowermass and uppermass (in M_sun),
+    in panels of 3 decades with order points each. This fixed rule has no error control:
+    for 0 < z < 15 and the default mass range the merger rate with order=12 agrees with
+    log_mass_integral to 5x10^-5 (2x10^-4 for order=6, 5x10^-6 for order=16).
+    Usage:
+        surf = MergerRateSurface(NFWHalo(0), zz)
+        rate = surf.merger_rate(concentration.LudlowConcentration(surf.halo.overden.Dofz), "NFW")
+    """
+    def __init__(self, halo, redshifts, lowermass=400, uppermass=1e16, order=12):
+        self.halo = halo
+        self.redshifts = np.array(redshifts, dtype=np.float64)
+        #Constants in SI units
+        self.gravity = unitregistry.constant("newtonian_constant_of_gravitation")
+        self.light = unitregistry.constant("speed_of_light")
+        self.solarmass = unitregistry.conversion("Msolar", "kg")
+        mpc = unitregistry.conversion("Mpc", "m")
+        year = unitregistry.conversion("year", "s")
+        hubble = halo.hubble_units.hubble
+        #Mass nodes, in M_sun, and weights for integrating in ln M
+        (self.logmass, self.weights) = gauss_legendre_log_nodes(math.log10(lowermass), math.log10(uppermass), order=order)
+        self.mass = 10**self.logmass
+        zz = self.redshifts[:,np.newaxis]
+        massh = self.mass*hubble
+        #Critical density in kg m^-3, with H0 = 100 km/s/Mpc as in NFWHalo.rhocrit
+        hub0 = 100*1e3/mpc
+        rhoc = 3*(halo.overden.omega_matter0*(1+zz)**3 + halo.overden.omega_lambda0)*hub0**2/(8*math.pi*self.gravity)
+        masskg = self.mass*self.solarmass
+        #Virial radius in m and velocity in m/s
+        self.R200 = (3 * masskg / (4* math.pi* 200 * rhoc))**(1/3.)
+        self.vvir = np.sqrt(2*self.gravity*masskg/self.R200)
+        self.masskg = masskg
+        #Peak height
+        growth = halo.overden.Dofz(self.redshifts)[:,np.newaxis]
+        self.nu = 1.686/(growth*halo.overden.sigma_int(np.log10(massh)))
+        #dn/dM in Mpc^-3 M_sun^-1
+        self.dndm = halo.dndm_grid(massh, self.redshifts)*hubble**4
+        #Convert s^-1 Mpc^-3 to yr^-1 Gpc^-3
+        self.units = year*1e9
+        #Concentration dependent quantities: conc_model -> (conc, cross section)
+        self._models = {}
+
+    def _conc_cross_section(self, conc_model):
+        """Concentration and cross-section (in m^3/s kg^-2) on the grid for a concentration model.
+        Follows NFWHalo.cross_section."""
+        if conc_model in self._models:
+            return self._models[conc_model]
+        conc = conc_model.concentration(self.nu, self.redshifts[:,np.newaxis])*np.ones_like(self.nu)
+        vdisp = self.vvir*vdisp_factor(conc, self.halo.dmax)
+        cross = merger_prefactor(self.gravity, self.light)*velocity_average(vdisp/self.light, self.vvir/self.light)
+        self._models[conc_model] = (conc, cross)
+        return (conc, cross)
+
+    def halo_rate(self, conc_model, profile="NFW"):
+        """Merger rate per halo in yr^-1 on the (redshift, mass) grid, for an NFW or Einasto profile.
+        Follows NFWHalo.pbhpbhrate and EinastoHalo.pbhpbhrate."""
+        (conc, cross) = self._conc_cross_section(conc_model)
+        Rs = self.R200/conc
+        if profile == "Einasto":
+            factor = einasto_rate_factor(conc, EinastoHalo.alpha)
+        else:
+            factor = nfw_rate_factor(conc)
+        rate = cross * self.masskg**2 / Rs**3 * factor
+        return rate * self.units / 1e9
+
+    def rate_density(self, conc_model, profile="NFW"):
+        """Merger rate per unit volume per log mass, in Gpc^-3 yr^-1, on the (redshift, mass) grid.
+        As NFWHalo.halomergerratepervolume."""
+        return self.dndm * self.halo_rate(conc_model, profile) * self.mass * 1e9
+
+    def merger_rate(self, conc_model, profile="NFW"):
+        """Merger rate in Gpc^-3 yr^-1 at each redshift, integrated over mass, in the rest frame of the halo.
+        As NFWHalo.mergerpervolume."""
+        return np.dot(self.rate_density(conc_model, profile), self.weights)
+
+def gauss_legendre_log_nodes(logmin, logmax, panel=3., order=12):
+    """Nodes in log10 M and weights for integrating d ln M from logmin to logmax,
+    with a Gauss-Legendre rule of order points on each panel. Interior panel edges are multiples of panel."""
+    edges = np.arange(np.ceil(logmin/panel)*panel, logmax, panel)
+    edges = np.unique(np.concatenate([[logmin], edges, [logmax]]))
+    (nodes, weights) = np.polynomial.legendre.leggauss(order)
+    half = np.diff(edges)[:,np.newaxis]/2.
+    mid = (edges[1:]+edges[:-1])[:,np.newaxis]/2.
+    return ((mid + half*nodes).ravel(), (half*weights*math.log(10)).ravel())
+
 def plot_pbh_halo(redshift):
     """Plot the PBH merger rate as a function of halo mass."""
     mass = np.logspace(2,15)
@@ -306,14 +587,12 @@ def plot_pbh_per_mass(redshift):
     mass = np.logspace(2,15)
     hh = NFWHalo(redshift,conc_model="ludlow")
     hh.conc_model = concentration.LudlowConcentration(hh.overden.Dofz)
-    plt.loglog(mass,  hh.halomergerratepervolume(mass), ls='-', label="Ludlow concentration")
+    rates = hh.halomergerratepervolume_models(mass, ("tinker_200", "press_schechter", "jenkins"))
+    plt.loglog(mass, rates[0], ls='-', label="Ludlow concentration")
     hh.conc_model = concentration.PradaConcentration(hh.overden.omega_matter0)
     plt.loglog(mass, hh.halomergerratepervolume(mass), ls='--', label="Prada concentration")
-    hh.conc_model = concentration.LudlowConcentration(hh.overden.Dofz)
-    hh.mass_function = hh.press_schechter
-    plt.loglog(mass, hh.halomergerratepervolume(mass), ls=':', label="Press-Schechter m.f.")
-    hh.mass_function = hh.jenkins
-    plt.loglog(mass, hh.halomergerratepervolume(mass), ls='-.', label="Jenkins m.f.")
+    plt.loglog(mass, rates[1], ls=':', label="Press-Schechter m.f.")
+    plt.loglog(mass, rates[2], ls='-.', label="Jenkins m.f.")
     plt.xlim(500,1e15)
     plt.xticks(np.logspace(3,15,5))
     plt.xlabel(r"$M_\mathrm{vir}$ ($M_\odot/h$)")
@@ -347,11 +626,12 @@ def _print_numbers(hh):
     print("Mergers per Gpc:",hh.mergerpervolume(400)," above 10^9: ",hh.mergerpervolume(1e9))
     #z02vol = 2.336
     #print("Mergers in six months in z=0.2, lower limit:",z02vol*hh.mergerpervolume(500*0.7)/2,"above 10^9: ",z02vol*hh.mergerpervolume(1e9)/2)
-    #Press-Schechter
-    hh.mass_function = hh.press_schechter
-    print("Press-Schechter Mergers per Gpc:",hh.mergerpervolume(400)," above 10^9: ",hh.mergerpervolume(1e9))
-    hh.mass_function = hh.jenkins
-    print("Jenkins Mergers per Gpc:",hh.mergerpervolume(400)," above 10^9: ",hh.mergerpervolume(1e9))
+    #Press-Schechter and Jenkins
+    models = ("press_schechter", "jenkins")
+    total = hh.mergerpervolume_models(models, 400)
+    above = hh.mergerpervolume_models(models, 1e9)
+    print("Press-Schechter Mergers per Gpc:",total[0]," above 10^9: ",above[0])
+    print("Jenkins Mergers per Gpc:",total[1]," above 10^9: ",above[1])
 
 def merger_at_z(z, conc="Ludlow", halo="Einasto"):
     """Compute the merger rate at a given redshift"""
@@ -376,16 +656,17 @@ def rate_over_redshift(zmin=0., zmax=20., nred = 100,conc="Ludlow", halo="Einast
     mergers = np.array([merger_at_z(zz,conc=conc, halo=halo).magnitude for zz in zzs])
     return zzs, mergers
 
-def redshift_tables(nred=100):
-    """Print tables of the redshift evolution of the mergers"""
-    zzs, mergers = rate_over_redshift(conc="Ludlow", halo="Einasto", nred=nred)
-    np.savetxt("ludlow_einasto.txt", np.array((zzs,mergers)).T)
-    zzs, mergers = rate_over_redshift(conc="Ludlow", halo="NFW", nred=nred)
-    np.savetxt("ludlow_nfw.txt", np.array((zzs,mergers)).T)
-    zzs, mergers = rate_over_redshift(conc="Prada", halo="Einasto", nred=nred)
-    np.savetxt("prada_einasto.txt", np.array((zzs,mergers)).T)
-    zzs, mergers = rate_over_redshift(conc="Prada", halo="NFW", nred=nred)
-    np.savetxt("prada_nfw.txt", np.array((zzs,mergers)).T)
+def redshift_tables(nred=100, zmin=0., zmax=20.):
+    """Print tables of the redshift evolution of the mergers.
+    All four tables come from one MergerRateSurface, equivalent to rate_over_redshift."""
+    zzs = 1/np.linspace(1/(1+zmax), 1/(1+zmin),nred) -1.
+    hh = NFWHalo(0)
+    surf = MergerRateSurface(hh, zzs)
+    for (conc, conc_model) in (("ludlow", concentration.LudlowConcentration(hh.overden.Dofz)), ("prada", concentration.PradaConcentration(hh.overden.omega_matter0))):
+        for halo in ("Einasto", "NFW"):
+            #Rate in the rest frame of the observer, as in merger_at_z
+            mergers = surf.merger_rate(conc_model, halo) / (1+zzs)
+            np.savetxt(conc+"_"+halo.lower()+".txt", np.array((zzs,mergers)).T)
 
 def print_numbers():
     """Wrapper to print for both halos"""
@@ -0,0 +1,91 @@
+"""Tests for the primordial black hole merger rates."""
+
+import warnings
+import numpy as np
+import concentration
+import pbhmergers
+
+def test_conc_table(tmp_path):
+    """Check that the tabulated concentrations give the same merger rate, and follow conc_model."""
+    fname = str(tmp_path / "conc_table.npz")
+    exact = pbhmergers.NFWHalo(0)
+    tabled = pbhmergers.NFWHalo(0, conc_table=fname)
+    mass = np.logspace(3, 15, 20)
+    assert np.allclose(tabled.concentration(mass), exact.concentration(mass), rtol=1e-4)
+    assert np.isclose(tabled.mergerpervolume(400).magnitude, exact.mergerpervolume(400).magnitude, rtol=1e-4)
+    #Changing the model rebuilds the table, overwriting the saved one
+    tabled.conc_model = concentration.PradaConcentration(tabled.overden.omega_matter0)
+    exact.conc_model = concentration.PradaConcentration(exact.overden.omega_matter0)
+    assert np.allclose(tabled.concentration(mass), exact.concentration(mass), rtol=1e-4)
+    assert concentration.load_table(fname).key == tabled._conc_table_key()
+
+def test_mass_function_models():
+    """Check that evaluating several mass functions at once matches swapping mass_function."""
+    hh = pbhmergers.NFWHalo(0)
+    mass = np.logspace(3, 15, 20)
+    models = ("tinker_200", "press_schechter", "jenkins")
+    rates = hh.halomergerratepervolume_models(mass, models)
+    totals = hh.mergerpervolume_models(models, 400)
+    assert np.shape(rates) == (3, 20)
+    for (i, model) in enumerate(models):
+        hh.mass_function = getattr(hh, model)
+        assert np.allclose(rates[i].magnitude, hh.halomergerratepervolume(mass).magnitude, rtol=1e-10)
+        #Both are integrated to a tolerance of 1e-4, but may choose different points
+        assert np.isclose(totals[i].magnitude, hh.mergerpervolume(400).magnitude, rtol=1e-4)
+    dndm = hh.dndm_models(mass)
+    assert np.shape(dndm) == (len(hh.mass_functions), 20)
+
+def test_mergerpervolume_integral():
+    """Check the adaptive integral against a dense trapezium rule, and that a second call reuses evaluations."""
+    hh = pbhmergers.NFWHalo(0)
+    mass = np.logspace(np.log10(400), 16, 20000)
+    dense = np.trapz(hh.halomergerratepervolume(mass).magnitude, np.log(mass))
+    assert np.isclose(hh.mergerpervolume(400).magnitude, dense, rtol=1e-4)
+    cache = list(hh._integrand_cache.values())[0]
+    nevals = len(cache)
+    #At least 10 times fewer than the 1000 of the old fixed grid
+    assert nevals <= 100
+    hh.mergerpervolume(1e9)
+    assert len(cache) < 2*nevals
+    #Changing the model invalidates the cache
+    hh.mass_function = hh.press_schechter
+    hh.mergerpervolume(400)
+    assert len(hh._integrand_cache) == 1
+    assert hh.mass_function in list(hh._integrand_cache)[0]
+
+def test_merger_rate_surface():
+    """Check the surface against the per-redshift calculation with units, for both profiles."""
+    hh = pbhmergers.NFWHalo(0)
+    zz = np.array([0., 2.])
+    surf = pbhmergers.MergerRateSurface(hh, zz)
+    conc = concentration.LudlowConcentration(hh.overden.Dofz)
+    assert np.shape(surf.rate_density(conc)) == (2, np.size(surf.mass))
+    for (profile, halo) in (("NFW", pbhmergers.NFWHalo), ("Einasto", pbhmergers.EinastoHalo)):
+        rates = surf.merger_rate(conc, profile)
+        for (i, z) in enumerate(zz):
+            zhalo = halo(z)
+            zhalo.conc_model = concentration.LudlowConcentration(zhalo.overden.Dofz)
+            #The documented accuracy of the fixed order 12 rule
+            assert np.isclose(rates[i], zhalo.mergerpervolume(400, tol=1e-8).magnitude, rtol=5e-5)
+    #The concentration dependent parts are shared between profiles
+    assert len(surf._models) == 1
+
+def test_log_mass_integral_zero():
+    """A zero integrand is accepted at once, without warnings, and an empty range gives zero."""
+    nevals = []
+    def zero(logm):
+        """Zero integrand which counts evaluations"""
+        nevals.append(np.size(logm))
+        return np.zeros_like(logm)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert pbhmergers.log_mass_integral(zero, 6, 16) == 0
+    assert sum(nevals) < 100
+    assert np.array_equal(pbhmergers.log_mass_integral(lambda logm: np.vstack([logm, logm]), 3, 3), [0, 0])
+    #Reversed limits change the sign
+    forward = pbhmergers.log_mass_integral(lambda logm: 10**(-logm), 2, 5)
+    assert np.isclose(forward, 1e-2 - 1e-5, rtol=1e-8)
+    assert pbhmergers.log_mass_integral(lambda logm: 10**(-logm), 5, 2) == -forward
+    hh = pbhmergers.NFWHalo(0)
+    assert hh.mergerpervolume(1e6, 1e6).magnitude == 0
+    assert np.all(hh.mergerpervolume_models(lowermass=1e6, uppermass=1e6).magnitude == 0)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Binary storage for the text power spectrum outputs of a simulation suite.
+
+Parsing thousands of *_flux_power.txt, PK-by-*, PK-DM-* and *_flux_pdf.txt files with np.loadtxt is slow.
+convert_directory packs every matching text file in a directory (ie, all snapshots of one run)
+into a single flat .npy file, which is memory-mapped when read, so only the pages of the tables
+actually used are read from disc. Each table is stored column-major, so that k, P(k) and
+the mode counts are each contiguous. A JSON metadata file next to it records the offset,
+shape and modification time of each source file.
+
+load_table is a drop-in replacement for np.loadtxt which reads from the binary store when
+it exists and the text file has the same mtime and size as when it was packed (or is gone),
+and falls back to the text file otherwise.
+
+Usage:
+    python pkstore.py /path/to/runs
+converts every directory under /path/to/runs.
+"""
+
+import os
+import sys
+import glob
+import json
+import threading
+import numpy as np
+
+#Name of the binary store in each directory
+STORE_NAME = "powerspec_store.npy"
+#Name of its metadata file
+META_NAME = "powerspec_store.json"
+#Increment this if the layout changes
+STORE_VERSION = 3
+#Files which are packed by default
+PATTERNS = ("*_flux_power.txt", "PK-by-*", "PK-DM-*", "PK-nu-*", "*_flux_pdf.txt")
+#Names of the first columns, for the metadata
+COLUMNS = ("k", "P(k)", "modes")
+#Set to False to always read the text files
+use_store = True
+
+#Open stores: directory -> (metadata mtime, memory-mapped array, metadata)
+_stores = {}
+#Guards _stores, which is used by the loader threads of power_specs.calc_all_parallel
+_stores_lock = threading.Lock()
+
+def store_path(directory):
+    """Path of the binary store for a directory"""
+    return os.path.join(directory, STORE_NAME)
+
+def meta_path(directory):
+    """Path of the metadata for the binary store in a directory"""
+    return os.path.join(directory, META_NAME)
+
+def convert_directory(directory, patterns=PATTERNS):
+    """Pack all text power spectra in directory into one binary store.
+    Returns the number of files packed."""
+    fnames = sorted(set(ff for pat in patterns for ff in glob.glob(os.path.join(directory, pat))))
+    if len(fnames) == 0:
+        return 0
+    arrays = []
+    offset = 0
+    meta = {"version": STORE_VERSION, "files": {}}
+    for fname in fnames:
+        table = np.loadtxt(fname, ndmin=2)
+        name = os.path.basename(fname)
+        #Column-major, so each column is contiguous
+        arrays.append(np.ravel(table.T))
+        stat = os.stat(fname)
+        meta["files"][name] = {"mtime": stat.st_mtime, "size": stat.st_size, "offset": offset, "shape": list(np.shape(table)), "columns": list(COLUMNS[:np.shape(table)[1]])}
+        offset += np.size(table)
+    #Write to temporary files and move, so readers never see a partial store.
+    #The metadata records the stat of the array file, so a reader which sees
+    #the metadata from one conversion and the array from another ignores the store.
+    tmpname = store_path(directory)+".tmp.npy"
+    np.save(tmpname, np.concatenate(arrays))
+    stat = os.stat(tmpname)
+    meta["data_mtime"] = stat.st_mtime
+    meta["data_size"] = stat.st_size
+    tmpmeta = meta_path(directory)+".tmp"
+    with open(tmpmeta, "w") as ff:
+        json.dump(meta, ff)
+    os.replace(tmpname, store_path(directory))
+    os.replace(tmpmeta, meta_path(directory))
+    with _stores_lock:
+        _stores.pop(directory, None)
+    return len(fnames)
+
+def convert_runs(base, patterns=PATTERNS):
+    """Convert every directory below base. Returns the number of files packed."""
+    total = 0
+    for (dirpath, _, _) in os.walk(base):
+        total += convert_directory(dirpath, patterns)
+    return total
+
+def _open_store(directory):
+    """Get the (memory-mapped array, metadata) for the store in directory, or None if there is no usable store."""
+    mpath = meta_path(directory)
+    spath = store_path(directory)
+    try:
+        mtime = os.path.getmtime(mpath)
+    except OSError:
+        return None
+    with _stores_lock:
+        try:
+            (smtime, store, meta) = _stores[directory]
+            if smtime == mtime:
+                return (store, meta)
+        except KeyError:
+            pass
+        _stores.pop(directory, None)
+        try:
+            with open(mpath) as ff:
+                meta = json.load(ff)
+            stat = os.stat(spath)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != STORE_VERSION or (stat.st_mtime, stat.st_size) != (meta["data_mtime"], meta["data_size"]):
+            return None
+        store = np.load(spath, mmap_mode="r")
+        _stores[directory] = (mtime, store, meta)
+        return (store, meta)
+
+def _from_store(fname):
+    """Load a table from the binary store, or return None if it is not there or out of date."""
+    if not use_store:
+        return None
+    (directory, name) = os.path.split(fname)
+    opened = _open_store(directory)
+    if opened is None:
+        return None
+    (store, meta) = opened
+    try:
+        info = meta["files"][name]
+    except KeyError:
+        return None
+    #A text file which has changed in any way since it was packed, including being
+    #replaced by a copy with an older mtime, wins.
+    try:
+        stat = os.stat(fname)
+        if (stat.st_mtime, stat.st_size) != (info["mtime"], info["size"]):
+            return None
+    except OSError:
+        pass
+    (nrows, ncols) = info["shape"]
+    offset = info["offset"]
+    return store[offset:offset+nrows*ncols].reshape(ncols, nrows).T
+
+def load_table(fname):
+    """Load a text table, as np.loadtxt(fname, ndmin=2), using the binary store if possible."""
+    table = _from_store(fname)
+    if table is None:
+        table = np.loadtxt(fname, ndmin=2)
+    return table
+
+def exists(fname):
+    """True if a table can be loaded from fname, either as text or from the binary store."""
+    if os.path.exists(fname):
+        return True
+    (directory, name) = os.path.split(fname)
+    opened = _open_store(directory)
+    return opened is not None and name in opened[1]["files"]
+
+if __name__ == "__main__":
+    for base in sys.argv[1:]:
+        print(base, ":", convert_runs(base), "files packed")
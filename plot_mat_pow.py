@@ -7,10 +7,13 @@ Various functions to plot P(k) from different estimating programs
 import numpy as np
 import math
 import scipy.interpolate
-import os.path
+import os
 import matplotlib.pyplot as plt
 import re
-import glob
+import warnings
+import concurrent.futures
+import pkstore
+import filecache
 
 def rebin(data, xaxis,newx):
     """Just rebins the data"""
@@ -72,10 +75,10 @@ def load_genpk(path,box, o_nu = 0):
     """Load a GenPk format power spectum."""
     #Load DM P(k)
     o_m = 0.3
-    matpow=np.loadtxt(path)
+    matpow=folded_filedata.load(path, pkstore.load_table)
     path_nu = re.sub("PK-DM-","PK-nu-",path)
-    if o_nu > 0 and glob.glob(path_nu):
-        mp1a = np.loadtxt(path_nu)
+    if o_nu > 0 and pkstore.exists(path_nu):
+        mp1a = folded_filedata.load(path_nu, pkstore.load_table)
         matpow_t = (mp1a*o_nu +matpow*(o_m - o_nu))/o_m
         ind = np.where(matpow_t/matpow > 2)
         matpow_t[ind] = matpow[ind]
@@ -96,6 +99,13 @@ def plot_genpk_rel_power(matpow1,matpow2, box,o_nu = 0, colour="blue"):
     plt.title("Power spectrum change")
     plt.semilogx(k, Pk2/Pk1, linestyle="-", color=colour)
 
+def get_rel_power_genpk(matpow1,matpow2, box,o_nu = 0):
+    """Get the ratio between two genpk matter power spectra, rebinning the second onto the k bins of the first.
+    Unlike plot_genpk_rel_power, this does not need the two spectra to have the same k bins."""
+    (k1, Pk1)=load_genpk(matpow1,box, o_nu)
+    (k2, Pk2)=load_genpk(matpow2,box, o_nu)
+    return (k1, rebin(Pk2,k2,k1)/Pk1)
+
 def plot_genpk_power(matpow1, box,o_nu = 0, ls="-",color=None, label=None):
     """ Plot the matter power as output by gen-pk"""
     (k, Pk1) = load_genpk(matpow1,box, o_nu)
@@ -125,6 +135,86 @@ def get_rel_power(matpow1,matpow2):
     #^2*2*!PI^2*2.4e-9*k*hub^3
     return (k, rebin(Pk2,k2,k)/Pk1)
 
+def _load_camb(fname):
+    """Load a CAMB matter power spectrum as in get_rel_power"""
+    mk1=folded_filedata.load(fname, np.loadtxt)
+    return ((mk1[1:,0], mk1[1:,1]),)
+
+def _load_folded_blocks(fname):
+    """Load the small and large scale blocks of a Gadget power spectrum, as in get_rel_folded_power"""
+    (kk_a,pk_a,kk_b,pk_b)=loadfolded(fname)
+    return ((kk_a, pk_a), (kk_b, pk_b))
+
+def _join_folded(kk_a, pk_a, kk_b, pk_b):
+    """Join the large scale block to the part of the small scale block at higher k.
+    pk_a and pk_b may be 2D, with k along the last axis."""
+    ind = np.where(kk_a > kk_b[-1])[0]
+    return (np.concatenate([kk_b,kk_a[ind]]), np.concatenate([pk_b, pk_a[...,ind]], axis=-1))
+
+#Loaders for get_rel_power_batch: kind -> (function(fname, box, o_nu) returning a tuple of (k, P(k)) blocks,
+#function joining the (k, ratio) of each block into a single (k, ratio))
+_batch_loaders = {"camb" : (lambda fname, box, o_nu: _load_camb(fname), lambda kk, rel: (kk, rel)),
+                  "folded" : (lambda fname, box, o_nu: _load_folded_blocks(fname), _join_folded),
+                  "genpk" : (lambda fname, box, o_nu: (load_genpk(fname, box, o_nu),), lambda kk, rel: (kk, rel))}
+
+def get_rel_power_batch(pairs, kind="folded", kgrid=None, box=None, o_nu=0, nthreads=0):
+    """Get the ratios of many pairs of power spectra, P_target(k) / P_ref(k), in one go.
+    pairs is a list of (reference file, target file).
+    kind is "camb" (as get_rel_power), "folded" (Gadget estimator, as get_rel_folded_power)
+    or "genpk" (as get_rel_power_genpk, which needs box and o_nu).
+    Each file is loaded once and a spline is fitted to each of its blocks, however many pairs it is in.
+    Each ratio is computed as by the single pair function, on the k bins of its reference file.
+    If all the reference files have the same k bins (the usual case), each target spline is evaluated
+    once on them and all the ratios are a single indexed division.
+    The ratios are returned on kgrid, which defaults to the k bins of the first pair.
+    Ratios with different k bins are rebinned onto kgrid.
+    If nthreads > 0, the files are loaded and fitted in a pool of that many threads.
+    Returns (kgrid, ratios), with ratios of shape (len(pairs), len(kgrid))."""
+    (loader, join)=_batch_loaders[kind]
+    fnames=sorted(set(ff for pair in pairs for ff in pair))
+    def fit(fname):
+        """Load a file and fit a spline to each block, as in rebin"""
+        blocks=loader(fname, box, o_nu)
+        return [(kk, pk, scipy.interpolate.InterpolatedUnivariateSpline(np.log(kk),pk)) for (kk, pk) in blocks]
+    if nthreads > 0:
+        with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+            fits=dict(zip(fnames, pool.map(fit, fnames)))
+    else:
+        fits=dict((ff, fit(ff)) for ff in fnames)
+    refs=sorted(set(ref for (ref, _) in pairs))
+    if all(np.array_equal(kk, kk0) for ref in refs for ((kk, _, _), (kk0, _, _)) in zip(fits[ref], fits[refs[0]])):
+        #Shared k bins: evaluate each target spline once per block, then divide all the pairs at once
+        targets=sorted(set(target for (_, target) in pairs))
+        ridx=[refs.index(ref) for (ref, _) in pairs]
+        tidx=[targets.index(target) for (_, target) in pairs]
+        rel=[]
+        for (b, (kk, _, _)) in enumerate(fits[refs[0]]):
+            tpower=np.array([fits[ff][b][2](np.log(kk)) for ff in targets])
+            rpower=np.array([fits[ff][b][1] for ff in refs])
+            rel+=[kk, tpower[tidx]/rpower[ridx]]
+        (kk, ratios)=join(*rel)
+        if kgrid is None or np.array_equal(kgrid, kk):
+            return (kk, ratios)
+        rels=list(zip([kk]*len(pairs), ratios))
+    else:
+        rels=[]
+        for (ref, target) in pairs:
+            #The ratio of one pair on the k bins of the reference
+            rel=[]
+            for ((kk, pk, _), (_, _, intp)) in zip(fits[ref], fits[target]):
+                rel+=[kk, intp(np.log(kk))/pk]
+            rels.append(join(*rel))
+    if kgrid is None:
+        kgrid=rels[0][0]
+    kgrid=np.array(kgrid)
+    ratios=np.empty((len(pairs), np.size(kgrid)))
+    for (i, (kk, rel)) in enumerate(rels):
+        if np.array_equal(kk, kgrid):
+            ratios[i]=rel
+        else:
+            ratios[i]=rebin(rel, kk, kgrid)
+    return (kgrid, ratios)
+
 def get_rel_folded_power(fname1, fname2):
     """Get the ratio of two matter power spectra from the Gadget estimator"""
     #Note for some reason the small scale power is first in the file.
@@ -133,10 +223,7 @@ def get_rel_folded_power(fname1, fname2):
     relpk_a=rebin(pk_a2,kk_a2,kk_a1)/pk_a1
     relpk_b=rebin(pk_b2,kk_b2,kk_b1)/pk_b1
     #Ignore the first few bins of the b power, as they are always noisy.
-    ind = np.where(kk_a1 > kk_b1[-1])
-    kk_aa1 = np.ravel(kk_a1[ind])
-    relpk_aa = np.ravel(relpk_a[ind])
-    return (np.concatenate([kk_b1,kk_aa1]), np.concatenate([relpk_b, relpk_aa]))
+    return _join_folded(kk_a1, relpk_a, kk_b1, relpk_b)
 
 def plot_rel_folded_power(fname1,fname2,colour="black", ls="-"):
     """Plot the ratio of two matter power spectra from the Gadget estimator"""
@@ -162,19 +249,12 @@ def plot_folded_power(fname1,ls="-", color=None, label=None):
 def get_folded_power(fname1):
     """Get the matter power spectrum from the internal Gadget estimator"""
     (kk_a1,pk_a1,kk_b1,pk_b1)=loadfolded(fname1)
-    ind = np.where(kk_a1 > kk_b1[-1])
-    kk_aa1 = np.ravel(kk_a1[ind])
-    pk_aa = np.ravel(pk_a1[ind])/kk_a1[ind]**3
-    pk_b1 = pk_b1/kk_b1**3
-    return (np.concatenate([kk_b1,kk_aa1]), np.concatenate([pk_b1, pk_aa]))
+    return _join_folded(kk_a1, pk_a1/kk_a1**3, kk_b1, pk_b1/kk_b1**3)
 
 def get_nu_folded_power(fname):
     """Load the neutrino power spectrum in the format output
     by the internal gadget integrator"""
-    f_in= np.fromfile(fname, sep=' ',count=-1)
-    time=f_in[0]
-    bins=f_in[1]
-    data=f_in[2:(2*bins+2)].reshape(bins,2)
+    (time, data)=folded_filedata.load(fname, read_nu_folded)
     scale=1000
     pk=data[:,1]
     k=data[:,0]
@@ -187,31 +267,105 @@ def plot_nu_folded_power(fname,ls="-",color=None, label=None):
     (kk,delta)=get_nu_folded_power(fname)
     plt.loglog(kk,delta,linestyle=ls,color=color, label=label)
 
-#This is a cache for files that will not change between reads
-folded_filedata={}
+#This is a cache for files that will not change between reads,
+#shared by loadfolded, get_nu_folded_power and load_genpk.
+#Use folded_filedata.stats() to see how well it is doing and folded_filedata.clear() to empty it.
+folded_filedata=filecache.FileCache(max_bytes=128*1024**2, check_size=True)
+
+#Set this to True to save a binary copy, fname.npy, of each Gadget power spectrum file when it is parsed.
+#Later reads memory map the binary copy, which is much faster than parsing the text.
+folded_sidecars=False
+
+def _file_stamp(fname):
+    """The (mtime, size) of a file, recorded in its sidecar, or None if it does not exist"""
+    try:
+        stat=os.stat(fname)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+def write_folded_sidecar(fname, f_in=None, stamp=None):
+    """Save the numbers in a Gadget power spectrum file to the binary sidecar fname.npy.
+    The first two numbers in the sidecar are the (mtime, size) of the text file, as it was when read.
+    If f_in is given, stamp should be the _file_stamp of fname from before it was read."""
+    if f_in is None:
+        stamp=_file_stamp(fname)
+        f_in=np.fromfile(fname, sep=' ',count=-1)
+    #Write to a temporary file and move, so readers never see a partial file.
+    tmpname=fname+".tmp.npy"
+    np.save(tmpname, np.concatenate([stamp, f_in]))
+    os.replace(tmpname, fname+".npy")
+
+def read_folded_flat(fname):
+    """Read all the numbers in a Gadget power spectrum file into a flat array.
+    Uses the binary sidecar if the text file has exactly the mtime and size recorded in it,
+    or if there is no text file. Any other change to the text file, even to an older mtime, means it is parsed again."""
+    sidecar=fname+".npy"
+    stamp=_file_stamp(fname)
+    if os.path.exists(sidecar):
+        f_side=np.load(sidecar, mmap_mode='r')
+        if np.size(f_side) >= 2 and (stamp is None or tuple(f_side[:2]) == stamp):
+            return f_side[2:]
+    f_in=np.fromfile(fname, sep=' ',count=-1)
+    if folded_sidecars:
+        write_folded_sidecar(fname, f_in, stamp)
+    return f_in
+
+def _header_bins(f_in, off, width, fname):
+    """Get the number of bins from the header at off, checking there are enough numbers after it
+    for bins records of width numbers each."""
+    if np.size(f_in) < off+4:
+        raise ValueError(fname+": truncated header at "+str(off))
+    bins=int(f_in[off+1])
+    if bins != f_in[off+1] or bins < 0:
+        raise ValueError(fname+": bad number of bins "+str(f_in[off+1]))
+    if np.size(f_in) < off+4+width*bins:
+        raise ValueError(fname+": "+str(bins)+" bins in header, but only "+str((np.size(f_in)-off-4)//width)+" records")
+    return bins
+
+def read_folded(fname):
+    """Read a folded power spectrum file from the internal Gadget estimator.
+    This has two blocks, large scale and small scale, each of which is a header:
+    time, number of bins, mass, number of particles; followed by a record of 10 numbers for each bin.
+    Returns ((time, mass, npart, data), (time, mass, npart, data)) with data of shape (bins, 10).
+    Raises ValueError if there are fewer records than the headers say.
+    Extra numbers at the end of the file are ignored, with a warning."""
+    f_in=read_folded_flat(fname)
+    blocks=[]
+    off=0
+    for _ in range(2):
+        bins=_header_bins(f_in, off, 10, fname)
+        blocks.append((f_in[off], f_in[off+2], f_in[off+3], f_in[off+4:off+4+10*bins].reshape(bins,10)))
+        off+=4+10*bins
+    if np.size(f_in) > off:
+        warnings.warn(fname+": ignoring "+str(np.size(f_in)-off)+" extra numbers at end of file")
+    return tuple(blocks)
+
+def read_nu_folded(fname):
+    """Read a neutrino power spectrum file from the internal Gadget integrator.
+    This is a header: time, number of bins, followed by k, P(k) for each bin.
+    Returns (time, data) with data of shape (bins, 2).
+    Extra numbers at the end of the file are ignored, with a warning."""
+    f_in=read_folded_flat(fname)
+    if np.size(f_in) < 2:
+        raise ValueError(fname+": truncated header")
+    bins=int(f_in[1])
+    if bins != f_in[1] or bins < 0 or np.size(f_in) < 2*bins+2:
+        raise ValueError(fname+": "+str(f_in[1])+" bins in header, but "+str(np.size(f_in)-2)+" numbers")
+    if np.size(f_in) > 2*bins+2:
+        warnings.warn(fname+": ignoring "+str(np.size(f_in)-2*bins-2)+" extra numbers at end of file")
+    return (f_in[0], f_in[2:2*bins+2].reshape(bins,2))
 
 def loadfolded(fname):
     """Load the folded power spectrum file"""
-    if fname in folded_filedata and os.path.getmtime(fname) <= folded_filedata[fname][0]:
-        return folded_filedata[fname][1]
-    f_in= np.fromfile(fname, sep=' ',count=-1)
-    #Load header
+    return folded_filedata.load(fname, _loadfolded)
+
+def _loadfolded(fname):
+    """Parse the folded power spectrum file, for loadfolded"""
     scale=1000
-    time=f_in[0]
-    bins_a=int(f_in[1])
-    mass_a=f_in[2]
-    npart=f_in[3]
-    #Read large scale power spectrum data
-    adata=f_in[4:(10*bins_a+4)].reshape(bins_a,10)
-    #Read second header
-    b_off=10*bins_a+4
-    time=f_in[b_off]
-    bins_b=int(f_in[b_off+1])
-    mass_b=f_in[b_off+2]
-    npart=f_in[b_off+3]
-    #Read small-scale data
-#     print os.path.basename(fname)+' at time '+str(round((1./time-1.),2))
-    bdata=f_in[(b_off+4):(10*bins_b+4+b_off)].reshape(bins_b,10)
+    ((time, mass_a, npart, adata), (time, mass_b, npart, bdata))=read_folded(fname)
+    bins_a=np.shape(adata)[0]
+    bins_b=np.shape(bdata)[0]
     (kk_a, pk_a) = GetFoldedPower(adata,bins_a)
     (kk_b, pk_b) = GetFoldedPower(bdata,bins_b)
     #Ignore the sample variance dominated modes near the edge of the small-scale bins.
@@ -223,8 +377,6 @@ def loadfolded(fname):
         ind=np.where(kk_b > 4*kk_b[0])
         kk_b=kk_b[ind]
         pk_b=pk_b[ind]
-    folded_filedata[fname]=(os.path.getmtime(fname), (scale*kk_a, pk_a, scale*kk_b, pk_b))
-
     return (scale*kk_a, pk_a, scale*kk_b, pk_b)
 
 def GetFoldedPower(adata, bins):
@@ -259,6 +411,41 @@ def GetFoldedPower(adata, bins):
     assert np.all(K_A) > 0
     logK_A=np.log10(K_A)
     MinDlogK = (np.max(logK_A) - np.min(logK_A))/TargetBins
+    #Bins are merged until they contain at least MinModeCount modes and span MinDlogK in log k.
+    #The search below needs k to be sorted
+    if np.any(np.diff(logK_A) < 0):
+        return _GetFoldedPowerLoop(K_A, ModeCount_A, ModePowUncorrected_A, ConvFac_A, MinModeCount, MinDlogK, bins)
+    #Cumulative mode count, so that bins istart:iend contain CumCount[iend]-CumCount[istart] modes.
+    CumCount = np.concatenate([[0.],np.cumsum(ModeCount_A[:bins])])
+    starts = np.arange(bins)
+    #For a group starting at each bin, the first end satisfying each criterion.
+    #These are bins+1 if there is no such end.
+    iend = np.maximum(starts+1, np.searchsorted(CumCount, CumCount[:bins]+MinModeCount))
+    iend = np.maximum(iend, np.searchsorted(logK_A[:bins], logK_A[:bins]+MinDlogK)+1)
+    #Each group starts where the last one ended. The last, incomplete, group is discarded.
+    groups = []
+    istart = 0
+    while istart < bins and iend[istart] <= bins:
+        groups.append(istart)
+        istart = iend[istart]
+    if len(groups) == 0:
+        return (np.array([]), np.array([]))
+    last = istart
+    count = np.add.reduceat(ModeCount_A[:last], groups)
+    #Earlier versions did: (ConvFac_A[b]*Specshape_A[b])
+    #This is a correction from what is done in pm_periodic.
+    #I think it is some sort of bin weighted average.
+    #In pm_periodic he divides each mode by Specshape_A(k_mode)
+    #, and then sums them. So we can use the Corrected powers and multiply by Specshape,
+    #or we can just use the uncorrected versions. They give the same answer.
+    Pk = np.add.reduceat((ModeCount_A*ModePowUncorrected_A*ConvFac_A)[:last], groups)/count
+    kk = np.add.reduceat((ModeCount_A*K_A)[:last], groups)/count
+    assert np.all(Pk >= 0)
+    return (kk, Pk)
+
+def _GetFoldedPowerLoop(K_A, ModeCount_A, ModePowUncorrected_A, ConvFac_A, MinModeCount, MinDlogK, bins):
+    """Merge power spectrum bins one at a time. Used by GetFoldedPower if k is not sorted."""
+    logK_A=np.log10(K_A)
     istart=0
     iend=0
     k_list_A = []#np.array([])
@@ -272,17 +459,12 @@ def GetFoldedPower(adata, bins):
         if count >= MinModeCount and logK_A[iend-1] >= targetlogK:
             pk = np.sum(ModeCount_A[istart:iend]*ModePowUncorrected_A[istart:iend]*ConvFac_A[istart:iend])/count
             kk = np.sum(ModeCount_A[istart:iend]*K_A[istart:iend])/count
-            #Earlier versions did: (ConvFac_A[b]*Specshape_A[b])
-            #This is a correction from what is done in pm_periodic.
-            #I think it is some sort of bin weighted average.
-            #In pm_periodic he divides each mode by Specshape_A(k_mode)
-            #, and then sums them. So we can use the Corrected powers and multiply by Specshape,
-            #or we can just use the uncorrected versions. They give the same answer.
             k_list_A.append(kk)
             Pk_list.append(pk)
 #             count_list_A.append(count)
             istart=iend
-            targetlogK=logK_A[istart]+MinDlogK
+            if istart < bins:
+                targetlogK=logK_A[istart]+MinDlogK
             count=0
             assert pk >= 0
     return (np.array(k_list_A), np.array(Pk_list))
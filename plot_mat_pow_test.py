@@ -0,0 +1,170 @@
+"""Tests for the power spectrum loading and rebinning functions."""
+
+import warnings
+import numpy as np
+import plot_mat_pow
+
+def _fake_folded(bins, seed=11):
+    """Make a fake table of power spectrum bins in the format output by the Gadget estimator"""
+    rng = np.random.RandomState(seed)
+    adata = np.zeros((bins, 10))
+    adata[:,0] = np.sort(np.exp(rng.uniform(-3, 2, size=bins)))
+    adata[:,4] = rng.randint(0, 30, size=bins)
+    adata[:,6] = rng.uniform(0.5, 2, size=bins)*adata[:,0]**-2
+    adata[:,9] = 4*np.pi*adata[:,0]**3
+    return adata
+
+def test_folded_power():
+    """Check the vectorized rebinning gives the same bins as merging them one at a time."""
+    for (bins, seed) in ((3000, 11), (20000, 12), (40, 13)):
+        adata = _fake_folded(bins, seed)
+        (kk, pk) = plot_mat_pow.GetFoldedPower(adata, bins)
+        logk = np.log10(adata[:,0])
+        (kk_l, pk_l) = plot_mat_pow._GetFoldedPowerLoop(adata[:,0], adata[:,4], adata[:,6], adata[:,9], 50, (logk[-1]-logk[0])/200, bins)
+        assert np.size(kk) == np.size(kk_l)
+        assert np.allclose(kk, kk_l, rtol=1e-12, atol=0)
+        assert np.allclose(pk, pk_l, rtol=1e-12, atol=0)
+    #Unsorted k uses the loop
+    adata = _fake_folded(500)[::-1]
+    (kk, pk) = plot_mat_pow.GetFoldedPower(adata, 500)
+    assert np.size(kk) == np.size(pk)
+
+def test_loadfolded_cache(tmp_path):
+    """Check that folded power spectrum files are parsed once and shared."""
+    fname = str(tmp_path / "powerspec_000.txt")
+    with open(fname, "w") as ff:
+        for seed in (1, 2):
+            adata = _fake_folded(3000, seed)
+            ff.write("0.5\n3000\n1.0\n512\n")
+            np.savetxt(ff, adata)
+    plot_mat_pow.folded_filedata.clear()
+    first = plot_mat_pow.loadfolded(fname)
+    second = plot_mat_pow.loadfolded(fname)
+    assert first is second
+    assert plot_mat_pow.folded_filedata.stats()["hits"] == 1
+    assert np.all(first[1] >= 0)
+
+def test_folded_sidecar(tmp_path):
+    """Check the binary sidecar gives the same answer as the text, and truncated files are caught."""
+    fname = str(tmp_path / "powerspec_001.txt")
+    with open(fname, "w") as ff:
+        for seed in (3, 4):
+            ff.write("0.5\n1000\n1.0\n512\n")
+            np.savetxt(ff, _fake_folded(1000, seed))
+    text = plot_mat_pow.read_folded(fname)
+    plot_mat_pow.write_folded_sidecar(fname)
+    binary = plot_mat_pow.read_folded(fname)
+    assert isinstance(binary[1][3].base, np.memmap)
+    for (tt, bb) in zip(text, binary):
+        assert tt[0:3] == bb[0:3]
+        assert np.all(tt[3] == bb[3])
+    #A newer text file is used instead of the sidecar
+    with open(fname, "w") as ff:
+        ff.write("0.5\n1000\n1.0\n512\n")
+        np.savetxt(ff, _fake_folded(1000, 3))
+    mtime = plot_mat_pow.os.path.getmtime(fname+".npy")
+    plot_mat_pow.os.utime(fname, (mtime+10, mtime+10))
+    try:
+        plot_mat_pow.read_folded(fname)
+        assert False
+    except ValueError:
+        pass
+
+def test_folded_sidecar_older(tmp_path):
+    """A text file replaced by a copy with an older mtime is read instead of the sidecar."""
+    fname = str(tmp_path / "powerspec_003.txt")
+    with open(fname, "w") as ff:
+        ff.write("1 2 3 4\n")
+    plot_mat_pow.write_folded_sidecar(fname)
+    assert np.array_equal(plot_mat_pow.read_folded_flat(fname), [1, 2, 3, 4])
+    mtime = plot_mat_pow.os.path.getmtime(fname)
+    with open(fname, "w") as ff:
+        ff.write("9 9 9 9\n")
+    plot_mat_pow.os.utime(fname, (mtime-100, mtime-100))
+    assert np.array_equal(plot_mat_pow.read_folded_flat(fname), [9, 9, 9, 9])
+    #With no text file, the sidecar is used
+    plot_mat_pow.os.remove(fname)
+    assert np.array_equal(plot_mat_pow.read_folded_flat(fname), [1, 2, 3, 4])
+
+def test_folded_trailing(tmp_path):
+    """Extra numbers after the last block are ignored with a warning, as the old loader ignored them."""
+    fname = str(tmp_path / "powerspec_002.txt")
+    with open(fname, "w") as ff:
+        for seed in (5, 6):
+            ff.write("0.5\n100\n1.0\n512\n")
+            np.savetxt(ff, _fake_folded(100, seed))
+    clean = plot_mat_pow.read_folded(fname)
+    with open(fname, "a") as ff:
+        ff.write("1.0 2.0 3.0\n")
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        extra = plot_mat_pow.read_folded(fname)
+    assert len(caught) == 1
+    for (cc, ee) in zip(clean, extra):
+        assert np.all(cc[3] == ee[3])
+    nuname = str(tmp_path / "powerspec-nu_002.txt")
+    with open(nuname, "w") as ff:
+        ff.write("0.5\n3\n1 2\n3 4\n5 6\n7\n")
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        (time, data) = plot_mat_pow.read_nu_folded(nuname)
+    assert len(caught) == 1
+    assert time == 0.5
+    assert np.array_equal(data, [[1, 2], [3, 4], [5, 6]])
+
+def test_rel_power_batch(tmp_path):
+    """Check the batch ratios match get_rel_power, with each file loaded once."""
+    kk = np.logspace(-3, 1, 200)
+    fnames = []
+    for i in range(4):
+        fname = str(tmp_path / ("matterpow_%d.dat" % i))
+        np.savetxt(fname, np.vstack([kk, (1+0.1*i*np.sin(kk))*kk**-1.5]).T)
+        fnames.append(fname)
+    pairs = [(fnames[0], fnames[i]) for i in (1, 2, 3)] + [(fnames[1], fnames[3])]
+    plot_mat_pow.folded_filedata.clear()
+    (kgrid, ratios) = plot_mat_pow.get_rel_power_batch(pairs, kind="camb", nthreads=2)
+    assert np.shape(ratios) == (4, 199)
+    assert plot_mat_pow.folded_filedata.misses == 4
+    for (pair, ratio) in zip(pairs, ratios):
+        (k1, rel) = plot_mat_pow.get_rel_power(*pair)
+        assert np.all(k1 == kgrid)
+        assert np.allclose(ratio, rel, rtol=1e-10)
+
+def test_rel_power_batch_blocks(tmp_path):
+    """Check the batch ratios of Gadget and GenPk spectra match get_rel_folded_power and get_rel_power_genpk."""
+    folded = []
+    genpk = []
+    for i in range(4):
+        fname = str(tmp_path / ("powerspec_%03d.txt" % i))
+        with open(fname, "w") as ff:
+            for (seed, kscale) in ((20+2*i, 8.), (21+2*i, 1.)):
+                adata = _fake_folded(3000, seed)
+                adata[:,0] *= kscale
+                ff.write("0.5\n3000\n1.0\n512\n")
+                np.savetxt(ff, adata)
+        folded.append(fname)
+        fname = str(tmp_path / ("PK-DM-%d" % i))
+        kk = np.logspace(-3, 1, 100+10*i)
+        np.savetxt(fname, np.vstack([kk, (1+0.1*i*np.sin(kk))*kk**-1.5]).T)
+        genpk.append(fname)
+    plot_mat_pow.folded_filedata.clear()
+    for (kind, fnames, single) in (("folded", folded, plot_mat_pow.get_rel_folded_power),
+                                   ("genpk", genpk, lambda f1, f2: plot_mat_pow.get_rel_power_genpk(f1, f2, 100.))):
+        pairs = [(fnames[0], fnames[i]) for i in (1, 2, 3)]
+        (kgrid, ratios) = plot_mat_pow.get_rel_power_batch(pairs, kind=kind, box=100., nthreads=2)
+        for (pair, ratio) in zip(pairs, ratios):
+            (k1, rel) = single(*pair)
+            assert np.all(k1 == kgrid)
+            assert np.allclose(ratio, rel, rtol=1e-12)
+        #A pair with a different reference
+        pair = (fnames[1], fnames[3])
+        (kgrid, ratios) = plot_mat_pow.get_rel_power_batch([pair], kind=kind, box=100.)
+        (k1, rel) = single(*pair)
+        assert np.all(k1 == kgrid)
+        assert np.allclose(ratios[0], rel, rtol=1e-12)
+        #References with different k bins: the second ratio is rebinned onto the bins of the first
+        (kgrid, ratios) = plot_mat_pow.get_rel_power_batch([(fnames[0], fnames[2]), pair], kind=kind, box=100.)
+        (k0, rel0) = single(fnames[0], fnames[2])
+        assert np.all(k0 == kgrid)
+        assert np.allclose(ratios[0], rel0, rtol=1e-12)
+        assert np.allclose(ratios[1], plot_mat_pow.rebin(rel, k1, kgrid), rtol=1e-12)
@@ -16,6 +16,71 @@ import matplotlib.pyplot as plt
 import matplotlib.backends
 import re
 import ast
+import os
+import time
+import hashlib
+import zipfile
+import concurrent.futures
+import multiprocessing
+import filecache
+import pkstore
+
+#Parsed simulation outputs, shared between all the power_spec classes.
+#The same best-fit files are read for every knot and redshift, so this saves a lot of parsing.
+pk_cache=filecache.FileCache()
+
+def loadtxt(fname):
+    """np.loadtxt, but through the file cache and reading from the binary store
+    made by pkstore.py if there is one. The returned array is read-only."""
+    return pk_cache.load(fname, pkstore.load_table)
+
+def _timed(func, *args):
+    """Call func(*args), returning (result, seconds taken)"""
+    start=time.time()
+    result=func(*args)
+    return (result, time.time()-start)
+
+def calc_all_parallel(flux, Knots, kbins, nthreads=8, nprocs=None):
+    """Parallel version of flux.calc_all for a list of knots.
+    Every (knot, redshift) pair is independent. Files are loaded with flux.load_z in a pool of nthreads threads,
+    and each fit is sent to a pool of nprocs processes (None is one per cpu; 0 fits in this process)
+    as soon as its data is loaded.
+    The process pool starts its workers with "spawn", not "fork": they are started while the loader threads
+    may hold locks (eg, in pk_cache), and a forked child would inherit those locks held and could deadlock.
+    So flux must be picklable, and each worker imports this module afresh.
+    Returns (list of flux.calc_all(knot, kbins) for each knot,
+             list of (knot index, redshift, load seconds, fit seconds))"""
+    nz=np.size(flux.Zz)
+    tasks=[(i,j) for i in range(len(Knots)) for j in range(nz)]
+    results={}
+    timings={}
+    procs=None
+    if nprocs != 0:
+        procs=concurrent.futures.ProcessPoolExecutor(nprocs, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(nthreads,1)) as threads:
+            loads={threads.submit(_timed, flux.load_z, flux.Zz[j], Knots[i]) : (i,j) for (i,j) in tasks}
+            fits={}
+            for ff in concurrent.futures.as_completed(loads):
+                (i,j)=loads[ff]
+                (data, tload)=ff.result()
+                timings[(i,j)]=tload
+                if procs is None:
+                    (results[(i,j)], tfit)=_timed(flux.fit_z, flux.Zz[j], Knots[i], kbins, data)
+                    timings[(i,j)]=(tload, tfit)
+                else:
+                    fits[procs.submit(_timed, flux.fit_z, flux.Zz[j], Knots[i], kbins, data)]=(i,j)
+            for ff in concurrent.futures.as_completed(fits):
+                (i,j)=fits[ff]
+                (results[(i,j)], tfit)=ff.result()
+                timings[(i,j)]=(timings[(i,j)], tfit)
+    finally:
+        if procs is not None:
+            procs.shutdown()
+    #Same layout as calc_all: (derivatives) x (zbins)
+    derivs=[np.array([results[(i,j)] for j in range(nz)]).T for i in range(len(Knots))]
+    times=[(i, flux.Zz[j])+timings[(i,j)] for (i,j) in tasks]
+    return (derivs, times)
 
 class DataError(Exception):
     def __init__(self, value):
@@ -24,6 +89,45 @@ class DataError(Exception):
     def __str__(self):
         return repr(self.value)
 
+#Increment this if the layout of saved flux_interp tables changes
+TABLE_VERSION=1
+
+def hash_files(fnames, base=""):
+    """SHA1 hash of the contents of a list of files, for detecting stale tables.
+    File names are hashed relative to base, so a suite can be moved.
+    Files only present in a pkstore binary store are hashed by their contents."""
+    sha=hashlib.sha1()
+    for fname in fnames:
+        sha.update(os.path.relpath(fname, base).encode())
+        if os.path.exists(fname):
+            with open(fname,"rb") as ff:
+                sha.update(ff.read())
+        elif pkstore.exists(fname):
+            sha.update(np.ascontiguousarray(pkstore.load_table(fname)).tobytes())
+        else:
+            sha.update(b"missing")
+    return sha.hexdigest()
+
+def knots_hash(flux, Knots):
+    """Hash of the input files of a flux_interp built from flux and Knots, as stored in its table."""
+    return hash_files([ff for Kn in Knots for ff in flux.knot_files(Kn)], flux.base)
+
+def load_flux_interp(fname, inputs_hash=None):
+    """Load a table saved with flux_interp.save.
+    If inputs_hash is not None, raise DataError if the table was made from different input files.
+    With inputs_hash=None nothing is checked: this is for likelihood workers, which should start fast."""
+    with np.load(fname) as data:
+        if int(data["version"]) != TABLE_VERSION:
+            raise DataError(fname+" has version "+str(data["version"])+" not "+str(TABLE_VERSION))
+        if inputs_hash is not None and str(data["inputs_hash"]) != inputs_hash:
+            raise DataError(fname+" is stale: input files have changed")
+        interp=flux_interp.__new__(flux_interp)
+        for name in ("derivs","p0","q0","kbins","Zz"):
+            setattr(interp, name, data[name])
+        interp.inputs_hash=str(data["inputs_hash"])
+    interp.timings=[]
+    return interp
+
 def smooth(data, window_len, window):
     """ Smooth data (code modified from SciPy Cookbook 1D smooth) """
     if data.ndim != 1:
@@ -139,7 +243,7 @@ class power_spec:
         # power_spec class exists as an ancestor to the flux and matter classes, so it shouldn't really
         #   matter what we define loadpk to be here - each class has its own function
         #Adjust Fourier convention.
-        flux_power=np.loadtxt(self.base+path)
+        flux_power=loadtxt(self.base+path)
         scale=self.H0/box
         k=(flux_power[1:,0]-0.5)*scale*2.0*math.pi
         PF=flux_power[1:,1]/scale
@@ -180,7 +284,7 @@ class power_spec:
     def loaddata(self, file, box):
         """ Do correct units conversion to return k and one-d power """
         #Adjust Fourier convention.
-        flux_power=np.loadtxt(file)
+        flux_power=loadtxt(file)
         scale=self.H0/box
         k=flux_power[1:,0]*scale*2.0*math.pi
         PF=flux_power[1:,1]/scale
@@ -414,11 +518,27 @@ class power_spec:
     def calc_z(self, redshift,s_knot, kbins):
         """ Calculate the flux derivatives for a single redshift
             Output: (kbins d2P...kbins dP (flat vector of length 2xkbins))"""
+        return self.fit_z(redshift, s_knot, kbins, self.load_z(redshift, s_knot))
+
+    def load_z(self, redshift, s_knot):
+        """Load the power spectra calc_z needs for a single redshift. Does all the I/O.
+            Output: (k, best-fit power, power for each simulation in the knot)"""
+        snap=self.GetSnap(redshift)
+        (k,PFp0)=self.loadpk(s_knot.bstft+self.suf+snap+self.ext,s_knot.bfbox)
+        PowerFluxes=np.zeros((np.size(s_knot.names),np.size(k)))
+        for i in np.arange(0,np.size(s_knot.names)):
+            (k,PowerFluxes[i,:])=self.loadpk(s_knot.names[i]+self.suf+snap+self.ext, s_knot.bfbox)
+        return (k, PFp0, PowerFluxes)
+
+    def fit_z(self, redshift, s_knot, kbins, data):
+        """ Calculate the flux derivatives for a single redshift from the output of load_z.
+            Does no I/O, so can be run in a separate process.
+            Output: (kbins d2P...kbins dP (flat vector of length 2xkbins))"""
         #Array to store answers.
         #Format is: k x (dP, d²P, χ²)
         kbins=np.array(kbins)
         nk=np.size(kbins)
-        snap=self.GetSnap(redshift)
+        (k, PFp0, PowerFluxes) = data
         results=np.zeros(2*nk)
         if np.size(s_knot.qvals) > 0: 
             results = np.zeros(4*nk)
@@ -431,8 +551,6 @@ class power_spec:
             if np.size(s_knot.qvals) > 0:
                 qdifs=s_knot.qvals[:,i] - s_knot.q0[i]
         npvals=np.size(pdifs)
-        #Load the data
-        (k,PFp0)=self.loadpk(s_knot.bstft+self.suf+snap+self.ext,s_knot.bfbox)
         #This is to rescale by the mean flux, for generating mean flux tables.
         ###
         #tau_eff=0.0023*(1+redshift)**3.65
@@ -441,9 +559,6 @@ class power_spec:
         #teffs=tmin+s_knot.pvals*(tmax-tmin)/30.
         #pdifs=teffs/tau_eff-1.
         ###
-        PowerFluxes=np.zeros((npvals,np.size(k)))
-        for i in np.arange(0,np.size(s_knot.names)):
-            (k,PowerFluxes[i,:])=self.loadpk(s_knot.names[i]+self.suf+snap+self.ext, s_knot.bfbox)
         #So now we have an array of data values, which we want to rebin.
         ind = np.where(kbins >= k[0])
         difPF_rebin=np.ones((npvals,np.size(kbins)))
@@ -467,6 +582,10 @@ class power_spec:
                 results[3*nk+k]=derivs[3]
         return results
     
+    def knot_files(self, s_knot):
+        """List of all files calc_all may load for a knot"""
+        return [self.base+sim+self.suf+snap+self.ext for sim in (s_knot.bstft,)+tuple(s_knot.names) for snap in self.Snaps]
+
     def calc_all(self, s_knot,kbins):
         """ Calculate the flux derivatives for all redshifts 
         Input: Sims to load, parameter values, mean parameter value
@@ -612,7 +731,7 @@ class flux_pow(power_spec):
     def loadpk(self, path,box):
         """Load a Pk. Different function due to needing to be different for each class"""
         #Adjust Fourier convention.
-        flux_power=np.loadtxt(self.base+path)
+        flux_power=loadtxt(self.base+path)
         scale=self.H0/box
         k=(flux_power[1:,0]-0.5)*scale*2.0*math.pi
         PF=flux_power[1:,1]/scale
@@ -635,19 +754,24 @@ class matter_pow(power_spec):
         self.ob=ob
         self.pre=matpre
 
+    def knot_files(self, s_knot):
+        """List of all files calc_all may load for a knot: the DM power is loaded with the baryon power."""
+        fnames=power_spec.knot_files(self, s_knot)
+        return fnames+[re.sub("by","DM",ff) for ff in fnames]
+
     def plot_z(self,Knot,redshift,title="Relative Matter Power",ylabel=r"$\mathrm{P}(k,p)\,/\,\mathrm{P}(k,p_0)$",legend=True):
         power_spec.plot_z(self,Knot,redshift,title,ylabel,legend)
 
     def loadpk(self, path,box):
         """Load a Pk. Different function due to needing to be different for each class"""
         #Load baryon P(k)
-        matter_power=np.loadtxt(self.base+path)
+        matter_power=loadtxt(self.base+path)
         scale=self.H0/box
         #Adjust Fourier convention.
         simk=matter_power[1:,0]*scale*2.0*math.pi
         Pkbar=matter_power[1:,1]/scale**3
         #Load DM P(k)
-        matter_power=np.loadtxt(self.base+re.sub("by","DM",path))
+        matter_power=loadtxt(self.base+re.sub("by","DM",path))
         PkDM=matter_power[1:,1]/scale**3
         Pk=(Pkbar*self.ob+PkDM*(self.om-self.ob))/self.om
         return (simk,Pk)
@@ -656,7 +780,7 @@ class matter_pow(power_spec):
         """ Plot absolute power spectrum, not relative"""
         (k_g, Pk_g)=power_spec.plot_power(self,path,redshift,colour,camb_filename)
         sigma=2.0
-        pkg=np.loadtxt(self.base+path+self.suf+self.pre+self.GetSnap(redshift)+self.ext)
+        pkg=loadtxt(self.base+path+self.suf+self.pre+self.GetSnap(redshift)+self.ext)
         samp_err=pkg[1:,2]
         sqrt_err=np.array(np.sqrt(samp_err))
         plt.loglog(k_g,Pk_g*(1+sigma*(2.0/sqrt_err+1.0/samp_err)),linestyle="-.",color="black")
@@ -682,7 +806,7 @@ class flux_pdf(power_spec):
         power_spec.__init__(self, Snaps,Zz,sdsskbins,knotpos, om, H0,box,base,suf,ext)
 
     def loadpk(self, path, box):
-        flux_pdf = np.loadtxt(self.base+path)
+        flux_pdf = loadtxt(self.base+path)
         return(flux_pdf[:,0], flux_pdf[:,1])
     
     def plot_compare_two(self, one, onebox, two,twobox,colour=""):
@@ -714,10 +838,33 @@ class flux_pdf(power_spec):
     def calc_z(self, redshift,s_knot,kbins):
         """ Calculate the flux derivatives for a single redshift
             Output: (kbins d2P...kbins dP (flat vector of length 2x21))"""
+        return self.fit_z(redshift, s_knot, kbins, self.load_z(redshift, s_knot))
+
+    def load_z(self, redshift, s_knot):
+        """Load the PDFs from the snapshots either side of redshift.
+            Output: (best-fit upper, upper sims, best-fit lower, lower sims)"""
+        npvals=np.size(s_knot.pvals)
+        ured=np.ceil(redshift*5)/5.
+        lred=np.floor(redshift*5)/5.
+        usnap=self.GetSnap(ured)
+        lsnap=self.GetSnap(lred)
+        #Load the data
+        (k,uPFp0)=self.loadpk(s_knot.bstft+self.suf+usnap+self.ext,s_knot.bfbox)
+        uPower=np.zeros((npvals,np.size(k)))
+        for i in np.arange(0,np.size(s_knot.names)):
+            (k,uPower[i,:])=self.loadpk(s_knot.names[i]+self.suf+usnap+self.ext, s_knot.bfbox)
+        (k,lPFp0)=self.loadpk(s_knot.bstft+self.suf+lsnap+self.ext,s_knot.bfbox)
+        lPower=np.zeros((npvals,np.size(k)))
+        for i in np.arange(0,np.size(s_knot.names)):
+            (k,lPower[i,:])=self.loadpk(s_knot.names[i]+self.suf+lsnap+self.ext, s_knot.bfbox)
+        return (uPFp0, uPower, lPFp0, lPower)
+
+    def fit_z(self, redshift, s_knot, kbins, data):
+        """ Calculate the flux derivatives for a single redshift from the output of load_z.
+            Output: (kbins d2P...kbins dP (flat vector of length 2x21))"""
         #Array to store answers.
         #Format is: k x (dP, d²P, χ²)
         kbins = np.array(kbins)
-        npvals=np.size(s_knot.pvals)
         nk=21
         results=np.zeros(2*nk)
         pdifs=s_knot.pvals-s_knot.p0
@@ -731,17 +878,7 @@ class flux_pdf(power_spec):
         ###
         ured=np.ceil(redshift*5)/5.
         lred=np.floor(redshift*5)/5.
-        usnap=self.GetSnap(ured)
-        lsnap=self.GetSnap(lred)
-        #Load the data
-        (k,uPFp0)=self.loadpk(s_knot.bstft+self.suf+usnap+self.ext,s_knot.bfbox)
-        uPower=np.zeros((npvals,np.size(k)))
-        for i in np.arange(0,np.size(s_knot.names)):
-            (k,uPower[i,:])=self.loadpk(s_knot.names[i]+self.suf+usnap+self.ext, s_knot.bfbox)
-        (k,lPFp0)=self.loadpk(s_knot.bstft+self.suf+lsnap+self.ext,s_knot.bfbox)
-        lPower=np.zeros((npvals,np.size(k)))
-        for i in np.arange(0,np.size(s_knot.names)):
-            (k,lPower[i,:])=self.loadpk(s_knot.names[i]+self.suf+lsnap+self.ext, s_knot.bfbox)
+        (uPFp0, uPower, lPFp0, lPower) = data
         PowerFluxes=5*((redshift-lred)*uPower+(ured-redshift)*lPower)
         PFp0=5*((redshift-lred)*uPFp0+(ured-redshift)*lPFp0)
         #So now we have an array of data values. 
@@ -848,13 +985,36 @@ class flux_interp:
     q0=np.array([])
     Zz=np.array([])
     kbins=np.array([])
-    """Initialization done from flux_pow class lets us keep all the messy I/O in there."""
-    def __init__(self,flux, Knots):
+    inputs_hash=""
+    """Initialization done from flux_pow class lets us keep all the messy I/O in there.
+    If nthreads > 0, the derivatives for all knots and redshifts are computed in parallel by calc_all_parallel,
+    with nthreads threads loading files and nprocs processes doing the fits.
+    The time taken for each (knot, redshift) is then in self.timings.
+    If table is a file name, the tables are loaded from it if it was made from identical input files,
+    and otherwise (or if it cannot be read) computed and saved to it.
+    Without a table, inputs_hash is not computed and is empty."""
+    def __init__(self,flux, Knots, nthreads=0, nprocs=0, table=None):
         if np.shape(Knots) == ():
             Knots=(Knots,)
         Knots=np.array(Knots)
+        #Hashing reads every input file, so only do it if there is a table to check or save
+        if table is not None:
+            self.inputs_hash=knots_hash(flux, Knots)
+        if table is not None and os.path.exists(table):
+            try:
+                saved=load_flux_interp(table, self.inputs_hash)
+                self.__dict__.update(saved.__dict__)
+                return
+            except (DataError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                #Stale, truncated or corrupt: rebuild it
+                pass
         self.kbins=flux.Getkbins()
-        tmp=np.fliplr(flux.calc_all(Knots[0],self.kbins))
+        self.timings=[]
+        if nthreads > 0:
+            (alld, self.timings)=calc_all_parallel(flux, Knots, self.kbins, nthreads, nprocs)
+        else:
+            alld=[flux.calc_all(Kn,self.kbins) for Kn in Knots]
+        tmp=np.fliplr(alld[0])
         self.derivs=np.empty(np.shape(Knots)+np.shape(tmp))
         self.derivs[0]=tmp
         if np.size(Knots[0].p0) > 1:
@@ -863,17 +1023,26 @@ class flux_interp:
             self.q0=np.empty([np.size(Knots),np.size(Knots[0].q0)])
             self.q0[0,:]=np.array(Knots[0].q0)
             for i in np.arange(1,np.size(Knots)):
-                self.derivs[i]=np.fliplr(flux.calc_all(Knots[i],self.kbins))
+                self.derivs[i]=np.fliplr(alld[i])
                 self.p0[i,:]=np.array(Knots[i].p0)
                 self.q0[i,:]=np.array(Knots[i].q0)
         else:
             self.p0=np.empty(np.shape(Knots))
             self.p0[0]=np.array(Knots[0].p0)
             for i in np.arange(1,np.size(Knots)):
-                self.derivs[i]=np.fliplr(flux.calc_all(Knots[i],self.kbins))
+                self.derivs[i]=np.fliplr(alld[i])
                 self.p0[i]=np.array(Knots[i].p0)
 
         self.Zz=np.flipud(flux.Zz)
+        if table is not None:
+            self.save(table)
+
+    def save(self, fname):
+        """Save the tables to a binary file, which can be loaded with load_flux_interp"""
+        tmpname=fname+".tmp.npz"
+        np.savez(tmpname, version=TABLE_VERSION, inputs_hash=self.inputs_hash, derivs=self.derivs,
+                 p0=self.p0, q0=self.q0, kbins=self.kbins, Zz=self.Zz)
+        os.replace(tmpname, fname)
     
     def GetPFSingleKnot(self, i, redshift, param,qaram=np.array([])):
         """ Get an interpolated estimate for the power spectrum with the change of a 
@@ -903,6 +1072,10 @@ class flux_interp:
                 curve=curve+self.GetPFSingleKnot(i, redshift,prms[i])
         return curve
 
+    def compile(self):
+        """Get a flux_table, for fast repeated evaluation of GetPF"""
+        return flux_table(self)
+
     def Get_MV_Tables(self,j,flux):
         """Get tables in the format Matteo uses for CosmoMC"""
         ind = np.where(self.Zz >= 2.2)
@@ -933,6 +1106,67 @@ class flux_interp:
             fd[:,i]=pdf.calc_z(pz[i], s_knot)
         return fd
            
+class flux_table(object):
+    """The derivative tables of a flux_interp, rearranged so that the predicted power
+    for all knots, redshifts and k bins is a single tensor contraction.
+    For use inside a sampler, where GetPF is called millions of times:
+        table = interp.compile()
+        curve = table.GetPF(prms, redshift)
+    Coefficients are stored as: knots x [d2P, dP, d2Q, dQ] x redshifts x kbins."""
+    def __init__(self, interp):
+        self.kbins=np.array(interp.kbins)
+        self.Zz=np.array(interp.Zz)
+        nk=np.size(self.kbins)
+        nz=np.size(self.Zz)
+        (nknots, nrows)=np.shape(interp.derivs)[0:2]
+        self.ncoeff=nrows//nk
+        self.coeffs=np.ascontiguousarray(interp.derivs[:,0:self.ncoeff*nk,:].reshape(nknots,self.ncoeff,nk,nz).transpose(0,1,3,2))
+        #Parameter values are either one per knot, or one per knot per redshift
+        self.per_z=np.ndim(interp.p0) > 1
+        self.p0=np.ones((nknots,nz))*np.reshape(interp.p0,(nknots,-1))
+        self.q0=np.zeros((nknots,nz))
+        if self.ncoeff > 2:
+            self.q0+=np.reshape(interp.q0,(nknots,-1))
+        #Map redshift -> index, replacing the floating point search in wheref
+        self.zindex=dict((self._zkey(zz),i) for (i,zz) in enumerate(self.Zz))
+
+    def _zkey(self, redshift):
+        """Dictionary key for a redshift. Rounded to avoid floating point inaccuracy."""
+        return round(float(redshift),5)
+
+    def zind(self, redshift):
+        """Index of a redshift in the table"""
+        try:
+            return self.zindex[self._zkey(redshift)]
+        except KeyError:
+            raise DataError("Redshift "+str(redshift)+" not in table")
+
+    def _offset(self, prms, p0):
+        """Parameter offsets from the knot values, shape (batch) x knots x redshifts"""
+        prms=np.asarray(prms, dtype=np.float64)
+        if not self.per_z:
+            prms=prms[...,np.newaxis]
+        return prms-p0
+
+    def GetPF(self, prms, redshift=None, qrms=None):
+        """Get an interpolated power spectrum estimate. Equivalent to flux_interp.GetPF.
+        prms has shape (batch) x knots, or (batch) x knots x redshifts if the knots have per-redshift parameters,
+        where (batch) is any number of leading dimensions for evaluating many parameter vectors at once.
+        If redshift is None, returns (batch) x redshifts x kbins, otherwise (batch) x kbins."""
+        dp=self._offset(prms, self.p0)
+        powers=[dp**2, dp]
+        if self.ncoeff > 2:
+            if qrms is None:
+                dq=np.zeros_like(dp)
+            else:
+                dq=self._offset(qrms, self.q0)
+            powers+=[dq**2, dq]
+        powers=np.stack(powers, axis=-2)
+        if redshift is None:
+            return np.einsum('...icz,iczk->...zk', powers, self.coeffs)
+        ind=self.zind(redshift)
+        return np.einsum('...ic,ick->...k', powers[...,ind], self.coeffs[:,:,ind,:])
+
 class matteo_flux_interp(flux_interp):
     """Load pre-calculated tables in the style Matteo uses"""
     def __init__(self, file, p0):
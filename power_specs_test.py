@@ -0,0 +1,163 @@
+"""Tests for the flux power spectrum derivative module, using a small fake simulation suite."""
+
+import os
+import numpy as np
+import power_specs
+import pkstore
+
+SNAPS = ("snapshot_000", "snapshot_001","snapshot_002","snapshot_003","snapshot_004","snapshot_005","snapshot_006","snapshot_007","snapshot_008","snapshot_009","snapshot_010","snapshot_011")
+
+def _write_flux(path, pf):
+    """Write a flux power spectrum file in the format output by the extraction code."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nbins = np.size(pf)
+    table = np.vstack([np.arange(nbins+1), np.concatenate([[0.], pf])]).T
+    np.savetxt(path, table)
+
+def _make_suite(base):
+    """Make a fake suite where P_F(p)/P_F(p0) - 1 = a dp^2 + b dp exactly."""
+    nbins = 80
+    kk = np.arange(1,nbins+1)
+    pf0 = 1./kk
+    aa = 0.02*np.log(kk)
+    bb = 0.1*np.sqrt(kk)/10.
+    pvals = (0.8,0.9,1.1,1.2)
+    for snap in SNAPS:
+        _write_flux(os.path.join(base,"best-fit/flux-power",snap+"_flux_power.txt"), pf0)
+        for pp in pvals:
+            dp = pp - 1.
+            _write_flux(os.path.join(base, "A"+str(pp)+"/flux-power",snap+"_flux_power.txt"), pf0*(1+aa*dp**2+bb*dp))
+    knot = power_specs.knot(tuple("A"+str(pp)+"/" for pp in pvals), pvals, 1.0, "best-fit/", 60)
+    return knot
+
+def test_loadpk_cache(tmp_path):
+    """Check that building the derivative tables parses each file only once."""
+    base = str(tmp_path)+"/"
+    knot = _make_suite(base)
+    power_specs.pk_cache.clear()
+    flux = power_specs.flux_pow(base=base, bf="best-fit/")
+    interp = power_specs.flux_interp(flux, knot)
+    #One file per simulation per snapshot, plus the best-fit.
+    assert power_specs.pk_cache.misses == 5*len(SNAPS)
+    assert power_specs.pk_cache.hits > 0
+    #Check the derivatives were recovered.
+    nk = np.size(interp.kbins)
+    kk = np.arange(1,nk+1)
+    assert np.allclose(interp.derivs[0,0:nk,0], 0.02*np.log(kk), atol=1e-3)
+    #Modifying a file invalidates the cache
+    fname = base+"best-fit/flux-power/snapshot_000_flux_power.txt"
+    os.utime(fname, (os.path.getatime(fname), os.path.getmtime(fname)+10))
+    misses = power_specs.pk_cache.misses
+    flux.loadpk("best-fit/flux-power/snapshot_000_flux_power.txt", 60)
+    assert power_specs.pk_cache.misses == misses + 1
+
+def test_binary_store(tmp_path):
+    """Check that spectra packed into the binary store load identically to the text files."""
+    base = str(tmp_path)+"/"
+    knot = _make_suite(base)
+    fname = base+"A0.8/flux-power/snapshot_003_flux_power.txt"
+    text = np.loadtxt(fname)
+    assert pkstore.convert_runs(base) == 5*len(SNAPS)
+    assert np.all(pkstore.load_table(fname) == text)
+    #The store is memory-mapped, not read into memory
+    assert isinstance(pkstore._open_store(os.path.dirname(fname))[0], np.memmap)
+    #Remove the text files: we should now read from the store.
+    for sim in knot.names+(knot.bstft,):
+        for snap in SNAPS:
+            os.remove(base+sim+"flux-power/"+snap+"_flux_power.txt")
+    assert pkstore.exists(fname)
+    power_specs.pk_cache.clear()
+    flux = power_specs.flux_pow(base=base, bf="best-fit/")
+    (kk, pf) = flux.loadpk("A0.8/flux-power/snapshot_003_flux_power.txt", 60)
+    assert np.all(pf == text[1:,1]/(flux.H0/60))
+    #A newer text file takes precedence
+    text[:,1] *= 2
+    np.savetxt(fname, text)
+    os.utime(fname, (os.path.getatime(fname), os.path.getmtime(fname)+10))
+    assert np.all(pkstore.load_table(fname) == text)
+    #So does one replaced by a copy with an older mtime
+    pkstore.convert_runs(base)
+    mtime = os.path.getmtime(fname)
+    text[:,1] *= 2
+    np.savetxt(fname, text)
+    os.utime(fname, (mtime-100, mtime-100))
+    assert np.all(pkstore.load_table(fname) == text)
+
+def test_parallel_build(tmp_path):
+    """Check that building the tables in parallel gives the same answer as the serial build."""
+    base = str(tmp_path)+"/"
+    knot = _make_suite(base)
+    flux = power_specs.flux_pow(base=base, bf="best-fit/")
+    serial = power_specs.flux_interp(flux, (knot, knot))
+    threaded = power_specs.flux_interp(flux, (knot, knot), nthreads=4)
+    assert np.all(threaded.derivs == serial.derivs)
+    assert len(threaded.timings) == 2*len(SNAPS)
+    procs = power_specs.flux_interp(flux, (knot, knot), nthreads=4, nprocs=2)
+    assert np.all(procs.derivs == serial.derivs)
+    assert np.all(procs.p0 == serial.p0)
+
+def test_flux_table():
+    """Check the compiled evaluator against the GetPF loop, with and without per-redshift parameters."""
+    rng = np.random.RandomState(23)
+    (nknots, nk) = (3, 5)
+    interp = power_specs.flux_interp.__new__(power_specs.flux_interp)
+    interp.kbins = np.arange(nk)
+    interp.Zz = np.arange(2.0, 4.4, 0.2)
+    nz = np.size(interp.Zz)
+    interp.derivs = rng.normal(size=(nknots, 2*nk, nz))
+    interp.p0 = rng.uniform(size=nknots)
+    interp.q0 = np.array([])
+    table = interp.compile()
+    prms = rng.uniform(size=(4, nknots))
+    for zz in interp.Zz:
+        assert np.allclose(table.GetPF(prms[0], zz), interp.GetPF(prms[0], zz))
+    batch = table.GetPF(prms)
+    assert np.shape(batch) == (4, nz, nk)
+    for (b, pp) in enumerate(prms):
+        assert np.allclose(batch[b, 3], interp.GetPF(pp, interp.Zz[3]))
+    #Parameters varying with redshift, as for the thermal history knots
+    interp.derivs = rng.normal(size=(nknots, 4*nk, nz))
+    interp.p0 = rng.uniform(size=(nknots, nz))
+    interp.q0 = rng.uniform(size=(nknots, nz))
+    table = interp.compile()
+    prms = rng.uniform(size=(nknots, nz))
+    qrms = rng.uniform(size=(nknots, nz))
+    for zz in interp.Zz:
+        assert np.allclose(table.GetPF(prms, zz, qrms), interp.GetPF(prms, zz, qrms))
+
+def test_saved_table(tmp_path):
+    """Check that tables are saved, reloaded, and rebuilt when an input file changes."""
+    base = str(tmp_path)+"/"
+    knot = _make_suite(base)
+    table = base+"table.npz"
+    flux = power_specs.flux_pow(base=base, bf="best-fit/")
+    built = power_specs.flux_interp(flux, knot, table=table)
+    loaded = power_specs.load_flux_interp(table)
+    for name in ("derivs", "p0", "q0", "kbins", "Zz"):
+        assert np.all(getattr(loaded, name) == getattr(built, name))
+    assert np.all(loaded.compile().GetPF([1.1]) == built.compile().GetPF([1.1]))
+    #Loading again should not parse any files
+    power_specs.pk_cache.clear()
+    again = power_specs.flux_interp(flux, knot, table=table)
+    assert power_specs.pk_cache.misses == 0
+    assert np.all(again.derivs == built.derivs)
+    #Change an input: the table is stale and should be rebuilt
+    _write_flux(base+"A1.2/flux-power/snapshot_004_flux_power.txt", 2./np.arange(1,81))
+    try:
+        power_specs.load_flux_interp(table, power_specs.knots_hash(flux, (knot,)))
+        assert False
+    except power_specs.DataError:
+        pass
+    rebuilt = power_specs.flux_interp(flux, knot, table=table)
+    assert np.any(rebuilt.derivs != built.derivs)
+    assert power_specs.load_flux_interp(table, rebuilt.inputs_hash).inputs_hash == rebuilt.inputs_hash
+    #Without a table the inputs are not hashed
+    assert power_specs.flux_interp(flux, knot).inputs_hash == ""
+    #A truncated table is rebuilt
+    with open(table, "rb") as ff:
+        data = ff.read()
+    with open(table, "wb") as ff:
+        ff.write(data[:len(data)//2])
+    repaired = power_specs.flux_interp(flux, knot, table=table)
+    assert np.all(repaired.derivs == rebuilt.derivs)
+    assert np.all(power_specs.load_flux_interp(table).derivs == rebuilt.derivs)
@@ -1,12 +1,16 @@
 """ find the Schwarzschild radius of the Sun in m using pint"""
 
-import pint
+import numpy as np
+import unitregistry
+
+def rs_per_msolar():
+    """ The Schwarzschild radius of one solar mass, 2 G M_sun / c^2, in m. The conversion is cached. """
+    return 2 * unitregistry.constant("newtonian_constant_of_gravitation") * unitregistry.conversion("Msolar", "kg") / unitregistry.constant("speed_of_light")**2
 
 class Sun:
     """ Class to describe a star based on its mass in terms of solar masses """
     def __init__(self, mass):
-        self.ureg = pint.UnitRegistry()
-        self.ureg.define("Msolar = 1.98855*10**30 * kilogram")
+        self.ureg = unitregistry.get_registry()
         self.mass = mass * self.ureg.Msolar
 
     def schwarz(self):
@@ -16,10 +20,17 @@ class Sun:
         r_sch = 2 * g_newt * msun / self.ureg.speed_of_light**2
         return r_sch.to_base_units()
 
-def schwarz_rad(mass):
-    """ Given a mass, find the Schwarzschild radius """
-    star = Sun(mass)
-    radius = star.schwarz()
+def schwarz_rad(mass, units=True):
+    """ Given a mass, find the Schwarzschild radius.
+    mass may be a number or array in solar masses (or a dimensionless Quantity), or a pint mass quantity.
+    Returns a pint quantity in m, or if units is False a float64 array in m.
+    Vectorized: the constants are converted once, so it is fast for large catalogues. """
+    ureg = unitregistry.get_registry()
+    if isinstance(mass, ureg.Quantity):
+        mass = mass.magnitude if mass.dimensionless else mass.to(ureg.Msolar).magnitude
+    radius = rs_per_msolar() * np.asarray(mass, dtype=np.float64)
+    if units:
+        return radius * ureg.meter
     return radius
 
 if __name__ == "__main__":
@@ -0,0 +1,23 @@
+"""Tests for the Schwarzschild radius"""
+import numpy as np
+import unitregistry
+import problem3a
+
+def test_schwarz_rad():
+    """The vectorized radius agrees with the Sun class, with and without units."""
+    ureg = unitregistry.get_registry()
+    single = problem3a.Sun(3.).schwarz()
+    assert np.isclose(problem3a.schwarz_rad(3.).to("m").magnitude, single.magnitude)
+    masses = np.array([1., 10., 1e6])
+    radii = problem3a.schwarz_rad(masses, units=False)
+    assert radii.dtype == np.float64
+    assert np.allclose(radii, [problem3a.Sun(m).schwarz().magnitude for m in masses])
+    assert np.allclose(problem3a.schwarz_rad(masses*1.98855e30*ureg.kg, units=False), radii)
+
+def test_schwarz_rad_dimensionless():
+    """A dimensionless Quantity, eg a mass ratio, is a number of solar masses."""
+    ureg = unitregistry.get_registry()
+    masses = np.array([1., 10., 1e6])
+    ratio = masses*ureg.Msolar/(1.*ureg.Msolar)
+    assert np.allclose(problem3a.schwarz_rad(ratio, units=False), problem3a.schwarz_rad(masses, units=False))
+    assert np.isclose(problem3a.schwarz_rad(3.*ureg.dimensionless).to("m").magnitude, problem3a.Sun(3.).schwarz().magnitude)
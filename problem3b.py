@@ -5,8 +5,6 @@ The result: the number of halos with mass > 10^12 Msolar at z=0 is effectively 0
 
 # The plan: get the mass function dn/dM and integrate for masses above 10^12 Msolar
 
-import numpy as np
-import scipy
 import halo_mass_function as hm
 
 def num_halos_above(z, msolar):
@@ -14,10 +12,8 @@ def num_halos_above(z, msolar):
     # halo.dndm requires mass in units of M_sun / h, so we need to divide the mass by hubble:
     h = halo.overden.hubble0
     mass = msolar / h
-    dndM = lambda m: halo.dndm(m)
-    nhalos = scipy.integrate.quad(dndM, mass, np.inf)
-    # scipy integrating returns results for the upper and lower bounds so let's properly subtract them:
-    return nhalos[0]-nhalos[1]
+    # The mass function integrated from mass to the top of the sigma tables, looked up from a table.
+    return halo.n_above(mass)
 
 if __name__ == "__main__":
     z = 0
@@ -1,6 +1,10 @@
 """ Write a simple routine to multiply two matrices together. Write one routine using nested for loops,
-one using a list comprehension, and one using the built-in numpy matrix multiplication routines."""
+one using a list comprehension, and one using the built-in numpy matrix multiplication routines.
+blocked_mult and threaded_mult multiply tiles with numpy, to show how close python orchestration gets to BLAS.
+All routines return a numpy array."""
 
+import os
+import concurrent.futures
 import numpy as np
 
 def for_mult(amatrix, bmatrix):
@@ -21,13 +25,58 @@ def for_mult(amatrix, bmatrix):
 
 def comp_mult(amatrix, bmatrix):
     """ amatrix and bmatrix are matrices (numpy arrays) that we will multiply using list comprehensions """
-    a_columns = range(len(amatrix[0, :]))
+    a_rows = range(len(amatrix[:, 0]))
     b_rows = range(len(bmatrix[:, 0]))
     b_columns = range(len(bmatrix[0, :]))
-    cmatrix = [[sum(amatrix[i, k] * bmatrix[k, j] for k in b_rows) for j in b_columns] for i in a_columns]
-    return cmatrix
+    assert len(amatrix[0, :]) == len(b_rows), "matrix dimensions do not match"
+    cmatrix = [[sum(amatrix[i, k] * bmatrix[k, j] for k in b_rows) for j in b_columns] for i in a_rows]
+    return np.array(cmatrix, dtype=np.float64)
 
 def np_mult(amatrix, bmatrix):
     """ multiply two matrices using built-in numpy function """
     cmatrix = np.matmul(amatrix, bmatrix)
     return cmatrix
+
+def _tiles(size, tile):
+    """ slices covering range(size) in steps of tile """
+    return [slice(start, min(start + tile, size)) for start in range(0, size, tile)]
+
+def _mult_tile(amatrix, bmatrix, cmatrix, rows, columns, inner):
+    """ compute one tile of the output, cmatrix[rows, columns], summing over the inner tiles """
+    ctile = cmatrix[rows, columns]
+    for kslice in inner:
+        ctile += np.matmul(amatrix[rows, kslice], bmatrix[kslice, columns])
+
+def _setup_blocked(amatrix, bmatrix, tile):
+    """ check dimensions and make the output array and the tiles for a blocked multiply """
+    amatrix = np.asarray(amatrix)
+    bmatrix = np.asarray(bmatrix)
+    assert amatrix.shape[1] == bmatrix.shape[0], "matrix dimensions do not match"
+    assert tile > 0, "tile size must be positive"
+    cmatrix = np.zeros((amatrix.shape[0], bmatrix.shape[1]), dtype=np.result_type(amatrix, bmatrix))
+    tiles = (_tiles(amatrix.shape[0], tile), _tiles(bmatrix.shape[1], tile), _tiles(amatrix.shape[1], tile))
+    return amatrix, bmatrix, cmatrix, tiles
+
+def blocked_mult(amatrix, bmatrix, tile=128):
+    """ multiply two matrices by splitting them into tile x tile blocks, which fit in cache,
+    and multiplying the blocks with numpy """
+    amatrix, bmatrix, cmatrix, (rows, columns, inner) = _setup_blocked(amatrix, bmatrix, tile)
+    for islice in rows:
+        for jslice in columns:
+            _mult_tile(amatrix, bmatrix, cmatrix, islice, jslice, inner)
+    return cmatrix
+
+def threaded_mult(amatrix, bmatrix, tile=256, nthreads=None):
+    """ blocked multiply with the output tiles split between a pool of nthreads threads.
+    numpy releases the GIL during the block multiplies, so the threads run in parallel.
+    Each thread writes to different output tiles, so no locking is needed.
+    nthreads defaults to the number of cpus. """
+    amatrix, bmatrix, cmatrix, (rows, columns, inner) = _setup_blocked(amatrix, bmatrix, tile)
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max(nthreads, 1)) as pool:
+        jobs = [pool.submit(_mult_tile, amatrix, bmatrix, cmatrix, islice, jslice, inner) for islice in rows for jslice in columns]
+        for job in jobs:
+            #Raise any exceptions
+            job.result()
+    return cmatrix
@@ -0,0 +1,28 @@
+"""Tests for the matrix multiplication routines"""
+import numpy as np
+import problem3c
+
+def test_blocked():
+    """Blocked and threaded multiplies agree with numpy, including for tiles which do not divide the matrix."""
+    amatrix = np.random.random((70, 45))
+    bmatrix = np.random.random((45, 33))
+    expected = problem3c.np_mult(amatrix, bmatrix)
+    for tile in (1, 16, 128):
+        assert np.allclose(problem3c.blocked_mult(amatrix, bmatrix, tile=tile), expected)
+        assert np.allclose(problem3c.threaded_mult(amatrix, bmatrix, tile=tile, nthreads=3), expected)
+    try:
+        problem3c.blocked_mult(amatrix, amatrix)
+    except AssertionError:
+        pass
+    else:
+        assert False
+
+def test_result_type():
+    """All the routines return numpy arrays."""
+    amatrix = np.random.randint(10, size=(5, 4))
+    bmatrix = np.random.random((4, 6))
+    expected = problem3c.np_mult(amatrix, bmatrix)
+    for mult in (problem3c.for_mult, problem3c.comp_mult, problem3c.blocked_mult, problem3c.threaded_mult):
+        result = mult(amatrix, bmatrix)
+        assert isinstance(result, np.ndarray)
+        assert np.allclose(result, expected)
@@ -1,4 +1,5 @@
-""" Simple test for Problem 3c: multiply a large matrix with its inverse to obtain the identity. """
+""" Simple test for Problem 3c: multiply a large matrix with its inverse to obtain the identity.
+Also a benchmark of the matrix multiplication routines over a range of matrix sizes. """
 
 # Results: all of the matrix multiplication implementations in Problem 3c work
 # BUT they have wildly varying degrees of efficiency:
@@ -6,7 +7,13 @@
 # List comprehensions take about the same amount of time as for loops, since
 #    they are basically just for loops in disguise
 # The built-in numpy function takes almost no time at all
+# Run this file with --help to see the benchmark options.
 
+import argparse
+import json
+import platform
+import time
+import tracemalloc
 import numpy as np
 import problem3c
 
@@ -14,37 +21,114 @@ A = np.random.randint(10., size=(100, 100))
 
 A_INV = np.linalg.inv(A)
 
+#Multiplication routines to benchmark, and the largest matrix to give them.
+#The pure python routines take seconds already at size 128.
+ENGINES = {"for_mult" : (problem3c.for_mult, 128),
+           "comp_mult" : (problem3c.comp_mult, 128),
+           "np_mult" : (problem3c.np_mult, None),
+           "blocked_mult" : (problem3c.blocked_mult, None),
+           "threaded_mult" : (problem3c.threaded_mult, None),
+          }
+
+SIZES = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+def check_identity(I):
+    """ check that a matrix is the identity, to the accuracy expected of inverting A """
+    assert np.allclose(I, np.eye(np.shape(I)[0]), rtol=0, atol=1e-4), "Result is not the identity matrix"
+    offdiag = I - np.diag(np.diag(I))
+    assert np.all(np.abs(offdiag) <= 10**-12), "Result is not the identity matrix"
+
 def test_for():
     """ test the for loop multiplication with a big matrix """
     print("Testing for loop multiplication")
-    I = problem3c.for_mult(A, A_INV)
-    for i in range(len(I[0])):
-        assert 0.9999 <= I[i][i] <= 1.0001, "Result is not the identity matrix"
-        for j in range(len(I[0])):
-            if j != i:
-                assert abs(I[i][j]) <= 10**-12, "Result is not the identity matrix"
+    check_identity(problem3c.for_mult(A, A_INV))
 
 def test_comp():
     """ test the list comprehension multiplication from problem 3c """
     print("Testing list comprehension multiplication")
-    I = problem3c.comp_mult(A, A_INV)
-    for i in range(len(I[0])):
-        assert 0.9999 <= I[i][i] <= 1.0001, "Result is not the identity matrix"
-        for j in range(len(I[0])):
-            if j != i:
-                assert abs(I[i][j]) <= 10**-12, "Result is not the identity matrix"
+    check_identity(problem3c.comp_mult(A, A_INV))
 
 def test_np():
     """ test the built-in numpy matrix multiplication """
     print("Testing built-in numpy.matmult")
-    I = problem3c.np_mult(A, A_INV)
-    for i in range(len(I[0])):
-        assert 0.9999 <= I[i][i] <= 1.0001, "Result is not the identity matrix"
-        for j in range(len(I[0])):
-            if j != i:
-                assert abs(I[i][j]) <= 10**-12, "Result is not the identity matrix"
+    check_identity(problem3c.np_mult(A, A_INV))
+
+def time_mult(mult, amatrix, bmatrix, repeats=5, warmup=1):
+    """ time a multiplication routine. Returns the median time in seconds over repeats calls,
+    after warmup calls which are not timed, and the result of the last call. """
+    for _ in range(warmup):
+        result = mult(amatrix, bmatrix)
+    times = []
+    for _ in range(max(repeats, 1)):
+        start = time.perf_counter()
+        result = mult(amatrix, bmatrix)
+        times.append(time.perf_counter() - start)
+    return np.median(times), result
+
+def peak_memory(mult, amatrix, bmatrix):
+    """ peak memory allocated by python and numpy during one call, in bytes """
+    tracemalloc.start()
+    try:
+        mult(amatrix, bmatrix)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def run_benchmarks(sizes=SIZES, engines=None, repeats=5, warmup=1, seed=42):
+    """ benchmark the multiplication routines in ENGINES (or the names in engines) on random square matrices of each size.
+    Routines are skipped for sizes above their cap. Returns a list of dictionaries, one per (routine, size),
+    with the median time, the speed in GFLOP/s (counting 2 n^3 operations), the peak memory and
+    whether the result agreed with np.matmul. """
+    if engines is None:
+        engines = list(ENGINES)
+    rng = np.random.RandomState(seed)
+    results = []
+    for size in sizes:
+        amatrix = rng.random_sample((size, size))
+        bmatrix = rng.random_sample((size, size))
+        expected = np.matmul(amatrix, bmatrix)
+        for name in engines:
+            mult, maxsize = ENGINES[name]
+            if maxsize is not None and size > maxsize:
+                continue
+            median, result = time_mult(mult, amatrix, bmatrix, repeats=repeats, warmup=warmup)
+            results.append({"engine" : name, "size" : size, "repeats" : repeats,
+                            "median_time" : median, "gflops" : 2.*size**3/median/1e9,
+                            "peak_memory" : peak_memory(mult, amatrix, bmatrix),
+                            "correct" : bool(np.allclose(result, expected))})
+    return results
+
+def save_benchmarks(results, fname):
+    """ save benchmark results to a json file, with the versions and machine they were run on,
+    so that runs can be compared over time """
+    output = {"date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "numpy" : np.__version__,
+              "python" : platform.python_version(),
+              "machine" : platform.machine(),
+              "processor" : platform.processor(),
+              "results" : results}
+    with open(fname, 'w') as outfile:
+        json.dump(output, outfile, indent=1)
+
+def print_benchmarks(results):
+    """ print a table of benchmark results """
+    print("%14s %6s %12s %10s %12s %8s" % ("engine", "size", "median (s)", "GFLOP/s", "peak (MB)", "correct"))
+    for res in results:
+        print("%14s %6d %12.4g %10.3g %12.3g %8s" % (res["engine"], res["size"], res["median_time"], res["gflops"], res["peak_memory"]/1024**2, res["correct"]))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the matrix multiplication routines in problem3c")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Matrix sizes to benchmark")
+    parser.add_argument("--engines", nargs="+", default=None, choices=list(ENGINES), help="Routines to benchmark")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed calls for each size")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of untimed calls before timing")
+    parser.add_argument("--output", default=None, help="json file to save the results to")
+    args = parser.parse_args()
     test_for()
     test_comp()
     test_np()
+    RESULTS = run_benchmarks(args.sizes, args.engines, repeats=args.repeats, warmup=args.warmup)
+    print_benchmarks(RESULTS)
+    if args.output is not None:
+        save_benchmarks(RESULTS, args.output)
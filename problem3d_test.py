@@ -0,0 +1,22 @@
+"""Tests for the matrix multiplication benchmark"""
+import json
+import problem3d
+
+def test_identity():
+    """The checks of problem 3c still pass."""
+    problem3d.test_for()
+    problem3d.test_comp()
+    problem3d.test_np()
+
+def test_benchmarks(tmp_path):
+    """A small benchmark run covers each routine and size, respects the caps and can be saved."""
+    results = problem3d.run_benchmarks(sizes=(8, 200), repeats=2)
+    assert all(res["correct"] for res in results)
+    assert len(results) == 2*len(problem3d.ENGINES) - 2
+    assert all(res["size"] == 8 for res in results if res["engine"] == "for_mult")
+    assert all(res["median_time"] > 0 and res["peak_memory"] > 0 for res in results)
+    fname = str(tmp_path / "bench.json")
+    problem3d.save_benchmarks(results, fname)
+    with open(fname) as infile:
+        saved = json.load(infile)
+    assert saved["results"] == results
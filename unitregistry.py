@@ -0,0 +1,56 @@
+"""A single pint unit registry, shared between modules and built when first needed.
+Building a pint.UnitRegistry takes a large fraction of a second, so classes should call
+get_registry() rather than making their own. Quantities from the shared registry can also be
+mixed freely between objects.
+Units depending on the Hubble constant (Msun/h, Mpc/h) cannot be defined once for every
+cosmology, so they are handled with conversion factors by HubbleUnits."""
+
+import functools
+import pint
+
+_registry = None
+
+def get_registry():
+    """Get the shared unit registry, building it on the first call."""
+    global _registry
+    if _registry is None:
+        ureg = pint.UnitRegistry()
+        ureg.define("Msolar = 1.98855*10**30 * kilogram")
+        #Mpc newton's constant and light speed are already defined.
+        _registry = ureg
+    return _registry
+
+@functools.lru_cache(maxsize=None)
+def conversion(src, dst):
+    """Factor by which to multiply a number in units src to get a number in units dst.
+    Units are strings, eg: conversion("Mpc", "m"). Cached, so cheap to call in loops."""
+    ureg = get_registry()
+    return ureg.Quantity(1, src).to(dst).magnitude
+
+@functools.lru_cache(maxsize=None)
+def constant(name):
+    """The value of a physical constant in SI base units, as a number, eg: constant("speed_of_light")"""
+    return get_registry().Quantity(1, name).to_base_units().magnitude
+
+class HubbleUnits(object):
+    """Convert between physical units and the h-scaled units (Msun/h, Mpc/h) of a cosmology with hubble parameter h,
+    without defining a hubble-dependent unit in the shared registry."""
+    def __init__(self, hubble):
+        self.hubble = hubble
+        self.ureg = get_registry()
+
+    def msolarh(self, mass):
+        """Convert a pint mass, or a number (or dimensionless Quantity) in Msun, to a number in Msun/h."""
+        if isinstance(mass, self.ureg.Quantity):
+            mass = mass.magnitude if mass.dimensionless else mass.to(self.ureg.Msolar).magnitude
+        return mass * self.hubble
+
+    def mpch(self, length):
+        """Convert a pint length, or a number (or dimensionless Quantity) in Mpc, to a number in Mpc/h."""
+        if isinstance(length, self.ureg.Quantity):
+            length = length.magnitude if length.dimensionless else length.to(self.ureg.Mpc).magnitude
+        return length * self.hubble
+
+    def mass_function(self, dndm):
+        """Convert a mass function in h^4 Mpc^-3 Msun^-1 (ie, per (Mpc/h)^3 per Msun/h) to a pint quantity per Mpc^3 per Msun."""
+        return dndm * self.hubble**4 * self.ureg('Mpc**(-3) Msolar**(-1)')
@@ -0,0 +1,30 @@
+"""Tests for the shared unit registry"""
+import numpy as np
+import unitregistry
+
+def test_shared_registry():
+    """The registry is built once and knows about solar masses."""
+    ureg = unitregistry.get_registry()
+    assert unitregistry.get_registry() is ureg
+    assert np.isclose((1*ureg.Msolar).to("kg").magnitude, 1.98855e30)
+
+def test_conversion():
+    """Cached conversion factors match pint."""
+    ureg = unitregistry.get_registry()
+    assert unitregistry.conversion("Mpc", "m") == (1*ureg.Mpc).to("m").magnitude
+    assert np.isclose(unitregistry.conversion("Gpc**(-3)", "Mpc**(-3)"), 1e-9)
+    assert np.isclose(unitregistry.constant("speed_of_light"), 299792458)
+
+def test_hubble_units():
+    """Different cosmologies share the registry but have their own h-scaled units."""
+    ureg = unitregistry.get_registry()
+    h1 = unitregistry.HubbleUnits(0.7)
+    h2 = unitregistry.HubbleUnits(0.5)
+    assert np.isclose(h1.msolarh(2*ureg.Msolar), 1.4)
+    assert np.isclose(h2.msolarh(2), 1.)
+    assert np.isclose(h2.mpch(1000*ureg.kpc), 0.5)
+    #Dimensionless quantities are numbers in Msun or Mpc
+    assert np.isclose(h1.msolarh(ureg.Quantity(2.)), 1.4)
+    assert np.allclose(h2.mpch(ureg.Quantity(np.array([1., 4.]))), [0.5, 2.])
+    dndm = h1.mass_function(np.array([1., 2.]))
+    assert np.allclose(dndm.to("Mpc**(-3) Msolar**(-1)").magnitude, 0.7**4*np.array([1., 2.]))